@@ -0,0 +1,361 @@
+# benchmark.py
+"""
+求解の所要時間を段階ごとに計測するベンチマーク
+
+合成したアンケート（生徒数・講座数・受講講座数・人気の偏り・同じ希望の生徒の割合を指定）
+について、読み込み → モデル構築 → 初期解 → 求解 → 結果の抽出 → 保存 の各段階の時間を計り、
+JSON / CSV のスケーリングレポートに書き出す。版ごとのレポートを比べると、
+どの段階で遅くなったかが分かる。
+
+    python benchmark.py --students 100 300 1000 --modes decomposed heuristic \
+        --json bench.json --csv bench.csv
+
+--startup を付けると、代わりに起動から最初の入力待ちまでの時間を計る（EXE も計れる）。
+
+    python benchmark.py --startup --repeat 5 --max-startup 1.0
+    python benchmark.py --startup --startup-command dist/student-scheduler.exe
+"""
+import argparse
+import contextlib
+import csv
+import datetime
+import io
+import itertools
+import json
+import os
+import platform
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from importlib import metadata
+
+import numpy as np
+import openpyxl
+
+from main import StudentScheduler, available_engines
+
+# レポートの列（CSV の見出しの順）
+REPORT_FIELDS = [
+    'mode', 'engine', 'students', 'courses', 'periods', 'choices', 'skew', 'duplicates',
+    'min', 'max', 'repeat', 'status', 'objective', 'num_cols', 'num_rows', 'num_nonzeros',
+    'load', 'build', 'start', 'solve', 'extract', 'save', 'total',
+]
+PHASES = ['load', 'build', 'start', 'solve', 'extract', 'save']
+
+# 対話モードの最初の入力待ちの表示
+FIRST_PROMPT = "生徒の人数を入力してください"
+# main を import しただけでは読み込まれないはずの重いモジュール
+HEAVY_MODULES = ['openpyxl', 'pulp', 'highspy', 'ortools', 'concurrent.futures']
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+def generate_survey(path, num_students, num_courses, num_choices=None, skew=1.0,
+                    duplicate_ratio=0.0, seed=0):
+    """
+    合成アンケートを作る（拡張子が .csv なら CSV、それ以外は Excel）
+
+    講座 c（0始まり）の人気を 1 / (c + 1) ** skew（Zipf 型）とし、各生徒の希望リストは
+    人気に比例する確率で重複なしに順に選ぶ（Gumbel ノイズを加えた対数人気の上位）。
+    skew=0 なら全講座が同じ人気。duplicate_ratio の割合の生徒は、それより前の
+    生徒の希望リストをそのまま写す（希望パターン集約の効き具合を調べる用）。
+    """
+    rng = np.random.default_rng(seed)
+    num_choices = num_courses if num_choices is None else num_choices
+    weights = 1.0 / np.arange(1, num_courses + 1) ** skew
+    keys = np.log(weights) + rng.gumbel(size=(num_students, num_courses))
+    prefs = np.argsort(-keys, axis=1)[:, :num_choices]
+
+    duplicates = rng.random(num_students) < duplicate_ratio
+    duplicates[0] = False
+    for s in np.flatnonzero(duplicates):
+        prefs[s] = prefs[rng.integers(s)]
+
+    names = [f"講座{c + 1:02d}" for c in range(num_courses)]
+    header = ['生徒番号', '氏名'] + [f'第{i}希望' for i in range(1, num_choices + 1)]
+    rows = ([f"{s + 1:05d}", f"生徒{s + 1}"] + [names[c] for c in row] for s, row in enumerate(prefs))
+
+    if os.path.splitext(path)[1].lower() == '.csv':
+        with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+        return
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("アンケート入力")
+    ws.append(header)
+    for row in rows:
+        ws.append(row)
+    wb.save(path)
+
+
+def capacity_bounds(num_students, num_courses, slack):
+    """1コマあたりの平均人数の ±slack 倍を最低・最高人数にする"""
+    average = num_students / num_courses
+    return int(np.floor(average * (1 - slack))), int(np.ceil(average * (1 + slack)))
+
+
+def run_case(path, output, mode, num_periods, num_choices, min_per_course, max_per_course,
+             engine=None, time_limit=None, warm_start=True):
+    """
+    1つのアンケートを指定した方式で解き、段階ごとの秒数などを辞書で返す
+
+    mode: 'ilp'（全体モデル）/ 'decomposed'（2段階分解）/ 'heuristic'
+    求解に失敗した場合は status に理由を入れ、以降の段階は None のまま返す。
+    """
+    row = dict.fromkeys(PHASES)
+    row.update(status='OK', objective=None, num_cols=None, num_rows=None, num_nonzeros=None)
+
+    scheduler = StudentScheduler(None, num_periods, num_choices, min_per_course, max_per_course)
+    scheduler.input_file = path
+    scheduler.output_file = output
+    scheduler.engine = engine
+    scheduler.time_limit = time_limit
+
+    def timed(phase, func, *args):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            value_ = func(*args)
+        row[phase] = round(time.perf_counter() - start, 4)
+        return value_
+
+    timed('load', scheduler.load_data)
+
+    if mode == 'heuristic':
+        row['build'] = row['start'] = 0.0
+        course_sets = timed('solve', scheduler._heuristic_course_sets)
+        if course_sets is None:
+            row['status'] = '人数条件を満たせない'
+            return row
+        result = timed('extract', scheduler._assign_course_sets, course_sets.tolist())
+    else:
+        if mode == 'ilp':
+            model, x_idx = timed('build', scheduler.build_ilp_matrix)
+            start = lambda: scheduler._ilp_start(model, x_idx)
+        elif mode == 'decomposed':
+            model, y_idx = timed('build', scheduler.build_selection_matrix)
+            start = lambda: scheduler._heuristic_start(y_idx, y_idx.size, y_idx.size + 1,
+                                                       model.num_cols)[0]
+        else:
+            raise ValueError(f"ベンチマークできない求解方式です: {mode}")
+        row.update(num_cols=model.num_cols, num_rows=model.num_rows, num_nonzeros=model.num_nonzeros)
+
+        initial = None
+        row['start'] = 0.0
+        if warm_start:
+            initial = timed('start', start)
+
+        status, col_value, _ = timed('solve', scheduler._solve_matrix, model, initial)
+        if col_value is None:
+            row['status'] = status
+            return row
+        if status != 'Optimal':
+            row['status'] = status
+
+        if mode == 'ilp':
+            result = timed('extract', scheduler.extract_ilp_result, col_value, x_idx)
+        else:
+            chosen = col_value[y_idx] > 0.5
+            result = timed('extract', scheduler._assign_course_sets,
+                           [np.flatnonzero(r).tolist() for r in chosen])
+
+    if result is None:
+        row['status'] = '時限への割り当てに失敗'
+        return row
+
+    summary = scheduler.statistics(result)['summary']
+    row['objective'] = summary['weighted_objective']
+    timed('save', scheduler.save_results, result)
+    return row
+
+
+def startup_time(command, prompt=FIRST_PROMPT):
+    """command を起動してから最初の入力待ち（prompt の表示）までの秒数"""
+    env = dict(os.environ, PYTHONIOENCODING='utf-8')
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, env=env)
+    try:
+        output = b''
+        while prompt.encode('utf-8') not in output:
+            chunk = os.read(process.stdout.fileno(), 4096)
+            if not chunk:
+                raise RuntimeError(f"入力待ちになる前に終了しました: {shlex.join(command)}")
+            output += chunk
+        return time.perf_counter() - start
+    finally:
+        process.kill()
+        process.wait()
+
+
+def modules_loaded_at_import():
+    """main を import した直後に読み込まれている HEAVY_MODULES"""
+    code = ("import sys, main; "
+            f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(MAIN_SCRIPT)).stdout
+    return out.split()
+
+
+def run_startup(args):
+    """--startup: 起動時間を計測して表示・保存する（--max-startup を超えたら終了コード 1）"""
+    command = shlex.split(args.startup_command) if args.startup_command else [sys.executable, MAIN_SCRIPT]
+    times = []
+    for repeat in range(args.repeat):
+        times.append(round(startup_time(command), 4))
+        print(f"起動時間（{repeat + 1}/{args.repeat}）: {times[-1]:.3f}秒", flush=True)
+    loaded = modules_loaded_at_import()
+    report = {'command': command, 'seconds': times, 'min': min(times),
+              'median': round(statistics.median(times), 4), 'heavy_modules_at_import': loaded}
+
+    print(f"\n最初の入力待ちまで: 最小 {report['min']:.3f}秒 / 中央値 {report['median']:.3f}秒")
+    if loaded:
+        print(f"※ import 時に重いモジュールが読み込まれています: {', '.join(loaded)}")
+
+    if args.json is not None:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'environment': environment(), 'startup': report}, f, ensure_ascii=False, indent=2)
+        print(f"\n✓ レポートを保存しました: {args.json}")
+    if args.max_startup is not None and report['median'] > args.max_startup:
+        print(f"起動時間の中央値が上限（{args.max_startup}秒）を超えています", file=sys.stderr)
+        return 1
+    return 0
+
+
+def environment():
+    """レポートに添える実行環境の情報"""
+    versions = {}
+    for package in ('numpy', 'openpyxl', 'pulp', 'highspy', 'ortools'):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'packages': versions,
+        'engines': available_engines(),
+    }
+
+
+def print_report(rows):
+    """段階ごとの秒数を表にして表示"""
+    print(f"\n{'方式':<11}{'生徒':>7}{'講座':>5}{'時限':>5}{'偏り':>5}{'重複':>5}  "
+          + "".join(f"{p:>9}" for p in PHASES + ['total']) + f"{'目的関数':>10}  状態")
+    for row in rows:
+        times = "".join(f"{row[p]:>9.3f}" if row[p] is not None else f"{'-':>9}" for p in PHASES + ['total'])
+        objective = f"{row['objective']:>10.0f}" if row['objective'] is not None else f"{'-':>10}"
+        print(f"{row['mode']:<11}{row['students']:>7}{row['courses']:>5}{row['periods']:>5}"
+              f"{row['skew']:>7g}{row['duplicates']:>7g}  "
+              f"{times}{objective}  {row['status']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="学生講座配置プログラムのベンチマーク（段階ごとの所要時間）")
+    parser.add_argument('--students', type=int, nargs='+', default=[100, 300, 1000], metavar='N',
+                        help="生徒数（複数指定で全組み合わせを計測）")
+    parser.add_argument('--courses', type=int, nargs='+', default=[8], metavar='N', help="講座数")
+    parser.add_argument('--periods', type=int, nargs='+', default=[3], metavar='N', help="受講する講座数")
+    parser.add_argument('--choices', type=int, default=None, metavar='N',
+                        help="希望順位の数（既定: 講座数と同じ）")
+    parser.add_argument('--skew', type=float, nargs='+', default=[1.0], metavar='S',
+                        help="人気の偏り（Zipf の指数。0 で偏りなし）")
+    parser.add_argument('--duplicates', type=float, nargs='+', default=[0.0], metavar='割合',
+                        help="前の生徒と同じ希望リストを出す生徒の割合")
+    parser.add_argument('--slack', type=float, default=0.2, metavar='割合',
+                        help="最低・最高人数を平均人数の ±この割合にする（既定: 0.2）")
+    parser.add_argument('--modes', nargs='+', choices=['ilp', 'decomposed', 'heuristic'],
+                        default=['decomposed', 'heuristic'], help="計測する求解方式")
+    parser.add_argument('--engine', choices=available_engines(), default=None, help="求解エンジン")
+    parser.add_argument('--time-limit', type=float, default=None, metavar='秒', help="1回の求解の制限時間")
+    parser.add_argument('--no-warm-start', action='store_true', help="MIPスタートを使わない")
+    parser.add_argument('--repeat', type=int, default=1, metavar='N', help="各条件の計測回数")
+    parser.add_argument('--seed', type=int, default=0, metavar='N', help="アンケート生成の乱数シード")
+    parser.add_argument('--format', choices=['xlsx', 'csv'], default='xlsx', help="合成アンケートの形式")
+    parser.add_argument('--keep', metavar='DIR', help="合成アンケートと結果ファイルをこのフォルダに残す")
+    parser.add_argument('--json', metavar='PATH', help="レポート（実行環境＋計測結果）のJSONの保存先")
+    parser.add_argument('--csv', metavar='PATH', help="計測結果のCSVの保存先")
+    startup = parser.add_argument_group("起動時間")
+    startup.add_argument('--startup', action='store_true',
+                         help="求解の代わりに起動から最初の入力待ちまでの時間を --repeat 回計測する")
+    startup.add_argument('--startup-command', metavar='COMMAND',
+                         help="計測するコマンド（既定: このPythonで main.py を実行）。例: dist/student-scheduler.exe")
+    startup.add_argument('--max-startup', type=float, default=None, metavar='秒',
+                         help="起動時間の中央値がこれを超えたら終了コード 1 にする")
+    args = parser.parse_args(argv)
+    if args.choices is not None and args.choices > min(args.courses):
+        parser.error("--choices は講座数以下を指定してください")
+    if not 0 <= args.slack:
+        parser.error("--slack は0以上を指定してください")
+    if args.repeat < 1:
+        parser.error("--repeat は1以上を指定してください")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.startup:
+        return run_startup(args)
+
+    rows = []
+    # 記録するのは StudentScheduler が実際に使うエンジン（--engine 省略時は highs、無ければ pulp）
+    engine = StudentScheduler(0, 1, 1, 0, 0).engine_name(args.engine)
+    with contextlib.ExitStack() as stack:
+        directory = args.keep or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(directory, exist_ok=True)
+
+        for num_s, num_c, num_p, skew, dup in itertools.product(args.students, args.courses, args.periods,
+                                                                args.skew, args.duplicates):
+            if num_p > num_c:
+                continue
+            num_choices = args.choices or num_c
+            name = f"survey_{num_s}_{num_c}_{skew:g}_{dup:g}"
+            path = os.path.join(directory, f"{name}.{args.format}")
+            if not os.path.exists(path):
+                generate_survey(path, num_s, num_c, num_choices, skew, dup, args.seed)
+            lo, hi = capacity_bounds(num_s, num_c, args.slack)
+
+            for mode, repeat in itertools.product(args.modes, range(args.repeat)):
+                output = os.path.join(directory, f"{name}_{num_p}_{mode}_result.xlsx")
+                print(f"計測中: {mode} 生徒{num_s} 講座{num_c} 時限{num_p} 偏り{skew:g} 重複{dup:g}"
+                      f"（{repeat + 1}/{args.repeat}）", flush=True)
+                row = {'mode': mode, 'engine': None if mode == 'heuristic' else engine,
+                       'students': num_s, 'courses': num_c, 'periods': num_p, 'choices': num_choices,
+                       'skew': skew, 'duplicates': dup, 'min': lo, 'max': hi, 'repeat': repeat + 1}
+                try:
+                    row.update(run_case(path, output, mode, num_p, num_choices, lo, hi,
+                                        args.engine, args.time_limit, not args.no_warm_start))
+                except Exception as e:
+                    row.update(dict.fromkeys(PHASES), status=f"エラー: {e}", objective=None,
+                               num_cols=None, num_rows=None, num_nonzeros=None)
+                row['total'] = round(sum(row[p] or 0.0 for p in PHASES), 4)
+                rows.append(row)
+
+    print_report(rows)
+
+    if args.json is not None:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'environment': environment(), 'results': rows}, f, ensure_ascii=False, indent=2)
+        print(f"\n✓ レポートを保存しました: {args.json}")
+    if args.csv is not None:
+        with open(args.csv, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"✓ 計測結果を保存しました: {args.csv}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,50 +1,1351 @@
 # student_scheduler.py
-import openpyxl
-from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
-from openpyxl.utils import get_column_letter
+#
+# 起動（最初の入力待ち）を速くするため、openpyxl・PuLP・highspy・OR-Tools と
+# プロセスプール関連のモジュールはモジュールの読み込み時ではなく、それを使う関数の中で import する。
 from collections import defaultdict
+from collections.abc import Mapping
+from types import ModuleType
+from typing import Any, Dict, Optional
+import argparse
+import contextlib
+import cProfile
+import csv
+import functools
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
+import math
 import os
 import sys
 import subprocess
 import platform
 import time
+import tracemalloc
 
-# PuLP for Integer Linear Programming
-from pulp import LpProblem, LpMinimize, LpVariable, LpBinary, lpSum, LpStatus, value
+resource: Optional[ModuleType]
+try:
+    import resource  # Unix のみ（最大常駐メモリの取得）
+except ImportError:
+    resource = None
 
-def get_solver():
-    """利用可能なソルバーを取得"""
+import numpy as np
+
+# 並列化の方式（--parallel）→ HiGHS の parallel オプション
+# HiGHS の分枝限定は同じスレッド数・シードなら決定的なので、deterministic は既定の choose にする
+HIGHS_PARALLEL = {'deterministic': 'choose', 'opportunistic': 'on', 'off': 'off'}
+
+
+@functools.lru_cache(maxsize=None)
+def pulp_solvers():
+    """
+    PuLP から使えるソルバーの名前（プロセス内で1回だけ調べて結果を使い回す）
+
+    pulp.listSolvers(onlyAvailable=True) は全ソルバーの有無を実行ファイルの起動なども含めて
+    調べるため、求解のたびに呼ぶと遅い。
+    """
     import pulp
 
-    # 利用可能なソルバーを確認
-    available = pulp.listSolvers(onlyAvailable=True)
+    return tuple(pulp.listSolvers(onlyAvailable=True))
+
+
+@functools.lru_cache(maxsize=None)
+def bundled_cbc_path():
+    """PyInstaller でバンドルした CBC の実行ファイルのパス（バンドル時以外は None）"""
+    if not getattr(sys, 'frozen', False):
+        return None
+    base_path = sys._MEIPASS  # type: ignore[attr-defined]
+    if platform.system() == 'Windows':
+        return os.path.join(base_path, 'pulp', 'solverdir', 'cbc', 'win', '64', 'cbc.exe')
+    if platform.system() == 'Darwin':
+        return os.path.join(base_path, 'pulp', 'solverdir', 'cbc', 'osx', '64', 'cbc')
+    return os.path.join(base_path, 'pulp', 'solverdir', 'cbc', 'linux', 'i64', 'cbc')
+
+
+def get_solver(time_limit=None, mip_gap=None, threads=None, seed=None, parallel='deterministic'):
+    """
+    利用可能なソルバーを取得
+
+    time_limit: 制限時間（秒）。None なら無制限
+    mip_gap: 相対ギャップがこの値以下になったら終了する。None ならソルバーの既定値
+    threads: ソルバーのスレッド数。None ならソルバーの既定値
+    seed: 乱数シード。None ならソルバーの既定値
+    parallel: 'deterministic'（同じスレッド数・シードなら同じ解）/
+              'opportunistic'（速さ優先。実行ごとに解が変わりうる）/ 'off'（1スレッド）
+    """
+    import pulp
+
+    if parallel == 'off':
+        threads = 1
+
+    # 利用可能なソルバーを確認（プロセス内で1回だけ調べる）
+    available = pulp_solvers()
 
     # HiGHSを優先（クロスプラットフォームで安定）
     if 'HiGHS' in available:
-        return pulp.HiGHS(msg=False)
+        options = {'parallel': HIGHS_PARALLEL[parallel]}
+        if seed is not None:
+            options['random_seed'] = seed
+        return pulp.HiGHS(msg=False, timeLimit=time_limit, gapRel=mip_gap, threads=threads, **options)
+
+    # CBC は「100 + スレッド数」で再現性のある並列探索になる
+    cbc_threads = threads
+    if threads is not None and threads > 1 and parallel == 'deterministic':
+        cbc_threads = 100 + threads
+    cbc_options = [] if seed is None else [f"randomSeed {seed}", f"randomCbcSeed {seed}"]
 
     # PyInstallerバンドル時はCOIN_CMDでパス指定
-    if getattr(sys, 'frozen', False):
+    cbc_path = bundled_cbc_path()
+    if cbc_path is not None:
         try:
-            base_path = sys._MEIPASS  # type: ignore[attr-defined]
-            if platform.system() == 'Windows':
-                cbc_path = os.path.join(base_path, 'pulp', 'solverdir', 'cbc', 'win', '64', 'cbc.exe')
-            elif platform.system() == 'Darwin':
-                cbc_path = os.path.join(base_path, 'pulp', 'solverdir', 'cbc', 'osx', '64', 'cbc')
-            else:
-                cbc_path = os.path.join(base_path, 'pulp', 'solverdir', 'cbc', 'linux', 'i64', 'cbc')
-            return pulp.COIN_CMD(path=cbc_path, msg=0)
+            return pulp.COIN_CMD(path=cbc_path, msg=0, timeLimit=time_limit, gapRel=mip_gap,
+                                 threads=cbc_threads, options=cbc_options)
         except Exception:
             pass
 
     # PULP_CBC_CMDがあればそれを使用
     if 'PULP_CBC_CMD' in available:
-        return pulp.PULP_CBC_CMD(msg=0)
+        return pulp.PULP_CBC_CMD(msg=0, timeLimit=time_limit, gapRel=mip_gap,
+                                 threads=cbc_threads, options=cbc_options)
 
     # デフォルト（PuLPが自動選択）
     return None
 
 
+class ModelMatrix:
+    """
+    疎行列（CSR形式）で表現したILPモデル
+
+    制約は「1行あたりの非ゼロ数が同じ行ブロック」単位で追加し、
+    to_csr() でまとめて行圧縮形式の配列に変換する。
+    """
+
+    def __init__(self, num_cols):
+        self.num_cols = num_cols
+        self.col_cost = np.zeros(num_cols)
+        self.col_lower = np.zeros(num_cols)
+        self.col_upper = np.ones(num_cols)
+        self.integrality = np.ones(num_cols, dtype=bool)
+        self._blocks = []
+        self.num_rows = 0
+
+    def add_rows(self, indices, values, lower, upper):
+        """
+        行ブロックを追加
+
+        indices: (行数, 非ゼロ数) の列インデックス配列
+        values:  indices と同じ形状、またはブロードキャスト可能な係数
+        lower, upper: 各行の下限・上限（スカラーまたは行数の配列）
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if indices.ndim == 1:
+            indices = indices.reshape(1, -1)
+        n_rows = indices.shape[0]
+        values = np.broadcast_to(np.asarray(values, dtype=np.float64), indices.shape)
+        lower = np.broadcast_to(np.asarray(lower, dtype=np.float64), (n_rows,))
+        upper = np.broadcast_to(np.asarray(upper, dtype=np.float64), (n_rows,))
+        self._blocks.append((indices, values, lower, upper))
+        self.num_rows += n_rows
+
+    def to_csr(self):
+        """(start, index, value, row_lower, row_upper) を返す"""
+        if not self._blocks:
+            empty = np.zeros(0)
+            return np.zeros(1, dtype=np.int64), empty.astype(np.int64), empty, empty, empty
+        row_nnz = np.concatenate([np.full(b[0].shape[0], b[0].shape[1]) for b in self._blocks])
+        start = np.zeros(len(row_nnz) + 1, dtype=np.int64)
+        np.cumsum(row_nnz, out=start[1:])
+        index = np.concatenate([b[0].ravel() for b in self._blocks])
+        value = np.concatenate([b[1].ravel() for b in self._blocks])
+        row_lower = np.concatenate([b[2] for b in self._blocks])
+        row_upper = np.concatenate([b[3] for b in self._blocks])
+        return start, index, value, row_lower, row_upper
+
+    @property
+    def num_nonzeros(self):
+        return sum(b[0].size for b in self._blocks)
+
+    def without_fixed_columns(self):
+        """
+        下限と上限が等しい列を定数として行の範囲に移し、残りの列だけのモデルを作る
+
+        非ゼロが無くなった行は除く（その行が範囲を満たさなければモデルは実行不可能）。
+        戻り値: (縮小したモデル, 残した列の番号, 目的関数の定数項)。
+                固定された列が無ければ (self, None, 0.0)、実行不可能なら (None, None, None)
+        """
+        fixed = self.col_lower == self.col_upper
+        if not fixed.any():
+            return self, None, 0.0
+
+        start, index, value, row_lower, row_upper = self.to_csr()
+        keep = np.flatnonzero(~fixed)
+        new_col = np.full(self.num_cols, -1, dtype=np.int64)
+        new_col[keep] = np.arange(len(keep))
+        row_of = np.repeat(np.arange(self.num_rows), np.diff(start))
+        on_fixed = fixed[index]
+        shift = np.bincount(row_of[on_fixed], value[on_fixed] * self.col_lower[index[on_fixed]],
+                            minlength=self.num_rows)
+        row_lower, row_upper = row_lower - shift, row_upper - shift
+        nnz = np.bincount(row_of[~on_fixed], minlength=self.num_rows)
+        empty = nnz == 0
+        if np.any(empty & ((row_lower > 1e-9) | (row_upper < -1e-9))):
+            return None, None, None
+
+        reduced = ModelMatrix(len(keep))
+        reduced.col_cost = self.col_cost[keep]
+        reduced.col_lower = self.col_lower[keep]
+        reduced.col_upper = self.col_upper[keep]
+        reduced.integrality = self.integrality[keep]
+        entries = np.flatnonzero(~on_fixed)
+        for k in np.unique(nnz[~empty]):
+            rows = np.flatnonzero(nnz == k)
+            block = entries[nnz[row_of[entries]] == k].reshape(len(rows), k)
+            reduced.add_rows(new_col[index[block]], value[block], row_lower[rows], row_upper[rows])
+        return reduced, keep, float(self.col_cost[fixed] @ self.col_lower[fixed])
+
+
+def print_progress(objective, bound, gap, elapsed):
+    """暫定解の更新を表示（solve_model_matrix の progress の既定値）"""
+    bound_text = f"{bound:.2f}" if np.isfinite(bound) else "-"
+    gap_text = f"{gap:.1%}" if np.isfinite(gap) else "-"
+    print(f"  暫定解: 目的関数値 {objective:.2f} / 下界 {bound_text} / "
+          f"ギャップ {gap_text}（{elapsed:.1f}秒）")
+
+
+def solve_model_matrix(model, initial=None, time_limit=None, mip_gap=None, progress=print_progress,
+                       threads=None, seed=None, parallel='deterministic'):
+    """
+    ModelMatrix を highspy のネイティブAPIで解く
+
+    initial: 列の値の初期解（MIPスタート）。実行可能解なら分枝限定の上界に使われる
+    time_limit: 制限時間（秒）。None なら無制限
+    mip_gap: 相対ギャップがこの値以下になったら最適とみなして終了する
+    progress: 暫定解が更新されるたびに (目的関数値, 下界, ギャップ, 経過秒) で呼ばれる。
+              None なら何もしない
+    threads, seed, parallel: スレッド数・乱数シード・並列化の方式（get_solver と同じ）。
+              同じスレッド数・シードなら同じ解が得られる（制限時間で打ち切った場合を除く）
+
+    戻り値: (ステータス, 列の値の配列, 目的関数値)
+        制限時間に達しても実行可能解があれば、その暫定解を返す
+        （ステータスは 'Optimal' 以外）。解が無ければ列の値と目的関数値は None
+    """
+    import highspy
+
+    start, index, val, row_lower, row_upper = model.to_csr()
+    inf = highspy.kHighsInf
+
+    lp = highspy.HighsLp()
+    lp.num_col_ = model.num_cols
+    lp.num_row_ = model.num_rows
+    lp.col_cost_ = model.col_cost
+    lp.col_lower_ = model.col_lower
+    lp.col_upper_ = np.where(np.isinf(model.col_upper), inf, model.col_upper)
+    lp.row_lower_ = np.where(np.isinf(row_lower), -inf, row_lower)
+    lp.row_upper_ = np.where(np.isinf(row_upper), inf, row_upper)
+    lp.a_matrix_.format_ = highspy.MatrixFormat.kRowwise
+    lp.a_matrix_.start_ = start
+    lp.a_matrix_.index_ = index
+    lp.a_matrix_.value_ = val
+    lp.integrality_ = [highspy.HighsVarType.kInteger if flag else highspy.HighsVarType.kContinuous
+                       for flag in model.integrality]
+
+    h = highspy.Highs()
+    h.silent()
+    if time_limit is not None:
+        h.setOptionValue('time_limit', float(time_limit))
+    if mip_gap is not None:
+        h.setOptionValue('mip_rel_gap', float(mip_gap))
+    if parallel == 'off':
+        threads = 1
+    if threads is not None:
+        h.setOptionValue('threads', int(threads))
+    if seed is not None:
+        h.setOptionValue('random_seed', int(seed))
+    h.setOptionValue('parallel', HIGHS_PARALLEL[parallel])
+    if progress is not None:
+        def on_improving_solution(event):
+            out = event.data_out
+            progress(out.objective_function_value, out.mip_dual_bound, out.mip_gap, out.running_time)
+        h.cbMipImprovingSolution.subscribe(on_improving_solution)
+    h.passModel(lp)
+    if initial is not None:
+        solution = highspy.HighsSolution()
+        solution.col_value = np.asarray(initial, dtype=np.float64)
+        h.setSolution(solution)
+    h.run()
+
+    status = h.getModelStatus()
+    info = h.getInfo()
+    if status == highspy.HighsModelStatus.kOptimal:
+        label = 'Optimal'
+    else:
+        label = h.modelStatusToString(status)
+        if info.primal_solution_status != highspy.SolutionStatus.kSolutionStatusFeasible:
+            return label, None, None
+    col_value = np.asarray(h.getSolution().col_value)
+    return label, col_value, info.objective_function_value
+
+
+def iter_survey_rows(path, sheet_name='アンケート入力'):
+    """
+    アンケートの各行を (行番号, セルの値のタプル) で順に返す（見出し行は除く）
+
+    .csv はカンマ区切り、.tsv / .txt はタブ区切りのテキストとして読む
+    （UTF-8、読めなければ Shift_JIS）。それ以外は Excel を読み取り専用モードで
+    1行ずつ読むため、セルオブジェクトを全件作らず大きなブックでもメモリを抑えられる。
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.csv', '.tsv', '.txt'):
+        delimiter = ',' if ext == '.csv' else '\t'
+        for encoding in ('utf-8-sig', 'cp932'):
+            try:
+                with open(path, newline='', encoding=encoding) as f:
+                    # 文字コードの判定のため、先に全体を読めるか確かめる
+                    for _ in f:
+                        pass
+            except UnicodeDecodeError:
+                continue
+            with open(path, newline='', encoding=encoding) as f:
+                for row_number, row in enumerate(csv.reader(f, delimiter=delimiter), 1):
+                    if row_number > 1:
+                        yield row_number, tuple(row)
+            return
+        raise ValueError(f"文字コードを判別できません（UTF-8 または Shift_JIS で保存してください）: {path}")
+
+    import openpyxl
+
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        if sheet_name not in wb.sheetnames:
+            raise ValueError(f"シート「{sheet_name}」が見つかりません: {path}")
+        for row_number, row in enumerate(wb[sheet_name].iter_rows(min_row=2, values_only=True), 2):
+            yield row_number, row
+    finally:
+        wb.close()
+
+
+def load_previous_schedule(path):
+    """
+    前回の結果ファイル（生徒別配置結果シート）から各生徒の配置を読む
+
+    戻り値: {生徒番号: [1限の講座名, 2限の講座名, ...]}（空欄の時限は ''）
+    """
+    previous = {}
+    rows = iter_survey_rows(path, sheet_name='生徒別配置結果')
+    try:
+        for _, row in rows:
+            cells = [str(v).strip() if v is not None else '' for v in row]
+            if not any(cells):
+                break
+            if cells[0]:
+                previous[cells[0]] = cells[2:]
+    finally:
+        rows.close()
+
+    if not previous:
+        raise ValueError(f"前回の配置結果が見つかりません: {path}")
+    return previous
+
+
+def solve_model_matrix_pulp(model, initial=None, time_limit=None, mip_gap=None, progress=None,
+                            threads=None, seed=None, parallel='deterministic'):
+    """
+    ModelMatrix を PuLP 経由で解く（highspy が無い環境用）
+
+    引数と戻り値は solve_model_matrix と同じ（initial と progress は使わない）。
+    """
+    from pulp import LpProblem, LpMinimize, LpVariable, LpInteger, LpContinuous, lpSum, LpStatus, \
+        LpSolutionIntegerFeasible, value
+
+    prob = LpProblem("StudentScheduler_Matrix", LpMinimize)
+    cols = [LpVariable(f"v_{j}", lowBound=float(model.col_lower[j]),
+                       upBound=None if np.isinf(model.col_upper[j]) else float(model.col_upper[j]),
+                       cat=LpInteger if model.integrality[j] else LpContinuous)
+            for j in range(model.num_cols)]
+    prob += lpSum(float(cost) * cols[j] for j, cost in enumerate(model.col_cost) if cost)
+
+    start, index, val, row_lower, row_upper = model.to_csr()
+    for i in range(model.num_rows):
+        row = slice(start[i], start[i + 1])
+        expr = lpSum(float(v) * cols[j] for j, v in zip(index[row], val[row]))
+        lower, upper = float(row_lower[i]), float(row_upper[i])
+        if lower == upper:
+            prob += expr == lower
+            continue
+        if not np.isinf(lower):
+            prob += expr >= lower
+        if not np.isinf(upper):
+            prob += expr <= upper
+
+    solver = get_solver(time_limit, mip_gap, threads, seed, parallel)
+    if solver:
+        prob.solve(solver)
+    else:
+        prob.solve()
+
+    if prob.status != 1:
+        return LpStatus[prob.status], None, None
+    label = 'Optimal' if prob.sol_status != LpSolutionIntegerFeasible else 'Time limit reached'
+    col_value = np.array([v.varValue or 0.0 for v in cols])
+    return label, col_value, value(prob.objective)
+
+
+def solve_model_matrix_cpsat(model, initial=None, time_limit=None, mip_gap=None, progress=print_progress,
+                             threads=None, seed=None, parallel='deterministic'):
+    """
+    ModelMatrix を OR-Tools の CP-SAT で解く
+
+    引数と戻り値は solve_model_matrix と同じ。CP-SAT は整数変数しか扱えないため、
+    連続変数（公平性の max_score/min_score、人数のずれのスラック）も整数変数にする
+    （行の係数と下限・上限がすべて整数のモデルなので、これらは最適解で整数値を取る）。
+    上限の無い列には、上限のある列だけで各行が取りうる値の幅を上限として与える。
+
+    parallel='deterministic' では複数ワーカーの探索を決められた順に交互に進め
+    （interleave_search）、制限時間も CP-SAT の決定的時間で数えるため、
+    同じシードなら制限時間に達した場合も含めて同じ解が得られる。
+    """
+    from ortools.sat.python import cp_model
+
+    start, index, val, row_lower, row_upper = model.to_csr()
+    if not np.array_equal(val, np.round(val)):
+        raise ValueError("CP-SAT は係数が整数のモデルしか扱えません")
+
+    bounded = ~np.isinf(model.col_upper)
+    magnitude = np.where(bounded, np.maximum(np.abs(model.col_lower), np.abs(model.col_upper)), 0)
+    row_of = np.repeat(np.arange(model.num_rows), np.diff(start))
+    activity = np.bincount(row_of, np.abs(val) * magnitude[index], minlength=model.num_rows)
+    finite = np.concatenate([row_lower[~np.isinf(row_lower)], row_upper[~np.isinf(row_upper)], [0]])
+    big = int(np.ceil(activity.max(initial=0) + np.abs(finite).max())) + 1
+
+    cp = cp_model.CpModel()
+    cols = [cp.new_int_var(int(np.ceil(lo)), int(np.floor(up)) if np.isfinite(up) else big, f"v_{j}")
+            for j, (lo, up) in enumerate(zip(model.col_lower, model.col_upper))]
+    for i in range(model.num_rows):
+        row = slice(start[i], start[i + 1])
+        expr = cp_model.LinearExpr.weighted_sum([cols[j] for j in index[row]], val[row].astype(int).tolist())
+        lower, upper = row_lower[i], row_upper[i]
+        if not np.isinf(lower):
+            cp.add(expr >= int(np.ceil(lower)))
+        if not np.isinf(upper):
+            cp.add(expr <= int(np.floor(upper)))
+    nonzero = np.flatnonzero(model.col_cost)
+    cp.minimize(cp_model.LinearExpr.weighted_sum([cols[j] for j in nonzero], model.col_cost[nonzero].tolist()))
+    if initial is not None:
+        for var, v in zip(cols, np.rint(initial).astype(int).tolist()):
+            cp.add_hint(var, v)
+
+    solver = cp_model.CpSolver()
+    params = solver.parameters
+    if time_limit is not None:
+        if parallel == 'deterministic':
+            params.max_deterministic_time = float(time_limit)
+        else:
+            params.max_time_in_seconds = float(time_limit)
+    if mip_gap is not None:
+        params.relative_gap_limit = float(mip_gap)
+    if parallel == 'off':
+        threads = 1
+    if threads is not None:
+        params.num_workers = int(threads)
+    if seed is not None:
+        params.random_seed = int(seed)
+    if parallel == 'deterministic' and params.num_workers != 1:
+        params.interleave_search = True
+
+    callback = None
+    if progress is not None:
+        class ProgressCallback(cp_model.CpSolverSolutionCallback):
+            def on_solution_callback(self):
+                objective, bound = self.objective_value, self.best_objective_bound
+                gap = abs(objective - bound) / abs(objective) if objective else np.inf
+                progress(objective, bound, gap, self.wall_time)
+        callback = ProgressCallback()
+    status = solver.solve(cp, callback)
+
+    if status == cp_model.OPTIMAL:
+        label = 'Optimal'
+    elif status == cp_model.FEASIBLE:
+        label = 'Feasible'
+    else:
+        return solver.status_name(status), None, None
+    col_value = np.array([solver.value(var) for var in cols], dtype=np.float64)
+    return label, col_value, solver.objective_value
+
+
+# 求解エンジン: 名前 → ModelMatrix を解く関数（引数と戻り値は solve_model_matrix と同じ）
+SOLVER_ENGINES = {
+    'highs': solve_model_matrix,
+    'cpsat': solve_model_matrix_cpsat,
+    'pulp': solve_model_matrix_pulp,
+}
+
+# 各エンジンに必要なパッケージ（import する名前）
+ENGINE_PACKAGES = {'highs': 'highspy', 'cpsat': 'ortools', 'pulp': 'pulp'}
+
+# 各エンジンを使えるようにする pip install の引数（cpsat は pyproject.toml の extra）
+ENGINE_INSTALL = {'highs': 'highspy', 'cpsat': '"student-scheduler[cpsat]"', 'pulp': 'pulp'}
+
+
+def engine_install_hint(engine):
+    """求解エンジン engine が使えないときのエラーメッセージ"""
+    return (f"求解エンジン {engine} を使うには {ENGINE_PACKAGES[engine]} が必要です"
+            f"（pip install {ENGINE_INSTALL[engine]}）")
+
+
+@functools.lru_cache(maxsize=None)
+def installed(package):
+    """package がインストールされているか（import せずに調べる）"""
+    return importlib.util.find_spec(package) is not None
+
+
+def available_engines():
+    """この環境で使える求解エンジンの名前（必要なパッケージがインストールされているもの）"""
+    return [name for name in SOLVER_ENGINES if installed(ENGINE_PACKAGES[name])]
+
+
+def assign_periods(course_sets, num_periods, preferred=None):
+    """
+    各生徒の受講講座を時限に割り当てる（二部グラフの均等辺彩色）
+
+    生徒と講座を頂点、受講を辺とする二部グラフを num_periods 色で辺彩色する。
+    講座頂点は num_periods 本ずつの辺を持つ複製に分割してから彩色するため、
+    受講者数 d の講座は各時限に floor(d/P) 人または ceil(d/P) 人ずつ配置される。
+
+    course_sets: 生徒ごとの講座番号のリスト（各 num_periods 個、重複なし）
+    preferred: 生徒ごとの {講座番号: 時限（0始まり）} または None。指定すると
+               彩色の順と初期の色でその時限を優先する（交互路による修正で動くことがあるため、
+               動く件数を最小にするには StudentScheduler._keep_periods で解き直す）
+    戻り値: (生徒数, 時限数) の講座番号配列
+    """
+    num_s = len(course_sets)
+    free = -1
+
+    # 講座頂点を num_periods 本ずつの辺を持つ複製に分割
+    # copy_of_edge[s] = [(講座複製, 希望の色 or None)]
+    copy_of_edge = [[] for _ in range(num_s)]
+    copy_course = []
+    if preferred is None:
+        open_copy = {}
+        for s, courses in enumerate(course_sets):
+            for c in courses:
+                r, used = open_copy.get(c, (None, num_periods))
+                if used == num_periods:
+                    r, used = len(copy_course), 0
+                    copy_course.append(c)
+                open_copy[c] = (r, used + 1)
+                copy_of_edge[s].append((r, None))
+        order = range(num_s)
+    else:
+        members = defaultdict(list)
+        for s, courses in enumerate(course_sets):
+            for c in courses:
+                members[c].append(s)
+        for c, students in members.items():
+            # 希望時限ごとの待ち行列（末尾は希望なし）から、同じ複製に
+            # 希望時限の異なる辺が入るように1本ずつ配る
+            queues = [[] for _ in range(num_periods + 1)]
+            for s in students:
+                q = preferred[s].get(c) if preferred[s] else None
+                queues[num_periods if q is None else q].append(s)
+            remaining = len(students)
+            while remaining:
+                r = len(copy_course)
+                copy_course.append(c)
+                size = min(num_periods, remaining)
+                picked = []
+                for q in sorted(range(num_periods), key=lambda q: -len(queues[q])):
+                    if len(picked) < size and queues[q]:
+                        picked.append((queues[q].pop(), q))
+                while len(picked) < size:
+                    q = num_periods if queues[num_periods] else max(range(num_periods),
+                                                                     key=lambda q: len(queues[q]))
+                    picked.append((queues[q].pop(), q if q < num_periods else None))
+                for s, q in picked:
+                    copy_of_edge[s].append((r, q))
+                remaining -= size
+        # 希望のある生徒から彩色する
+        order = sorted(range(num_s), key=lambda s: not preferred[s])
+
+    # left[s][色] = 講座複製, right[r][色] = 生徒
+    left = [[free] * num_periods for _ in range(num_s)]
+    right = [[free] * num_periods for _ in range(len(copy_course))]
+
+    for s in order:
+        for r, q in copy_of_edge[s]:
+            if q is not None and left[s][q] == free and right[r][q] == free:
+                left[s][q] = r
+                right[r][q] = s
+                continue
+            a = left[s].index(free)
+            b = right[r].index(free)
+            if right[r][a] != free:
+                if left[s][b] == free:
+                    a = b
+                else:
+                    # r から a/b 交互路をたどって色を入れ替え、r で色 a を空ける
+                    path = []
+                    v, on_right, col = r, True, a
+                    while True:
+                        u = right[v][col] if on_right else left[v][col]
+                        if u == free:
+                            break
+                        path.append((u, v, col) if on_right else (v, u, col))
+                        v, on_right = u, not on_right
+                        col = b if col == a else a
+                    for ls, rc, col in path:
+                        left[ls][col] = free
+                        right[rc][col] = free
+                    for ls, rc, col in path:
+                        swapped = b if col == a else a
+                        left[ls][swapped] = rc
+                        right[rc][swapped] = ls
+            left[s][a] = r
+            right[r][a] = s
+
+    copy_course = np.asarray(copy_course, dtype=np.int64)
+    return copy_course[np.asarray(left, dtype=np.int64).reshape(num_s, num_periods)]
+
+
+def heuristic_course_sets(rank, num_periods, lower, upper, time_limit=1.0, seed=0,
+                          fairness_weight=10, initial=None, max_steps=None):
+    """
+    貪欲法＋局所探索で各生徒の受講講座を選ぶ
+
+    1. スネーク順のドラフト: 各巡で生徒が1講座ずつ、空きのある講座から
+       最も希望順位の高いものを選ぶ（巡ごとに順番を逆にして偏りを抑える）
+    2. 修復: 延べ人数が lower〜upper を外れた講座について、
+       希望順位の悪化が最小の生徒を移す
+    3. 局所探索: 1人の講座の入れ替え（a→b）と、2人の間での講座の交換を
+       「希望順位の合計 + fairness_weight * (最大スコア - 最小スコア)」が
+       改善する限り繰り返す（time_limit 秒まで。None なら時間では打ち切らない）
+
+    rank: (生徒, 講座) の希望順位行列
+    lower, upper: 講座ごとの延べ人数（全時限の合計）の下限・上限
+    initial: 初期の受講講座 (生徒, num_periods)。指定するとドラフトを省いて修復から始める
+    max_steps: 局所探索で調べる生徒の延べ数の上限（None なら無制限）。time_limit=None と
+               組み合わせると、実行環境の速さによらず同じ seed から同じ解が得られる
+    戻り値: (生徒, num_periods) の講座番号配列。人数条件を満たせない場合は None
+    """
+    num_s, num_c = rank.shape
+    if num_periods > num_c or not lower * num_c <= num_s * num_periods <= upper * num_c:
+        return None
+
+    rank = np.asarray(rank, dtype=np.int64)
+    big = np.iinfo(np.int64).max // 4
+    rng = np.random.default_rng(seed)
+    deadline = np.inf if time_limit is None else time.time() + time_limit
+    steps = np.inf if max_steps is None else max_steps
+    taken = np.zeros((num_s, num_c), dtype=bool)
+    count = np.zeros(num_c, dtype=np.int64)
+
+    # 1. スネーク順のドラフト
+    if initial is not None:
+        taken[np.arange(num_s)[:, None], np.asarray(initial, dtype=np.int64)] = True
+        count = taken.sum(axis=0)
+    order = rng.permutation(num_s)
+    for k in range(num_periods if initial is None else 0):
+        for s in (order if k % 2 == 0 else order[::-1]):
+            cand = np.where(taken[s] | (count >= upper), big, rank[s])
+            c = int(np.argmin(cand))
+            if cand[c] == big:
+                # 空きのある講座が無ければ定員超過を許し、次の修復で直す
+                c = int(np.argmin(np.where(taken[s], big, rank[s])))
+            taken[s, c] = True
+            count[c] += 1
+
+    # 2. 修復
+    while True:
+        under = np.flatnonzero(count < lower)
+        over = np.flatnonzero(count > upper)
+        if len(under):
+            b = under[0]
+            cost = np.where(taken & (count > lower) & ~taken[:, [b]], rank[:, [b]] - rank, big)
+            s, a = divmod(int(np.argmin(cost)), num_c)
+        elif len(over):
+            a = over[0]
+            cost = np.where(~taken & (count < upper) & taken[:, [a]], rank - rank[:, [a]], big)
+            s, b = divmod(int(np.argmin(cost)), num_c)
+        else:
+            break
+        if cost[s].min() == big:
+            return None
+        taken[s, a] = False
+        taken[s, b] = True
+        count[a] -= 1
+        count[b] += 1
+
+    # 3. 局所探索（スコアの度数分布で最大・最小を管理）
+    score = (rank * taken).sum(axis=1).tolist()
+    hist = [0] * (int(rank.max()) * num_periods + 1)
+    for value_ in score:
+        hist[value_] += 1
+
+    def spread():
+        low = next(i for i, n in enumerate(hist) if n)
+        high = len(hist) - 1 - next(i for i, n in enumerate(reversed(hist)) if n)
+        return high - low
+
+    def try_change(changes, total_delta):
+        """changes: [(生徒, 新スコア)]。目的関数が改善すれば確定して True"""
+        before = spread()
+        for s_, new in changes:
+            hist[score[s_]] -= 1
+            hist[new] += 1
+        if total_delta + fairness_weight * (spread() - before) < 0:
+            for s_, new in changes:
+                score[s_] = new
+            return True
+        for s_, new in reversed(changes):
+            hist[new] -= 1
+            hist[score[s_]] += 1
+        return False
+
+    improved = True
+    while improved and time.time() < deadline and steps > 0:
+        improved = False
+        min_score = next(i for i, n in enumerate(hist) if n)
+        max_score = len(hist) - 1 - next(i for i, n in enumerate(reversed(hist)) if n)
+        for s in rng.permutation(num_s):
+            if time.time() >= deadline or steps <= 0:
+                break
+            steps -= 1
+            have = np.flatnonzero(taken[s])
+            free = np.flatnonzero(~taken[s])
+            delta = rank[s, free][None, :] - rank[s, have][:, None]
+            # 自分の順位が上がる入れ替え（最小スコアの生徒は公平性のため下がる入れ替えも）
+            cand = np.argsort(delta, axis=None)
+            if score[s] != min_score:
+                cand = cand[delta.ravel()[cand] < 0]
+            for flat in cand:
+                i, j = divmod(int(flat), len(free))
+                a, b = have[i], free[j]
+                d = int(delta[i, j])
+                if count[a] > lower and count[b] < upper:
+                    if try_change([(s, score[s] + d)], d):
+                        taken[s, a] = False
+                        taken[s, b] = True
+                        count[a] -= 1
+                        count[b] += 1
+                        improved = True
+                        break
+                elif d < 0:
+                    # 講座 b を受講し a を受講していない生徒と交換
+                    gain = np.where(taken[:, b] & ~taken[:, a], rank[:, a] - rank[:, b], big)
+                    s2 = int(np.argmin(gain))
+                    if gain[s2] == big or (d + gain[s2] >= 0 and score[s] != max_score):
+                        continue
+                    d2 = int(gain[s2])
+                    if try_change([(s, score[s] + d), (s2, score[s2] + d2)], d + d2):
+                        taken[s, a] = taken[s2, b] = False
+                        taken[s, b] = taken[s2, a] = True
+                        improved = True
+                        break
+
+    return np.array([np.flatnonzero(row) for row in taken], dtype=np.int64).reshape(num_s, num_periods)
+
+
+# 再現性を優先する場合に局所探索で全生徒を調べる回数の上限
+HEURISTIC_PASSES = 20
+
+# 再現性を優先する場合に time_limit 1秒あたりに局所探索で調べる「生徒の延べ数 × 生徒数」
+# （1人を調べる手間は交換相手を探す分だけ生徒数にほぼ比例する。3000人・10講座で1秒に収まる値）
+HEURISTIC_STEP_RATE = 5_000_000
+
+# 公平性の方式（--fairness）
+#   weighted 希望順位の合計 + 10 × (最大スコア - 最小スコア) を1回で最小化する（従来どおり）
+#   minimax  最悪の生徒のスコアを最小化してから、その値を保ったまま希望順位の合計を最小化する
+#   cap      割り当てる講座の希望順位に上限を設けて（rank_cap、省略時は実現できる最小の上限）weighted で解く
+#   profile  希望外の件数 → 第K希望以下の件数 → … → 第2希望以下の件数の順に辞書式に最小化する
+FAIRNESS_STRATEGIES = ('weighted', 'minimax', 'cap', 'profile')
+
+# 事前チェックで講座のすべての部分集合を調べる講座数の上限（これより多い場合は
+# 1講座・1講座を除いた全講座・全講座の部分集合だけを調べる）
+PRESOLVE_MAX_SUBSET_COURSES = 12
+
+
+def presolve_selection(allowed, num_periods, min_per_course, max_per_course, chunk=256):
+    """
+    受講講座の選択が人数条件を満たせるかを数え上げだけで調べ、範囲を狭める
+
+    各生徒は allowed[s] が True の講座から num_periods 個を選び、各講座の延べ人数は
+    num_periods * min_per_course 〜 num_periods * max_per_course に収める。
+    これは生徒と講座の2部グラフの次数条件付き部分グラフの問題なので、講座の部分集合 Y
+    すべてについて
+        下限: Y の延べ人数の下限の合計 <= Σs min(num_periods, |allowed[s] ∩ Y|)
+        上限: Σs max(0, num_periods - |allowed[s] \\ Y|) <= Y の延べ人数の上限の合計
+    が成り立つことと、配置が存在することは同値になる（時限への割り当ては均等辺彩色で
+    必ずできるので、元のモデルの実行可能性とも同値）。同じ allowed の行はまとめて数える。
+    全講座を選べる場合は |Y| だけで決まるので講座数によらず厳密に調べられる。
+
+    戻り値: dict
+        'violations' 満たされない条件 (種類 'lower'/'upper', 講座番号のタプル, 必要な延べ人数, 上限)
+                     のリスト（講座の少ない順）。空なら実行可能（exact が False なら必要条件のみ）
+        'exact'      すべての部分集合を調べたか
+        'lower', 'upper'               狭めた講座ごとの延べ人数の範囲
+        'period_lower', 'period_upper' 狭めた各時限の講座ごとの人数の範囲
+        'fixed'      (生徒, 講座) の int8 配列。1 = 必ず受講、0 = 受講しない、-1 = 未定
+    """
+    allowed = np.asarray(allowed, dtype=bool)
+    num_s, num_c = allowed.shape
+    num_p = num_periods
+    lower = np.full(num_c, num_p * min_per_course, dtype=np.int64)
+    upper = np.full(num_c, num_p * max_per_course, dtype=np.int64)
+
+    exact = True
+    if allowed.all():
+        masks, sizes = np.ones((1, num_c), dtype=bool), np.array([num_s])
+        subsets = np.arange(num_c)[None, :] < np.arange(num_c + 1)[:, None]
+    else:
+        if num_c < 63:
+            # 行をビット列の整数にしてから重複を除く（行ごとの np.unique より速い）
+            bits, sizes = np.unique(allowed @ (np.int64(1) << np.arange(num_c, dtype=np.int64)), return_counts=True)
+            masks = (bits[:, None] >> np.arange(num_c)) & 1 == 1
+        else:
+            masks, sizes = np.unique(allowed, axis=0, return_counts=True)
+        if num_c <= PRESOLVE_MAX_SUBSET_COURSES:
+            subsets = (np.arange(2 ** num_c)[:, None] >> np.arange(num_c)) & 1 == 1
+        else:
+            exact = False
+            eye = np.eye(num_c, dtype=bool)
+            subsets = np.vstack([np.zeros((1, num_c), dtype=bool), eye, ~eye, np.ones((1, num_c), dtype=bool)])
+
+    masks = masks.astype(np.int64)
+    available = masks.sum(axis=1)
+    violations = []
+    for begin in range(0, len(subsets), chunk):
+        block = subsets[begin:begin + chunk].astype(np.int64)
+        inside = masks @ block.T
+        supply = sizes @ np.minimum(num_p, inside)
+        forced = sizes @ np.maximum(0, num_p - (available[:, None] - inside))
+        need, limit = block @ lower, block @ upper
+        for y in np.flatnonzero(need > supply):
+            violations.append(('lower', tuple(np.flatnonzero(block[y]).tolist()), int(need[y]), int(supply[y])))
+        for y in np.flatnonzero(forced > limit):
+            violations.append(('upper', tuple(np.flatnonzero(block[y]).tolist()), int(forced[y]), int(limit[y])))
+    violations.sort(key=lambda v: (len(v[1]), v[1]))
+
+    # 範囲の絞り込み: 受講できる生徒数・必ず受講する生徒数と、他の講座の範囲から
+    full = allowed.sum(axis=1) == num_p
+    able = allowed.sum(axis=0)
+    lower = np.maximum(lower, allowed[full].sum(axis=0))
+    upper = np.minimum(upper, able)
+    period_lower = np.full(num_c, min_per_course, dtype=np.int64)
+    period_upper = np.minimum(max_per_course, able)
+    for _ in range(2):
+        upper = np.minimum(upper, num_s * num_p - (lower.sum() - lower))
+        lower = np.maximum(lower, num_s * num_p - (upper.sum() - upper))
+        period_upper = np.minimum(period_upper, num_s - (period_lower.sum() - period_lower))
+        period_lower = np.maximum(period_lower, num_s - (period_upper.sum() - period_upper))
+
+    fixed = np.full((num_s, num_c), -1, dtype=np.int8)
+    fixed[allowed & (full[:, None] | (lower == able)[None, :])] = 1
+    fixed[~allowed | (upper == 0)[None, :]] = 0
+    return {'violations': violations, 'exact': exact, 'lower': lower, 'upper': upper,
+            'period_lower': period_lower, 'period_upper': period_upper, 'fixed': fixed}
+
+
+def gini(values):
+    """ジニ係数（0 なら全員同じ、1 に近いほど偏りが大きい）"""
+    x = np.sort(np.asarray(values, dtype=np.float64))
+    n = len(x)
+    if n == 0 or x.sum() == 0:
+        return 0.0
+    return float(2 * np.dot(np.arange(1, n + 1), x) / (n * x.sum()) - (n + 1) / n)
+
+
+def fairness_objective(fairness, ranks, num_choices):
+    """
+    公平性の方式 fairness で最小化する目的関数の値
+
+    ranks: (生徒, 時限) の割り当てた講座の希望順位（希望外は num_choices + 1）
+    weighted は 希望順位の合計 + 10 * (最大スコア - 最小スコア) の整数、ほかは辞書式に比べるリスト:
+        minimax [最悪の生徒のスコア, 希望順位の合計]
+        cap     [割り当てた最悪の希望順位, weighted の値]
+        profile [希望外の件数, 第N希望以下の件数, …, 第2希望以下の件数]
+    """
+    scores = ranks.sum(axis=1)
+    worst = int(scores.max()) if len(scores) else 0
+    weighted = int(scores.sum()) + 10 * (worst - int(scores.min()) if len(scores) else 0)
+    if fairness == 'minimax':
+        return [worst, int(scores.sum())]
+    if fairness == 'cap':
+        return [int(ranks.max()) if ranks.size else 0, weighted]
+    if fairness == 'profile':
+        return [int((ranks >= k).sum()) for k in range(num_choices + 1, 1, -1)]
+    return weighted
+
+
+def format_objective(value):
+    """fairness_objective の値を表示用の文字列にする（リストは / で区切る）"""
+    if isinstance(value, list):
+        return " / ".join(str(v) for v in value)
+    return str(value)
+
+
+def compute_statistics(rank_matrix, assignment, num_choices, max_per_course,
+                       percentiles=(10, 25, 50, 75, 90), fairness='weighted'):
+    """
+    割り当てと希望順位の行列から配置の統計をまとめて計算する
+
+    rank_matrix: (生徒, 講座) の希望順位（希望外は num_choices + 1）
+    assignment: (生徒, 時限) の講座番号（未配置は -1。希望外として数え、人数には含めない）
+    fairness: 求解に使った公平性の方式（summary の objective をその方式の目的関数値にする）
+
+    戻り値の辞書（配列の行は rank_matrix と同じ生徒の順）:
+        scores        生徒ごとの希望順位の合計
+        satisfaction  生徒ごとの満足度（全員第1希望なら100、全て希望外なら0）
+        avg_rank      生徒ごとの平均希望順位
+        rank_counts   (生徒, num_choices + 1) 第1希望〜第N希望・希望外の件数
+        rank_totals   rank_counts の全生徒の合計
+        counts        (時限, 講座) の人数
+        fill_rate     counts / max_per_course
+        summary       満足度の平均・最小・最大・標準偏差・パーセンタイル、
+                      平均希望順位、スコアのジニ係数と最大最小の差、未配置の枠数、
+                      公平性の方式（fairness）とその目的関数値（objective、fairness_objective）、
+                      方式によらず比べられる weighted の値（weighted_objective）
+    """
+    num_s, num_p = assignment.shape
+    num_c = rank_matrix.shape[1]
+    outside = num_choices + 1
+
+    # 未配置（-1）の枠は希望外として数える（-1 のまま引くと最後の講座の順位になる）
+    assigned = assignment >= 0
+    ranks = np.where(assigned, np.take_along_axis(rank_matrix, np.where(assigned, assignment, 0), axis=1),
+                     outside)
+    scores = ranks.sum(axis=1)
+
+    # 生徒ごとの順位のヒストグラム（行ごとにずらして1回の bincount で数える）
+    bins = np.minimum(ranks, outside) - 1 + outside * np.arange(num_s)[:, None]
+    rank_counts = np.bincount(bins.ravel(), minlength=num_s * outside).reshape(num_s, outside)
+
+    best = num_p
+    worst = num_p * outside
+    if worst > best:
+        satisfaction = 100 * (worst - scores) / (worst - best)
+    else:
+        satisfaction = np.full(num_s, 100.0)
+    avg_rank = scores / num_p if num_p > 0 else np.zeros(num_s)
+
+    counts = np.zeros((num_p, num_c), dtype=np.int64)
+    np.add.at(counts, (np.broadcast_to(np.arange(num_p), assignment.shape)[assigned], assignment[assigned]), 1)
+    fill_rate = counts / max_per_course if max_per_course > 0 else np.zeros(counts.shape)
+
+    spread = int(scores.max() - scores.min()) if num_s else 0
+    summary = {
+        'students': num_s,
+        'mean_satisfaction': float(satisfaction.mean()),
+        'min_satisfaction': float(satisfaction.min()),
+        'max_satisfaction': float(satisfaction.max()),
+        'std_satisfaction': float(satisfaction.std()),
+        'satisfaction_percentiles': {int(q): float(v) for q, v in
+                                     zip(percentiles, np.percentile(satisfaction, percentiles))},
+        'mean_rank': float(avg_rank.mean()),
+        'total_score': int(scores.sum()),
+        'score_spread': spread,
+        'score_gini': gini(scores),
+        'unassigned': int((~assigned).sum()),
+        'fairness': fairness,
+        'objective': fairness_objective(fairness, ranks, num_choices),
+        'weighted_objective': int(scores.sum()) + 10 * spread,
+    }
+
+    return {
+        'scores': scores,
+        'satisfaction': satisfaction,
+        'avg_rank': avg_rank,
+        'rank_counts': rank_counts,
+        'rank_totals': rank_counts.sum(axis=0),
+        'counts': counts,
+        'fill_rate': fill_rate,
+        'summary': summary,
+    }
+
+
+class Student:
+    """
+    アンケートの生徒1人
+
+    id: 生徒番号、name: 氏名、preferences: 希望講座名のタプル（希望順）
+    __slots__ で属性の辞書を持たないため、数万人規模でも1人あたりのメモリが小さい。
+    従来の辞書と同じく student['id'] のようにも参照できる。
+    """
+
+    __slots__ = ('id', 'name', 'preferences')
+
+    def __init__(self, id, name, preferences):
+        self.id = id
+        self.name = name
+        self.preferences = tuple(preferences)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        if not isinstance(other, Student):
+            return NotImplemented
+        return (self.id, self.name, self.preferences) == (other.id, other.name, other.preferences)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"Student(id={self.id!r}, name={self.name!r}, preferences={self.preferences!r})"
+
+    def __getstate__(self):
+        return self.id, self.name, self.preferences
+
+    def __setstate__(self, state):
+        self.id, self.name, self.preferences = state
+
+
+class _AssignmentView(Mapping):
+    """ScheduleResult.assignment の行を生徒番号で引くビュー（参照した行だけ変換する）"""
+
+    __slots__ = ('_result',)
+
+    def __init__(self, result):
+        self._result = result
+
+    def __getitem__(self, student_id):
+        result = self._result
+        return self._convert(result.assignment[result.student_index[student_id]], result.courses)
+
+    def __iter__(self):
+        return (student['id'] for student in self._result.students)
+
+    def __len__(self):
+        return len(self._result.students)
+
+    def __contains__(self, student_id):
+        return student_id in self._result.student_index
+
+
+class ScheduleView(_AssignmentView):
+    """ScheduleResult.schedule: 生徒番号 → {時限: 講座名}"""
+
+    __slots__ = ()
+
+    @staticmethod
+    def _convert(row, courses):
+        return {p: courses[c] for p, c in enumerate(row.tolist(), 1) if c >= 0}
+
+
+class CourseSelectionView(_AssignmentView):
+    """ScheduleResult.course_selection: 生徒番号 → 受講講座名の集合"""
+
+    __slots__ = ()
+
+    @staticmethod
+    def _convert(row, courses):
+        return {courses[c] for c in row.tolist() if c >= 0}
+
+
+class ScheduleResult:
+    """
+    配置結果
+
+    assignment: (生徒, 時限) の講座番号（courses の添字、未配置は -1）の int 配列。行は students の順
+    course_selection: 生徒番号 → 受講講座名の集合
+    schedule: 生徒番号 → {時限: 講座名}
+    roster: (時限, 講座名) → 生徒番号順の生徒（StudentScheduler.students の要素）のリスト
+    counts: (時限, 講座名) → 人数
+
+    配置は assignment の1つの配列だけで持ち、course_selection と schedule は
+    参照した生徒の行だけを変換する読み取り専用のビュー（dict と同じように使える）。
+    roster は初めて参照したときに作る。従来の戻り値と同じく
+    course_selection, schedule = result のように2要素のタプルとしても扱える。
+    """
+
+    __slots__ = ('students', 'courses', 'num_periods', 'student_index', 'assignment', 'counts', '_roster')
+
+    def __init__(self, students, courses, num_periods, assignment, student_index=None):
+        self.students = students
+        self.courses = courses
+        self.num_periods = num_periods
+        self.student_index = student_index if student_index is not None else \
+            {student['id']: s for s, student in enumerate(students)}
+        self.assignment = np.asarray(assignment, dtype=np.int64).reshape(-1, num_periods)
+        self._roster = None
+
+        counts = np.zeros((num_periods, len(courses)), dtype=np.int64)
+        periods, cols = np.nonzero(self.assignment.T >= 0)
+        np.add.at(counts, (periods, self.assignment.T[periods, cols]), 1)
+        self.counts = {(p + 1, course): int(counts[p, c])
+                       for p in range(num_periods) for c, course in enumerate(courses)}
+
+    @property
+    def schedule(self):
+        return ScheduleView(self)
+
+    @property
+    def course_selection(self):
+        return CourseSelectionView(self)
+
+    @property
+    def roster(self):
+        if self._roster is None:
+            by_id = np.array(sorted(range(len(self.students)), key=lambda s: self.students[s]['id']),
+                             dtype=np.int64)
+            self._roster = {}
+            for p in range(self.num_periods):
+                column = self.assignment[by_id, p]
+                for c, course in enumerate(self.courses):
+                    self._roster[p + 1, course] = [self.students[s] for s in by_id[column == c].tolist()]
+        return self._roster
+
+    def __iter__(self):
+        return iter((self.course_selection, self.schedule))
+
+    def __getitem__(self, index):
+        return (self.course_selection, self.schedule)[index]
+
+    def __len__(self):
+        return 2
+
+
+def max_rss_bytes():
+    """プロセスの最大常駐メモリ（バイト）。取得できない環境では None"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _reset_traced_peak():
+    """tracemalloc のピークを現在の確保量に戻す（reset_peak は Python 3.9 以降）"""
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+
+class RunProfiler:
+    """
+    処理の段階（スパン）ごとの所要時間とメモリを記録する
+
+    with profiler.span('load_data'): ... のように囲んだ区間を1件のスパンとして記録する。
+    入れ子にでき、depth と parent（親スパンの番号）で階層が分かる。
+    各スパンには経過秒と、終了時点のプロセスの最大常駐メモリ（max_rss_bytes）を記録し、
+    trace_memory=True なら tracemalloc でその区間の Python のメモリ確保量のピーク
+    （開始時点からの増分、peak_bytes）も記録する（tracemalloc の分だけ遅くなる）。
+    tracemalloc.reset_peak の無い Python 3.8 では、ピークは計測開始からの最大値になる
+    （区間のピークより大きく出ることがある）。
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.spans = []
+        self._stack = []  # 実行中のスパン: (番号, 開始時刻, 開始時のメモリ, それまでのピーク)
+        self._origin = time.perf_counter()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """name の区間を計測する（attrs は生徒数などの補足情報としてそのまま記録する）"""
+        index = len(self.spans)
+        record = {'name': name, 'depth': len(self._stack),
+                  'parent': self._stack[-1][0] if self._stack else None,
+                  'start': round(time.perf_counter() - self._origin, 6),
+                  'seconds': None, 'peak_bytes': None, 'max_rss_bytes': None}
+        record.update(attrs)
+        self.spans.append(record)
+
+        base = peak = 0
+        if self.trace_memory:
+            # 親のピークを引き継いでから計測をやり直す（終了時に親へ戻す）
+            if self._stack:
+                self._raise_parent_peak(tracemalloc.get_traced_memory()[1])
+            _reset_traced_peak()
+            base = peak = tracemalloc.get_traced_memory()[0]
+        self._stack.append([index, time.perf_counter(), base, peak])
+        try:
+            yield record
+        finally:
+            _, start, base, peak = self._stack.pop()
+            record['seconds'] = round(time.perf_counter() - start, 6)
+            record['max_rss_bytes'] = max_rss_bytes()
+            if self.trace_memory:
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                record['peak_bytes'] = peak - base
+                if self._stack:
+                    self._raise_parent_peak(peak)
+                _reset_traced_peak()
+
+    def _raise_parent_peak(self, peak):
+        self._stack[-1][3] = max(self._stack[-1][3], peak)
+
+    def summary(self):
+        """スパン名ごとの回数・合計秒・最大のメモリ確保量"""
+        totals = {}
+        for record in self.spans:
+            total = totals.setdefault(record['name'], {'count': 0, 'seconds': 0.0, 'peak_bytes': None})
+            total['count'] += 1
+            total['seconds'] = round(total['seconds'] + (record['seconds'] or 0.0), 6)
+            if record['peak_bytes'] is not None:
+                total['peak_bytes'] = max(total['peak_bytes'] or 0, record['peak_bytes'])
+        return totals
+
+    def report(self, top_allocations=20):
+        """実行レポート（JSON にできる辞書）"""
+        report = {
+            'command': sys.argv,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'elapsed_seconds': round(time.perf_counter() - self._origin, 6),
+            'max_rss_bytes': max_rss_bytes(),
+            'trace_memory': self.trace_memory,
+            'summary': self.summary(),
+            'spans': self.spans,
+        }
+        if self.trace_memory and tracemalloc.is_tracing():
+            stats = tracemalloc.take_snapshot().statistics('lineno')[:top_allocations]
+            report['top_allocations'] = [{'location': str(stat.traceback[0]), 'bytes': stat.size,
+                                          'count': stat.count} for stat in stats]
+        return report
+
+    def save(self, path, **extra):
+        """実行レポートを JSON で保存（extra は終了コードなどの追加の項目）"""
+        report = self.report()
+        report.update(extra)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    def print_table(self):
+        """スパンを階層付きの表で表示"""
+        print("\n【処理時間の内訳】")
+        for record in self.spans:
+            label = "  " * record['depth'] + record['name']
+            seconds = f"{record['seconds']:.3f}秒" if record['seconds'] is not None else "-"
+            memory = (f"  確保ピーク {record['peak_bytes'] / 1024 ** 2:.1f}MB"
+                      if record['peak_bytes'] is not None else "")
+            print(f"  {label:<32}{seconds:>12}{memory}")
+
+
+def traced(name):
+    """StudentScheduler のメソッド全体を self.profiler のスパン name として計測するデコレーター"""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.profiler.span(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+SOLVE_CACHE_VERSION = 2  # キャッシュの保存形式や求解の中身を変えたら上げる
+
+
+def default_cache_dir():
+    """求解キャッシュの既定の保存先（環境変数 STUDENT_SCHEDULER_CACHE、無ければOSのキャッシュ用フォルダ）"""
+    path = os.environ.get('STUDENT_SCHEDULER_CACHE')
+    if path:
+        return path
+    if platform.system() == 'Windows':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'student-scheduler')
+
+
+class SolveCache:
+    """
+    求解結果のディスクキャッシュ
+
+    キー（入力と求解条件の SHA-256）ごとに1つの JSON ファイルとして保存する。
+    合計サイズが max_bytes を超えたら、最後に使った時刻（ファイルの更新時刻）の
+    古いものから削除する。
+    """
+
+    def __init__(self, directory=None, max_bytes=64 * 1024 * 1024):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(payload):
+        """JSON にできる値からキーを作る（辞書のキーの順序に依存しない）"""
+        data = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        """保存された値を返す（無い・壊れている場合は None）。使った時刻を更新する"""
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                value_ = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return value_
+
+    def put(self, key, value_):
+        """値を保存し、合計サイズが上限を超えていれば古いものから削除する"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(value_, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        """合計サイズが max_bytes 以下になるまで古いエントリを削除する"""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.json') and entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+def result_styles():
+    """save_results で使う名前付きスタイル"""
+    from openpyxl.styles import PatternFill, Font, Alignment, Border, Side, NamedStyle
+    from openpyxl.styles.fonts import DEFAULT_FONT
+
+    header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
+    subheader_fill = PatternFill(start_color='D9E1F2', end_color='D9E1F2', fill_type='solid')
+    good_fill = PatternFill(start_color='C6EFCE', end_color='C6EFCE', fill_type='solid')
+    warning_fill = PatternFill(start_color='FFEB9C', end_color='FFEB9C', fill_type='solid')
+    bad_fill = PatternFill(start_color='FFC7CE', end_color='FFC7CE', fill_type='solid')
+    header_font = Font(bold=True, color='FFFFFF', size=11)
+    border = Border(
+        left=Side(style='thin'), right=Side(style='thin'),
+        top=Side(style='thin'), bottom=Side(style='thin')
+    )
+    center_align = Alignment(horizontal='center', vertical='center')
+    left_align = Alignment(horizontal='left', vertical='center')
+
+    return [
+        NamedStyle('配置_見出し', font=header_font, fill=header_fill, border=border, alignment=center_align),
+        NamedStyle('配置_名簿見出し', font=header_font, fill=header_fill, border=border, alignment=center_align),
+        NamedStyle('配置_小見出し', font=DEFAULT_FONT, fill=subheader_fill, border=border, alignment=center_align),
+        NamedStyle('配置_中央', font=DEFAULT_FONT, border=border, alignment=center_align),
+        NamedStyle('配置_左', font=DEFAULT_FONT, border=border, alignment=left_align),
+        NamedStyle('配置_左_良', font=DEFAULT_FONT, fill=good_fill, border=border, alignment=left_align),
+        NamedStyle('配置_左_注意', font=DEFAULT_FONT, fill=warning_fill, border=border, alignment=left_align),
+        NamedStyle('配置_左_不良', font=DEFAULT_FONT, fill=bad_fill, border=border, alignment=left_align),
+        NamedStyle('配置_中央_良', font=DEFAULT_FONT, fill=good_fill, border=border, alignment=center_align),
+        NamedStyle('配置_中央_注意', font=DEFAULT_FONT, fill=warning_fill, border=border, alignment=center_align),
+        NamedStyle('配置_中央_不良', font=DEFAULT_FONT, fill=bad_fill, border=border, alignment=center_align),
+        NamedStyle('配置_枠線', font=DEFAULT_FONT, border=border),
+        NamedStyle('配置_太字', font=Font(bold=True)),
+    ]
+
+
 class StudentScheduler:
     def __init__(self, num_students, num_periods, num_choices, min_per_course, max_per_course):
         self.num_students = num_students
@@ -52,13 +1353,35 @@ class StudentScheduler:
         self.num_choices = num_choices  # 希望順位の数（例: 6、これが講座数）
         self.min_per_course = min_per_course
         self.max_per_course = max_per_course
-        self.students = []
+        self.students = []  # Student のリスト（アンケートの行の順）
         self.courses = []  # 全講座リスト
+        self.profile_groups = []  # 同じ希望リストの生徒番号（self.students の添字）のグループ
+        self.rank_matrix = None  # 希望順位の行列 (生徒, 講座)、希望外は num_choices + 1
+        self.student_index = {}  # 生徒番号 → rank_matrix の行
+        self.course_index = {}  # 講座名 → rank_matrix の列
+        self.time_limit = None  # 求解の制限時間（秒）。None なら無制限
+        self.deadline = None  # 読み込みから再試行までの全体の締め切り（time.perf_counter() の値）。None なら無し
+        self.violations = []  # ソフト制約で解いた場合の人数範囲外の時限・講座
+        self.mip_gap = None  # 相対ギャップの目標値。None ならソルバーの既定値
+        self.cache = None  # SolveCache。None ならキャッシュを使わない
+        self.engine = None  # 求解エンジン（SOLVER_ENGINES の名前）。None なら highs、無ければ pulp
+        self.threads = None  # ソルバーのスレッド数。None ならソルバーの既定値
+        self.seed = None  # ソルバーとヒューリスティックの乱数シード。None なら既定値
+        self.parallel = 'deterministic'  # 並列化の方式（get_solver の parallel）
+        self.fairness = 'weighted'  # 公平性の方式（FAIRNESS_STRATEGIES）
+        self.rank_cap = None  # fairness='cap' の希望順位の上限。None なら実現できる最小の上限を探す
+        self.applied_fairness = None  # 直近の求解で実際に使った公平性の方式（self.fairness が使えない求解方式では weighted）
+        self.presolved = None  # presolve() の結果（presolve_selection の戻り値）。None なら使わない
+        self.profiler = RunProfiler()  # 処理の段階ごとの所要時間・メモリの記録
         self.input_file = "入力_生徒希望アンケート.xlsx"
         self.output_file = "出力_講座配置結果.xlsx"
 
     def create_input_template(self):
         """入力用のテンプレートExcelファイルを作成"""
+        import openpyxl
+        from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
+        from openpyxl.utils import get_column_letter
+
         wb = openpyxl.Workbook()
         ws = wb.active
         ws.title = "アンケート入力"
@@ -216,38 +1539,67 @@ class StudentScheduler:
                 print(".", end="", flush=True)
                 time.sleep(2)
 
+    @traced('load_data')
     def load_data(self):
-        """Excelファイルからデータを読み込む"""
-        wb = openpyxl.load_workbook(self.input_file)
-        ws = wb['アンケート入力']
-
-        all_courses = set()
-
-        for row in ws.iter_rows(min_row=2, max_row=self.num_students + 1, values_only=True):
-            if row[0] is None or str(row[0]).strip() == '':
-                continue
-            if row[1] is None or str(row[1]).strip() == '':
-                continue
-
-            preferences = []
-            for i in range(2, 2 + self.num_choices):
-                if i < len(row) and row[i] is not None and str(row[i]).strip() != '':
-                    preferences.append(str(row[i]).strip())
+        """
+        入力ファイル（Excel / CSV / TSV）からデータを読み込む
 
-            if preferences:
-                student = {
-                    'id': str(row[0]).strip(),
-                    'name': str(row[1]).strip(),
-                    'preferences': preferences
-                }
-                self.students.append(student)
-                all_courses.update(preferences)
+        1行目は見出し（生徒番号, 氏名, 第1希望〜）として読み飛ばし、
+        2行目から最初の空行（すべてのセルが空の行）の手前までを読む。
+        生徒番号・氏名の欠落や生徒番号の重複は行番号付きでまとめて ValueError にする。
+        """
+        all_courses = {}  # 講座名 → 最初に読んだ講座名（生徒間で同じ文字列オブジェクトを共有する）
+        errors = []
+        skipped = []
+        seen = {}
 
-        wb.close()
+        rows = iter_survey_rows(self.input_file)
+        try:
+            for row_number, row in rows:
+                cells = [str(v).strip() if v is not None else '' for v in row[:2 + self.num_choices]]
+                cells += [''] * (2 + self.num_choices - len(cells))
+                if not any(cells) and all(v is None or str(v).strip() == '' for v in row):
+                    break
+
+                student_id, name = cells[0], cells[1]
+                preferences = [all_courses.setdefault(course, course) for course in cells[2:] if course]
+
+                if not student_id:
+                    errors.append(f"{row_number}行目: 生徒番号が入力されていません")
+                    continue
+                if not name:
+                    errors.append(f"{row_number}行目: 氏名が入力されていません（生徒番号 {student_id}）")
+                    continue
+                if student_id in seen:
+                    errors.append(f"{row_number}行目: 生徒番号 {student_id} が{seen[student_id]}行目と重複しています")
+                    continue
+                seen[student_id] = row_number
+
+                if not preferences:
+                    skipped.append(row_number)
+                    continue
+
+                self.students.append(Student(student_id, name, preferences))
+        finally:
+            rows.close()
+
+        if errors:
+            shown = errors[:20]
+            if len(errors) > len(shown):
+                shown.append(f"ほか{len(errors) - len(shown)}件")
+            raise ValueError("入力データに誤りがあります\n  " + "\n  ".join(shown))
+
+        if skipped:
+            print(f"※ 希望が未入力のため除外した行: {', '.join(map(str, skipped))}")
 
         if len(self.students) == 0:
             raise ValueError("有効な生徒データが見つかりません")
 
+        if self.num_students is None:
+            self.num_students = len(self.students)
+        elif self.num_students != len(self.students):
+            print(f"※ 入力された生徒数（{self.num_students}名）と読み込んだ人数が異なります")
+
         # 全講座をリスト化（希望順位のスコアでソート）
         course_scores = defaultdict(int)
         for student in self.students:
@@ -256,8 +1608,24 @@ class StudentScheduler:
 
         self.courses = sorted(all_courses, key=lambda c: course_scores[c], reverse=True)
 
+        # 希望順位の行列（同じ講座を重複して書いた場合は上位の順位を採用）
+        self.student_index = {student['id']: s for s, student in enumerate(self.students)}
+        self.course_index = {course: c for c, course in enumerate(self.courses)}
+        self.rank_matrix = np.full((len(self.students), len(self.courses)),
+                                   self.num_choices + 1, dtype=np.int32)
+        for s, student in enumerate(self.students):
+            cols = [self.course_index[course] for course in student['preferences']]
+            self.rank_matrix[s, cols[::-1]] = np.arange(len(cols), 0, -1)
+
+        # 同じ希望リストを提出した生徒をまとめる（集約モード用）
+        groups = {}
+        for s, student in enumerate(self.students):
+            groups.setdefault(tuple(student['preferences']), []).append(s)
+        self.profile_groups = list(groups.values())
+
         print(f"\n✓ 読み込み完了: {len(self.students)}名の生徒データ")
         print(f"✓ 講座数: {len(self.courses)}講座")
+        print(f"✓ 希望パターン数: {len(self.profile_groups)}通り")
 
         print("\n【講座一覧】（人気順）")
         for i, course in enumerate(self.courses, 1):
@@ -265,11 +1633,377 @@ class StudentScheduler:
 
     def get_preference_rank(self, student, course):
         """生徒の希望順位を取得（1始まり、希望外は大きな値）"""
-        if course in student['preferences']:
-            return student['preferences'].index(course) + 1
-        return self.num_choices + 1  # 希望外
+        return self.rank_of(self.student_index[student['id']], course)
+
+    def rank_of(self, s, course):
+        """rank_matrix の s 行目から講座名で希望順位を引く（未配置・希望外は num_choices + 1）"""
+        c = self.course_index.get(course)
+        if c is None:
+            return self.num_choices + 1
+        return int(self.rank_matrix[s, c])
+
+    @traced('presolve')
+    def presolve(self, rank_cap=None):
+        """
+        モデルを組み立てる前に、人数条件を満たす配置があるかを数え上げで調べる
+
+        人数条件だけで実行不可能なら理由を表示して False を返す（呼び出し側は
+        solve_with_relaxed_constraints に進む）。rank_cap を指定すると、希望順位が
+        rank_cap より下の講座は受講できないものとして調べ、実行不可能なら ValueError。
+        実行可能なら presolve_selection の結果を self.presolved に設定して True を返す
+        （build_ilp_matrix と build_selection_matrix が人数の範囲と変数の固定に使う）。
+        """
+        self.presolved = None
+        num_s, num_c = self.rank_matrix.shape
+        num_p = self.num_periods
+
+        print("\n【事前チェック】")
+        if num_p > num_c:
+            print(f"✗ 受講する講座数（{num_p}）が講座の種類数（{num_c}）を超えています")
+            return False
+
+        start = time.perf_counter()
+        presolved = presolve_selection(np.ones((num_s, num_c), dtype=bool), num_p,
+                                       self.min_per_course, self.max_per_course)
+        if presolved['violations']:
+            print(f"✗ 人数条件を満たす配置はありません（{(time.perf_counter() - start) * 1000:.0f}ミリ秒）")
+            for reason in self._presolve_reasons(presolved['violations']):
+                print(f"  - {reason}")
+            return False
+
+        if rank_cap is not None:
+            presolved = presolve_selection(self.rank_matrix <= rank_cap, num_p,
+                                           self.min_per_course, self.max_per_course)
+            if presolved['violations']:
+                raise ValueError(f"全員を第{rank_cap}希望以内に配置することはできません。--rank-cap を大きくしてください。\n  "
+                                 + "\n  ".join(self._presolve_reasons(presolved['violations'], rank_cap)))
+
+        fixed = int((presolved['fixed'] >= 0).sum())
+        narrowed = int((presolved['lower'] > num_p * self.min_per_course).sum()
+                       + (presolved['upper'] < num_p * self.max_per_course).sum())
+        print(f"✓ 人数条件を満たす配置があります（{(time.perf_counter() - start) * 1000:.0f}ミリ秒）")
+        if narrowed:
+            print(f"  講座の延べ人数の範囲を狭めた箇所: {narrowed}")
+        if fixed:
+            print(f"  値の決まる受講の変数: {fixed}個（{fixed / presolved['fixed'].size:.1%}）")
+        if not presolved['exact']:
+            print(f"※ 講座数が{PRESOLVE_MAX_SUBSET_COURSES}を超えるため、一部の条件のみ調べました")
+        self.presolved = presolved
+        return True
+
+    def _presolve_reasons(self, violations, rank_cap=None):
+        """presolve_selection の violations を説明の文に直す（最大5件）"""
+        num_s, num_c = self.rank_matrix.shape
+        num_p = self.num_periods
+        reasons = []
+        seen = set()
+        for kind, courses, need, limit in violations:
+            if rank_cap is None:
+                # 全講座を選べる場合は講座の数だけで決まり、1講座と全講座の条件が他の条件を含むので
+                # その2つだけを1つずつ説明する
+                if len(courses) not in (1, num_c) or (kind, len(courses)) in seen:
+                    continue
+                seen.add((kind, len(courses)))
+                if kind == 'lower' and len(courses) == 1:
+                    reasons.append(f"各講座には{num_p}時限で延べ{need}名（{num_p}時限 × 最低{self.min_per_course}名）が"
+                                   f"必要ですが、同じ講座は1人1回しか受講しないため生徒{num_s}名では足りません")
+                    continue
+                if len(courses) == num_c:
+                    if kind == 'lower':
+                        reasons.append(f"各時限の{num_s}名では、{num_c}講座すべてに最低{self.min_per_course}名"
+                                       f"（計{num_c * self.min_per_course}名）を配置できません")
+                    else:
+                        reasons.append(f"各時限の{num_s}名が、{num_c}講座の最高人数の合計"
+                                       f"（{num_c} × {self.max_per_course}名 = {num_c * self.max_per_course}名）を超えています")
+                    continue
+            if not courses:
+                short = np.flatnonzero((self.rank_matrix <= rank_cap).sum(axis=1) < num_p)
+                ids = ", ".join(self.students[s]['id'] for s in short[:10])
+                more = f" ほか{len(short) - 10}名" if len(short) > 10 else ""
+                reasons.append(f"第{rank_cap}希望以内の講座が{num_p}個に満たない生徒がいます（{ids}{more}）")
+                continue
+            names = "・".join(self.courses[c] for c in courses)
+            within = "" if rank_cap is None else f"第{rank_cap}希望以内で"
+            if kind == 'lower':
+                reasons.append(f"講座 {names} には延べ{need}名以上が必要ですが、{within}受講できるのは延べ{limit}名までです")
+            else:
+                reasons.append(f"講座 {names} 以外では{within}受講する講座が足りないため延べ{need}名が {names} に入りますが、"
+                               f"最高人数の合計は延べ{limit}名です")
+        if len(reasons) > 5:
+            reasons = reasons[:5] + [f"ほか{len(reasons) - 5}件"]
+        return reasons
+
+    @traced('optimize')
+    def solve(self, mode='ilp'):
+        """
+        指定した方式で配置を求める
+
+        mode:
+            'ilp'        生徒×講座×時限の全体モデルを解く
+            'decomposed' 受講講座の選択と時限の割り当てを2段階で解く
+            'aggregated' 同じ希望リストの生徒をまとめた人数モデルを解く
+            'heuristic'  貪欲法＋局所探索で近似解を求める（ILPを解かない）
+
+        self.cache が設定されていれば、同じ入力・条件の結果をキャッシュから返し
+        （モデルの構築も求解も行わない）、新たに解いた結果はキャッシュに保存する。
+        """
+        if self.cache is None:
+            return self._solve_uncached(mode)
+
+        key = self.cache_key(mode)
+        cached = self.cache.get(key)
+        if cached is not None:
+            try:
+                assignment = [[self.course_index[course] for course in cached['schedule'][student['id']]]
+                              for student in self.students]
+                self.violations = cached['violations']
+                self.applied_fairness = cached['fairness']
+            except (KeyError, TypeError):
+                pass
+            else:
+                print(f"\n✓ 同じ入力・条件の求解結果をキャッシュから読み込みました（{self.cache.directory}）")
+                return self.make_result(assignment=assignment)
+
+        result = self._solve_uncached(mode)
+        try:
+            self.cache.put(key, {
+                'schedule': {student_id: [row[p] for p in range(1, self.num_periods + 1)]
+                             for student_id, row in result.schedule.items()},
+                'violations': self.violations,
+                'fairness': self.applied_fairness,
+            })
+        except OSError as e:
+            print(f"※ 求解結果をキャッシュに保存できませんでした: {e}")
+        return result
+
+    def cache_key(self, mode):
+        """
+        求解キャッシュのキー
+
+        生徒番号順に並べた (生徒番号, 希望リスト)、講座の並び、受講講座数、希望順位の数、
+        人数の範囲、求解方式と制限時間・ギャップ、使うソルバーから作る。
+        氏名は結果に影響しないので含めない。入力ファイル内の並び順も含めない。並び順が
+        変わると同じ目的関数値の別の解が選ばれることはあるが、同じ結果として扱う。
+        """
+        return SolveCache.key({
+            'version': SOLVE_CACHE_VERSION,
+            'students': sorted((student['id'], student['preferences']) for student in self.students),
+            'courses': self.courses,
+            'num_periods': self.num_periods,
+            'num_choices': self.num_choices,
+            'min_per_course': self.min_per_course,
+            'max_per_course': self.max_per_course,
+            'mode': mode,
+            'time_limit': self.time_limit,
+            'mip_gap': self.mip_gap,
+            'engine': self.engine_name(),
+            'threads': self.threads,
+            'seed': self.seed,
+            'parallel': self.parallel,
+            'fairness': self.fairness,
+            'rank_cap': self.rank_cap,
+        })
+
+    def engine_name(self, engine=None):
+        """
+        使う求解エンジンの名前を返す
+
+        engine（None なら self.engine）が未指定なら highs、highspy が無ければ pulp。
+        不明な名前や、必要なパッケージが無いエンジンなら ValueError。
+        """
+        engine = engine or self.engine
+        if engine is None:
+            return 'highs' if installed('highspy') else 'pulp'
+        if engine not in SOLVER_ENGINES:
+            raise ValueError(f"不明な求解エンジンです: {engine}")
+        if engine not in available_engines():
+            raise ValueError(engine_install_hint(engine))
+        return engine
+
+    def solve_time_limit(self, time_limit=None):
+        """
+        これから始める求解の制限時間
 
-    def solve_with_ilp(self):
+        time_limit（None なら self.time_limit）を self.deadline までの残り時間で抑える。
+        締め切りを過ぎていれば ValueError（制約を緩和した再試行なども打ち切る）。
+        """
+        if time_limit is None:
+            time_limit = self.time_limit
+        if self.deadline is None:
+            return time_limit
+        remaining = self.deadline - time.perf_counter()
+        if remaining <= 0:
+            raise ValueError("制限時間内に解が見つかりませんでした。制限時間を長くしてください。")
+        return remaining if time_limit is None else min(time_limit, remaining)
+
+    @traced('solve')
+    def _solve_matrix(self, model, initial=None, engine=None, time_limit=None):
+        """
+        ModelMatrix を求解エンジンで解く（戻り値は solve_model_matrix と同じ）
+
+        time_limit: この求解の制限時間（None なら self.time_limit。self.deadline までの残りで抑える）
+
+        値の決まった列（事前チェックで固定した変数など）は除いてから求解エンジンに渡す。
+        """
+        engine = self.engine_name(engine)
+        print(f"求解エンジン: {engine}")
+        time_limit = self.solve_time_limit(time_limit)
+        reduced, keep, offset = model.without_fixed_columns()
+        if reduced is None:
+            return 'Infeasible', None, None
+        if keep is not None:
+            print(f"事前処理: 値の決まった {model.num_cols - reduced.num_cols}列を除いて "
+                  f"{reduced.num_cols}列・{reduced.num_rows}行で解きます")
+            if initial is not None:
+                initial = np.asarray(initial)[keep]
+            if reduced.num_cols == 0:
+                return 'Optimal', model.col_lower.copy(), offset
+        status, col_value, objective = SOLVER_ENGINES[engine](
+            reduced, initial, time_limit, self.mip_gap, threads=self.threads, seed=self.seed, parallel=self.parallel)
+        if keep is None or col_value is None:
+            return status, col_value, objective
+        full = model.col_lower.copy()
+        full[keep] = col_value
+        return status, full, objective + offset
+
+    def _solve_fair(self, model, y_idx, max_col, min_col, initial=None, engine=None, move_cost=None):
+        """
+        受講講座 y[s,c] と max_score, min_score の列を持つモデルを self.fairness の方式で解く
+
+        weighted 以外は同じモデルの目的関数を段階ごとに差し替えて解く辞書式最適化で、
+        各段階の最適値を制約として加え、その解を次の段階の MIP スタートにする
+        （前の段階の解は次の段階でも実行可能なので、求解は暫定解から始まる）。
+        self.time_limit は全段階の合計の制限時間として扱う。
+
+        move_cost: 前回の講座を保つための列ごとの係数（solve_incremental）。model.col_cost には
+                   すでに足してあるものとし（weighted・cap はそれを使う）、minimax・profile では
+                   最後の段階の目的関数に足す。
+
+        戻り値: _solve_matrix と同じ（目的関数値は最後の段階のもの）
+        """
+        self.applied_fairness = self.fairness
+        if self.fairness == 'weighted':
+            return self._solve_matrix(model, initial, engine)
+
+        time_limit = self.solve_time_limit()
+        deadline = None if time_limit is None else time.perf_counter() + time_limit
+        rank = self.rank_matrix
+        weighted = model.col_cost.copy()
+
+        def y_cost(values):
+            cost = np.zeros(model.num_cols)
+            cost[y_idx.ravel()] = values.ravel()
+            return cost
+
+        if self.fairness == 'minimax':
+            worst = np.zeros(model.num_cols)
+            worst[max_col] = 1
+            stages = [('最悪の生徒のスコア', worst), ('希望順位の合計', y_cost(rank))]
+        elif self.fairness == 'profile':
+            stages = [(f"第{k}希望以下の件数" if k <= self.num_choices else "希望外の件数", y_cost(rank >= k))
+                      for k in range(self.num_choices + 1, 1, -1)]
+        else:
+            stages = None
+        if stages is not None:
+            if move_cost is not None:
+                label, cost = stages[-1]
+                stages[-1] = (f"{label}（前回の講座を保つペナルティ込み）", cost + move_cost)
+            return self._solve_lexicographic(model, stages, initial, deadline, engine)
+
+        # cap: 上限を超える希望順位の講座を選べないようにする
+        if self.rank_cap is not None:
+            cap = self.rank_cap
+        else:
+            # 上限 k を下げられる限り下げる（各生徒は num_periods 個の講座を受講するので下限は num_periods）。
+            # 数え上げで実現できないとわかる上限は解かずに除き、すべての講座の部分集合を
+            # 調べられた場合は、数え上げで実現できる最小の上限をそのまま使う
+            cap = floor = self.num_choices + 1
+            exact = True
+            for k in range(self.num_periods, self.num_choices + 1):
+                check = presolve_selection(rank <= k, self.num_periods, self.min_per_course, self.max_per_course)
+                if not check['violations']:
+                    floor, exact = k, check['exact']
+                    break
+            if exact:
+                cap = floor
+            else:
+                for k in range(self.num_choices, floor - 1, -1):
+                    model.col_upper[y_idx[rank > cap]] = 0
+                    solution = self._solve_lexicographic(model, [(f"第{k}希望より下の件数", y_cost(rank > k))],
+                                                         initial, deadline, engine, bound=False)
+                    if solution is None or solution[1] is None:
+                        break
+                    initial = solution[1]
+                    if solution[2] > 0.5:
+                        break
+                    cap = k
+        model.col_upper[y_idx[rank > cap]] = 0
+        if cap <= self.num_choices:
+            print(f"希望順位の上限: 第{cap}希望")
+        solution = self._solve_lexicographic(model, [('希望順位の合計 + 公平性ペナルティ', weighted)], initial,
+                                             deadline, engine)
+        if self.rank_cap is not None and solution[1] is None and str(solution[0]).lower() == 'infeasible':
+            # 人数制約の緩和では上限は守れないので、黙って上限を外さずに知らせる
+            raise ValueError(f"全員を第{self.rank_cap}希望以内に配置することはできません。--rank-cap を大きくしてください。")
+        return solution
+
+    def _solve_lexicographic(self, model, stages, initial, deadline, engine=None, bound=True):
+        """
+        stages（(名前, 目的関数の係数) のリスト）を順に最小化する
+
+        bound=True なら各段階の最適値（暫定解ならその値）を以降の段階の制約として加える。
+        係数が非負で、MIP スタートがすでに 0 を達成している段階は解かずに済ませる。
+        締め切り（deadline）を過ぎたら、それまでの段階の解を返す（1段階も解けていなければ None）。
+        """
+        best = None
+        for label, cost in stages:
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if best is not None and remaining is not None and remaining <= 0:
+                print("※ 制限時間に達したため、以降の段階を省略します")
+                break
+            model.col_cost = cost
+            if initial is not None and cost.min() >= 0 and cost @ initial < 0.5:
+                print(f"段階「{label}」: 初期解がすでに 0 のため求解を省略")
+                status, col_value, objective = 'Optimal', initial, 0.0
+            else:
+                print(f"\n段階「{label}」を最小化中...")
+                status, col_value, objective = self._solve_matrix(
+                    model, initial, engine, time_limit=None if remaining is None else max(remaining, 1e-3))
+                if col_value is None:
+                    if best is None:
+                        return status, None, None
+                    print(f"※ 段階「{label}」で解が得られなかったため、前の段階の解を使います")
+                    break
+                print(f"段階「{label}」: {objective:.2f}（{status}）")
+            best = (status, col_value, objective)
+            if bound:
+                nonzero = np.flatnonzero(cost)
+                model.add_rows(nonzero, cost[nonzero], -np.inf, np.floor(objective + 1e-6))
+            initial = col_value
+        return best
+
+    def _solve_uncached(self, mode):
+        """solve の本体（キャッシュを使わずに解く）"""
+        self.applied_fairness = 'weighted'  # _solve_fair を通る方式では self.fairness になる
+        if self.fairness != 'weighted' and mode in ('aggregated', 'heuristic'):
+            print(f"※ 公平性の方式 {self.fairness} は ilp と decomposed でのみ使えます（weighted で解きます）")
+        rank_cap = None
+        if self.fairness == 'cap' and (mode == 'decomposed' or (mode == 'ilp' and self.engine_name() != 'pulp')):
+            rank_cap = self.rank_cap
+        if not self.presolve(rank_cap):
+            print("制約を緩和して計算します...")
+            return self.solve_with_relaxed_constraints()
+        if mode == 'ilp':
+            return self.solve_with_ilp()
+        if mode == 'decomposed':
+            return self.solve_decomposed()
+        if mode == 'aggregated':
+            return self.solve_aggregated()
+        if mode == 'heuristic':
+            return self.solve_heuristic()
+        raise ValueError(f"不明な求解方式です: {mode}")
+
+    def solve_with_ilp(self, backend=None, warm_start=True):
         """
         整数線形計画法(ILP)で最適配置を求める
 
@@ -284,396 +2018,1112 @@ class StudentScheduler:
             2. 各生徒は各講座を最大1回受講
             3. 各生徒はnum_periods個の講座を受講
             4. 各時限の各講座の人数は目標±許容範囲
+
+        backend: 求解エンジンの名前（None なら self.engine）
+            'highs' 疎行列を組み立てて highspy に直接渡す（既定）
+            'cpsat' 同じ疎行列を OR-Tools の CP-SAT で解く
+            'pulp'  PuLPの変数オブジェクトで定式化する（highspy が無い場合の既定）
         """
         print("\n【整数線形計画法(ILP)で最適化】")
-        print("問題を定式化中...")
 
-        # 問題の作成
-        prob = LpProblem("StudentScheduler", LpMinimize)
+        backend = self.engine_name(backend)
+        if backend == 'pulp':
+            if self.fairness != 'weighted':
+                print(f"※ PuLP の定式化では公平性の方式 {self.fairness} は使えません（weighted で解きます）")
+            self.applied_fairness = 'weighted'
+            return self._solve_with_pulp()
+        return self._solve_with_matrix(warm_start, backend)
 
-        # インデックス
-        students_idx = range(len(self.students))
-        courses_idx = range(len(self.courses))
-        periods_idx = range(1, self.num_periods + 1)
+    @traced('build_model')
+    def build_ilp_matrix(self):
+        """
+        solve_with_ilp と同じモデルを疎行列として組み立てる
 
-        # 決定変数: x[s][c][p] = 1 if student s takes course c in period p
-        x = {}
-        for s in students_idx:
-            for c in courses_idx:
-                for p in periods_idx:
-                    x[s, c, p] = LpVariable(f"x_{s}_{c}_{p}", cat=LpBinary)
+        列の並び: x[s,c,p]（s, c, p の順）, y[s,c], max_score, min_score
+        MinBalance/MaxBalance は下限・上限付きの1行にまとめる。
 
-        # 補助変数: y[s][c] = 1 if student s takes course c (any period)
-        y = {}
-        for s in students_idx:
-            for c in courses_idx:
-                y[s, c] = LpVariable(f"y_{s}_{c}", cat=LpBinary)
+        戻り値: (ModelMatrix, x の列番号配列 (生徒, 講座, 時限))
+        """
+        num_s = len(self.students)
+        num_c = len(self.courses)
+        num_p = self.num_periods
 
-        # 公平性のための補助変数
-        max_score = LpVariable("max_score", lowBound=0)
-        min_score = LpVariable("min_score", lowBound=0)
+        rank = self.rank_matrix
 
-        # 各生徒のスコア（希望順位の合計）
-        student_scores = {}
-        for s in students_idx:
-            student = self.students[s]
-            student_scores[s] = lpSum(
-                self.get_preference_rank(student, self.courses[c]) * y[s, c]
-                for c in courses_idx
-            )
+        num_x = num_s * num_c * num_p
+        num_y = num_s * num_c
+        x_idx = np.arange(num_x, dtype=np.int64).reshape(num_s, num_c, num_p)
+        y_idx = np.arange(num_x, num_x + num_y, dtype=np.int64).reshape(num_s, num_c)
+        max_col = num_x + num_y
+        min_col = max_col + 1
 
-        print("目的関数を設定中...")
+        model = ModelMatrix(num_x + num_y + 2)
+        model.col_upper[[max_col, min_col]] = np.inf
+        model.integrality[[max_col, min_col]] = False
 
         # 目的関数: 希望順位の合計 + 公平性ペナルティ
-        total_preference_score = lpSum(student_scores[s] for s in students_idx)
-        fairness_penalty = (max_score - min_score) * 10
-
-        prob += total_preference_score + fairness_penalty, "Total_Cost"
-
-        print("制約条件を追加中...")
+        model.col_cost[y_idx.ravel()] = rank.ravel()
+        model.col_cost[max_col] = 10
+        model.col_cost[min_col] = -10
 
         # 制約1: 各生徒は各時限で1つの講座を受講
-        for s in students_idx:
-            for p in periods_idx:
-                prob += lpSum(x[s, c, p] for c in courses_idx) == 1, f"OnePerPeriod_s{s}_p{p}"
+        model.add_rows(x_idx.transpose(0, 2, 1).reshape(num_s * num_p, num_c), 1, 1, 1)
 
         # 制約2: 各生徒は各講座を最大1回受講
-        for s in students_idx:
-            for c in courses_idx:
-                prob += lpSum(x[s, c, p] for p in periods_idx) <= 1, f"MaxOnce_s{s}_c{c}"
-
-        # 制約3: y[s,c]とx[s,c,p]の関係
-        for s in students_idx:
-            for c in courses_idx:
-                prob += y[s, c] == lpSum(x[s, c, p] for p in periods_idx), f"Link_y_x_s{s}_c{c}"
-
-        # 制約4: 各時限の各講座の人数バランス
-        for p in periods_idx:
-            for c in courses_idx:
-                count = lpSum(x[s, c, p] for s in students_idx)
-                prob += count >= self.min_per_course, f"MinBalance_p{p}_c{c}"
-                prob += count <= self.max_per_course, f"MaxBalance_p{p}_c{c}"
+        model.add_rows(x_idx.reshape(num_s * num_c, num_p), 1, -np.inf, 1)
+
+        # 制約3: y[s,c] - Σp x[s,c,p] = 0
+        model.add_rows(np.hstack([y_idx.reshape(-1, 1), x_idx.reshape(num_s * num_c, num_p)]),
+                       np.hstack([[1.0], np.full(num_p, -1.0)]), 0, 0)
+
+        # 制約4: 各時限の各講座の人数バランス（下限・上限を1行で表す）
+        period_lower, period_upper = self.min_per_course, self.max_per_course
+        if self.presolved is not None:
+            period_lower = np.tile(self.presolved['period_lower'], num_p)
+            period_upper = np.tile(self.presolved['period_upper'], num_p)
+            self._fix_presolved(model, y_idx)
+            model.col_upper[x_idx[self.presolved['fixed'] == 0]] = 0
+        model.add_rows(x_idx.transpose(2, 1, 0).reshape(num_p * num_c, num_s), 1, period_lower, period_upper)
 
         # 制約5: 公平性（max_score, min_score）
-        for s in students_idx:
-            prob += student_scores[s] <= max_score, f"MaxScore_s{s}"
-            prob += student_scores[s] >= min_score, f"MinScore_s{s}"
+        self._add_fairness_rows(model, y_idx, rank, max_col, min_col)
+
+        return model, x_idx
+
+    def _fix_presolved(self, model, y_idx):
+        """self.presolved で値の決まった y[s,c] の列の下限・上限を固定する"""
+        fixed = self.presolved['fixed']
+        model.col_lower[y_idx[fixed == 1]] = 1
+        model.col_upper[y_idx[fixed == 0]] = 0
+
+    @staticmethod
+    def _add_fairness_rows(model, y_idx, rank, max_col, min_col):
+        """score[s] - max_score <= 0, score[s] - min_score >= 0 の行を追加"""
+        num_s = y_idx.shape[0]
+        minus_one = np.full((num_s, 1), -1.0)
+        model.add_rows(np.hstack([y_idx, np.full((num_s, 1), max_col)]),
+                       np.hstack([rank, minus_one]), -np.inf, 0)
+        model.add_rows(np.hstack([y_idx, np.full((num_s, 1), min_col)]),
+                       np.hstack([rank, minus_one]), 0, np.inf)
+
+    def solve_decomposed(self, warm_start=True):
+        """
+        2段階分解で最適配置を求める
+
+        目的関数は y[s,c]（どの講座を受講するか）だけで決まり、時限の区別は
+        人数バランス制約にしか現れない。そこで
+            段階1: 講座ごとの延べ人数 P*min〜P*max の下で各生徒の受講講座を選ぶ
+            段階2: 選んだ講座を辺彩色で時限に割り当てる（assign_periods）
+        の順に解く。均等辺彩色により各時限の人数は floor(d/P)〜ceil(d/P) に
+        収まるため、段階1の解は必ず段階2で実現でき、元のモデルと同じ最適値になる。
+        段階2で人数制約を満たせなかった場合は solve_with_ilp にフォールバックする。
+        """
+        print("\n【2段階分解で最適化】")
+
+        print("段階1: 受講講座の選択を定式化中...")
+        model, y_idx = self.build_selection_matrix()
+        max_col, min_col = y_idx.size, y_idx.size + 1
+
+        print(f"変数数: {model.num_cols}")
+        print(f"制約数: {model.num_rows}")
+
+        initial = None
+        if warm_start:
+            initial, _ = self._heuristic_start(y_idx, max_col, min_col, model.num_cols)
+            if initial is not None:
+                print("初期解: ヒューリスティック解をMIPスタートに設定しました")
 
-        print(f"変数数: {len(prob.variables())}")
-        print(f"制約数: {len(prob.constraints)}")
         print("\n最適化を実行中（しばらくお待ちください）...")
 
-        # 求解
         start_time = time.time()
-        solver = get_solver()
-        if solver:
-            prob.solve(solver)
+        status, col_value, objective = self._solve_fair(model, y_idx, max_col, min_col, initial)
+        solve_time = time.time() - start_time
+
+        print(f"\n✓ 段階1 求解完了（{solve_time:.1f}秒）")
+        self._print_status(status, col_value is not None)
+
+        if col_value is None:
+            print("警告: 最適解が見つかりませんでした。制約を緩和して再試行します...")
+            return self.solve_with_relaxed_constraints()
+
+        print("段階2: 時限への割り当て中...")
+        chosen = col_value[y_idx] > 0.5
+        result = self._assign_course_sets([np.flatnonzero(row).tolist() for row in chosen])
+        if result is None:
+            print("警告: 時限への割り当てが人数制約を満たしません。通常のILPで再計算します...")
+            return self.solve_with_ilp()
+
+        print(f"✓ 段階2 完了（合計 {time.time() - start_time:.1f}秒）")
+        print(f"目的関数値: {objective:.2f}")
+
+        return result
+
+    @traced('build_model')
+    def build_selection_matrix(self, slack_penalty=None):
+        """
+        2段階分解の段階1（受講講座の選択）のモデルを組み立てる
+
+        列の並び: y[s,c]（s, c の順）, max_score, min_score
+        slack_penalty を指定すると、講座ごとの延べ人数の不足・超過を表す
+        連続変数 under[c], over[c] を末尾に追加し、1人あたり slack_penalty を
+        目的関数に加える（人数条件を満たせなくても必ず解が得られる）。
+
+        戻り値: (ModelMatrix, y の列番号配列 (生徒, 講座))
+        """
+        num_s = len(self.students)
+        num_c = len(self.courses)
+        num_p = self.num_periods
+        rank = self.rank_matrix
+
+        num_y = num_s * num_c
+        y_idx = np.arange(num_y, dtype=np.int64).reshape(num_s, num_c)
+        max_col = num_y
+        min_col = num_y + 1
+        num_slack = 0 if slack_penalty is None else 2 * num_c
+
+        model = ModelMatrix(num_y + 2 + num_slack)
+        model.col_upper[max_col:] = np.inf
+        model.integrality[max_col:] = False
+        model.col_cost[:num_y] = rank.ravel()
+        model.col_cost[max_col] = 10
+        model.col_cost[min_col] = -10
+
+        # 各生徒は num_periods 個の講座を受講
+        model.add_rows(y_idx, 1, num_p, num_p)
+
+        # 各講座の延べ人数（全時限の合計）
+        if slack_penalty is None and self.presolved is not None:
+            model.add_rows(y_idx.T, 1, self.presolved['lower'], self.presolved['upper'])
+            self._fix_presolved(model, y_idx)
+        elif slack_penalty is None:
+            model.add_rows(y_idx.T, 1, num_p * self.min_per_course, num_p * self.max_per_course)
+        else:
+            # Σs y[s,c] + under[c] - over[c] が P*min〜P*max に入る
+            under = np.arange(num_y + 2, num_y + 2 + num_c, dtype=np.int64)
+            over = under + num_c
+            model.col_cost[under] = slack_penalty
+            model.col_cost[over] = slack_penalty
+            model.add_rows(np.hstack([y_idx.T, under[:, None], over[:, None]]),
+                           np.hstack([np.ones(num_s), [1.0, -1.0]]),
+                           num_p * self.min_per_course, num_p * self.max_per_course)
+
+        # 公平性
+        self._add_fairness_rows(model, y_idx, rank, max_col, min_col)
+
+        return model, y_idx
+
+    def _period_course_counts(self, assignment):
+        """(生徒, 時限) の講座番号配列から各時限・各講座の人数 (時限, 講座) を数える"""
+        num_p = self.num_periods
+        counts = np.zeros((num_p, len(self.courses)), dtype=np.int64)
+        np.add.at(counts, (np.broadcast_to(np.arange(num_p), assignment.shape), assignment), 1)
+        return counts
+
+    @traced('assign_periods')
+    def _assign_course_sets(self, course_sets, preferred=None, kept=()):
+        """
+        生徒ごとの受講講座（講座番号のリスト）を時限に割り当てる
+
+        preferred は生徒ごとの希望時限 {講座番号: 時限（0始まり）}。指定すると、
+        辺彩色の結果を初期解にして希望時限から動く件数を最小にする（_keep_periods）。
+        kept の生徒の移動はほかの生徒の移動より優先して避ける。
+        各時限・各講座の人数が範囲外になった場合は None を返す。
+        """
+        assignment = assign_periods(course_sets, self.num_periods, preferred)
+
+        # 各時限・各講座の人数を検証
+        counts = self._period_course_counts(assignment)
+        if counts.min() < self.min_per_course or counts.max() > self.max_per_course:
+            return None
+
+        if preferred is not None:
+            assignment = self._keep_periods(np.asarray(course_sets, dtype=np.int64), preferred, assignment, kept)
+
+        return self._build_schedule(assignment)
+
+    def _keep_periods(self, course_sets, preferred, assignment, kept=()):
+        """
+        受講講座を時限に割り当て直し、希望時限から動く件数を最小にする
+
+        変数 x[s,i,p] = 1 なら生徒 s の i 番目の受講講座（course_sets[s, i]）を時限 p に置く。
+        各受講講座はちょうど1つの時限、各時限はちょうど1つの受講講座、各時限・各講座の
+        人数は min_per_course〜max_per_course。preferred[s] にある講座を別の時限に
+        置くごとに 1、kept の生徒ならほかの全員の移動の合計を上回るコストを課す。
+        assignment（辺彩色の結果、(生徒, 時限) の講座番号）を MIP スタートにし、
+        解けなければそれをそのまま返す。
+        """
+        num_s, num_p = course_sets.shape
+        x_idx = np.arange(num_s * num_p * num_p, dtype=np.int64).reshape(num_s, num_p, num_p)
+
+        model = ModelMatrix(x_idx.size)
+        wanted = np.array([[preferred[s].get(c, -1) if preferred[s] else -1 for c in row]
+                           for s, row in enumerate(course_sets.tolist())], dtype=np.int64).reshape(num_s, num_p)
+        moved = (wanted[:, :, None] >= 0) & (wanted[:, :, None] != np.arange(num_p))
+        weight = np.ones(num_s)
+        weight[np.asarray(kept, dtype=np.int64)] = num_s * num_p + 1
+        model.col_cost[:] = (weight[:, None, None] * moved).ravel()
+
+        # 各受講講座はちょうど1つの時限、各時限はちょうど1つの受講講座
+        model.add_rows(x_idx.reshape(num_s * num_p, num_p), 1, 1, 1)
+        model.add_rows(x_idx.transpose(0, 2, 1).reshape(num_s * num_p, num_p), 1, 1, 1)
+
+        # 各時限・各講座の人数
+        for c in range(len(self.courses)):
+            s_idx, i_idx = np.nonzero(course_sets == c)
+            if len(s_idx):
+                model.add_rows(x_idx[s_idx, i_idx].T, 1, self.min_per_course, self.max_per_course)
+
+        # slot[s, p] = 時限 p に置いた講座が course_sets[s] の何番目か
+        slot = np.argmax(course_sets[:, :, None] == assignment[:, None, :], axis=1)
+        initial = np.zeros(model.num_cols)
+        initial[x_idx[np.arange(num_s)[:, None], slot, np.arange(num_p)]] = 1
+
+        print(f"段階2: 前回の時限から動く件数を最小化中（辺彩色では {int(moved.ravel() @ initial)}件）...")
+        status, col_value, _ = self._solve_matrix(model, initial)
+        if col_value is None:
+            print(f"※ 時限の割り当てを解けなかったため（{status}）、辺彩色の結果を使います")
+            return assignment
+        print(f"前回の時限から動く件数: {int(moved.ravel() @ (col_value > 0.5))}件（{status}）")
+        chosen = col_value[x_idx].argmax(axis=1)
+        return np.take_along_axis(course_sets, chosen, axis=1)
+
+    @traced('extract')
+    def _build_schedule(self, assignment):
+        """(生徒, 時限) の講座番号配列から ScheduleResult を作る"""
+        return self.make_result(assignment=assignment)
+
+    def make_result(self, course_selection=None, schedule=None, assignment=None):
+        """
+        ScheduleResult を作る
+
+        assignment（(生徒, 時限) の講座番号配列）を渡すのが基本。従来の
+        course_selection と schedule（生徒番号 → {時限: 講座名}）を渡した場合は
+        schedule から assignment を作る（course_selection は schedule から求まるので使わない）。
+        """
+        if assignment is None:
+            assignment = [[self.course_index[schedule[student['id']][p]] if p in schedule[student['id']] else -1
+                           for p in range(1, self.num_periods + 1)]
+                          for student in self.students]
+        return ScheduleResult(self.students, self.courses, self.num_periods, assignment, self.student_index)
+
+    def solve_aggregated(self, chunk_size=None):
+        """
+        同じ希望リストの生徒をまとめて、グループごとの人数で最適配置を求める
+
+        既定（chunk_size=None）では、グループ g のうち受講講座の組 T（num_periods 個の講座の
+        組み合わせ）を受講する人数を整数変数 n[g,T] にした人数モデルを解く
+        （_build_set_count_matrix）。同じ希望の生徒どうしの対称性がなく、元のモデルと同じ
+        最適値になる。組の数が多く グループ数 × 組の数 の2倍が 生徒数 × 講座数 を超える場合は、
+        生徒1人ずつの枠（chunk_size=1、solve_decomposed と同じモデル）で解く。
+
+        chunk_size を指定すると、グループを chunk_size 人以下のほぼ同じ人数の「枠」に分け、
+        枠ごとに受講講座 y[k,c] を選ぶ（枠内の生徒は同じ講座を受講する。_build_slot_matrix）。
+        枠単位でしか人数を動かせないため、chunk_size > 1 では最適解より目的関数値が
+        悪くなることがある（その旨を表示する）。
+        時限への割り当ては solve_decomposed と同じく辺彩色で行う。
+        """
+        print("\n【希望パターン集約で最適化】")
+
+        print("問題を定式化中（グループ人数）...")
+        num_sets = math.comb(len(self.courses), self.num_periods)
+        if chunk_size is None and 2 * len(self.profile_groups) * num_sets > len(self.students) * len(self.courses):
+            print(f"※ 受講講座の組が {num_sets}通りと多いため、生徒1人ずつの枠で解きます")
+            chunk_size = 1
+        if chunk_size is None:
+            model, decode = self._build_set_count_matrix()
         else:
-            prob.solve()
+            if chunk_size > 1:
+                print(f"※ {chunk_size}人ずつの枠で同じ講座を受講させるため、最適解より悪くなることがあります")
+            model, decode = self._build_slot_matrix(chunk_size)
+        print(f"変数数: {model.num_cols}")
+        print(f"制約数: {model.num_rows}")
+        print("\n最適化を実行中（しばらくお待ちください）...")
+
+        start_time = time.time()
+        status, col_value, objective = self._solve_matrix(model)
         solve_time = time.time() - start_time
 
         print(f"\n✓ 求解完了（{solve_time:.1f}秒）")
-        print(f"ステータス: {LpStatus[prob.status]}")
+        self._print_status(status, col_value is not None)
 
-        if prob.status != 1:  # 1 = Optimal
+        if col_value is None:
             print("警告: 最適解が見つかりませんでした。制約を緩和して再試行します...")
             return self.solve_with_relaxed_constraints()
 
-        # 結果の抽出
-        course_selection = {student['id']: set() for student in self.students}
-        schedule = {student['id']: {} for student in self.students}
+        result = self._assign_course_sets(decode(col_value))
+        if result is None:
+            print("警告: 時限への割り当てが人数制約を満たしません。通常のILPで再計算します...")
+            return self.solve_with_ilp()
 
-        for s in students_idx:
-            student_id = self.students[s]['id']
-            for c in courses_idx:
-                for p in periods_idx:
-                    if value(x[s, c, p]) and value(x[s, c, p]) > 0.5:
-                        course_name = self.courses[c]
-                        course_selection[student_id].add(course_name)
-                        schedule[student_id][p] = course_name
+        print(f"目的関数値: {objective:.2f}")
 
-        # 目的関数の値
-        print(f"目的関数値: {value(prob.objective):.2f}")
+        return result
 
-        return course_selection, schedule
+    def _build_set_count_matrix(self):
+        """
+        solve_aggregated の既定の人数モデル
 
-    def solve_with_relaxed_constraints(self):
-        """制約を緩和して解を求める（フォールバック）"""
-        print("\n制約を緩和して再試行...")
+        列の並び: n[g,T]（グループ g で組 T を受講する人数、0〜グループの人数）,
+        u[g,T]（n[g,T] >= 1 なら 1）, max_score, min_score。
+        公平性は u[g,T] = 1 の組のスコアが min_score〜max_score に入ることで表す。
+
+        戻り値: (ModelMatrix, 列の値から生徒ごとの受講講座のリストを作る関数)
+        """
+        num_c = len(self.courses)
+        num_p = self.num_periods
+        groups = self.profile_groups
+        sizes = np.array([len(members) for members in groups], dtype=np.float64)
+        sets = np.array(list(itertools.combinations(range(num_c), num_p)), dtype=np.int64).reshape(-1, num_p)
+        set_score = self.rank_matrix[[members[0] for members in groups]][:, sets].sum(axis=2)
+
+        num_g, num_t = set_score.shape
+        n_idx = np.arange(num_g * num_t, dtype=np.int64).reshape(num_g, num_t)
+        u_idx = n_idx + n_idx.size
+        max_col = 2 * n_idx.size
+        min_col = max_col + 1
+
+        model = ModelMatrix(max_col + 2)
+        model.col_upper[n_idx] = sizes[:, None]
+        model.col_upper[[max_col, min_col]] = np.inf
+        model.integrality[[max_col, min_col]] = False
+        model.col_cost[n_idx] = set_score
+        model.col_cost[max_col] = 10
+        model.col_cost[min_col] = -10
+
+        # 各グループの全員がいずれかの組を受講
+        model.add_rows(n_idx, 1, sizes, sizes)
+
+        # 各講座の延べ人数（全時限の合計）。どの講座も同じ数の組に含まれる
+        contains = (sets[:, :, None] == np.arange(num_c)).any(axis=1)
+        model.add_rows(np.stack([n_idx[:, contains[:, c]].ravel() for c in range(num_c)]), 1,
+                       num_p * self.min_per_course, num_p * self.max_per_course)
+
+        # n[g,T] <= グループの人数 * u[g,T]
+        model.add_rows(np.stack([n_idx.ravel(), u_idx.ravel()], axis=1),
+                       np.stack([np.ones(n_idx.size), -np.repeat(sizes, num_t)], axis=1), -np.inf, 0)
+
+        # 公平性: u[g,T] = 1 なら score - max_score <= 0、min_score <= score
+        big = num_p * (self.num_choices + 1)
+        score = set_score.ravel().astype(np.float64)
+        model.add_rows(np.stack([u_idx.ravel(), np.full(n_idx.size, max_col)], axis=1),
+                       np.stack([score, -np.ones(n_idx.size)], axis=1), -np.inf, 0)
+        model.add_rows(np.stack([u_idx.ravel(), np.full(n_idx.size, min_col)], axis=1),
+                       np.stack([np.full(n_idx.size, float(big)), np.ones(n_idx.size)], axis=1),
+                       -np.inf, score + big)
+
+        print(f"グループ数: {num_g}（受講講座の組: {num_t}通り）")
+
+        def decode(col_value):
+            counts = np.rint(col_value[n_idx]).astype(np.int64)
+            course_sets = [None] * len(self.students)
+            for g, members in enumerate(groups):
+                students = iter(members)
+                for t in np.flatnonzero(counts[g]):
+                    for _ in range(counts[g, t]):
+                        course_sets[next(students)] = sets[t].tolist()
+            return course_sets
+
+        return model, decode
+
+    def _build_slot_matrix(self, chunk_size):
+        """
+        solve_aggregated の枠モデル（グループを chunk_size 人以下の枠に分ける）
+
+        講座の延べ人数は Σk size[k] * y[k,c] で表すため、変数の数は生徒数ではなく
+        枠の数に比例する。公平性（max_score, min_score）は各枠のスコアに課すので、
+        全生徒のスコアがその範囲に収まる点は元のモデルと同じ。
+
+        戻り値: (ModelMatrix, 列の値から生徒ごとの受講講座のリストを作る関数)
+        """
+        num_c = len(self.courses)
+        num_p = self.num_periods
+        rank = self.rank_matrix
+
+        # 枠の一覧: (グループ番号, 人数)
+        slot_group = []
+        slot_size = []
+        for g, members in enumerate(self.profile_groups):
+            num_slots = -(-len(members) // chunk_size)
+            base, extra = divmod(len(members), num_slots)
+            slot_group.extend([g] * num_slots)
+            slot_size.extend([base + 1] * extra + [base] * (num_slots - extra))
+        slot_rank = rank[[members[0] for members in self.profile_groups]][slot_group]
+        slot_size = np.asarray(slot_size, dtype=np.float64)
+
+        num_slots = len(slot_size)
+        num_y = num_slots * num_c
+        y_idx = np.arange(num_y, dtype=np.int64).reshape(num_slots, num_c)
+        max_col = num_y
+        min_col = num_y + 1
+
+        model = ModelMatrix(num_y + 2)
+        model.col_upper[[max_col, min_col]] = np.inf
+        model.integrality[[max_col, min_col]] = False
+        model.col_cost[:num_y] = (slot_rank * slot_size[:, None]).ravel()
+        model.col_cost[max_col] = 10
+        model.col_cost[min_col] = -10
+
+        # 各枠の生徒は num_periods 個の講座を受講
+        model.add_rows(y_idx, 1, num_p, num_p)
+
+        # 各講座の延べ人数（全時限の合計）
+        model.add_rows(y_idx.T, np.broadcast_to(slot_size, (num_c, num_slots)),
+                       num_p * self.min_per_course, num_p * self.max_per_course)
+
+        # 公平性（各枠のスコア）
+        self._add_fairness_rows(model, y_idx, slot_rank, max_col, min_col)
+
+        print(f"グループ数: {len(self.profile_groups)}（枠数: {num_slots}）")
+
+        def decode(col_value):
+            # グループの生徒を枠の人数どおりに振り分けて、生徒ごとの受講講座に展開
+            slot_courses = [np.flatnonzero(row).tolist() for row in col_value[y_idx] > 0.5]
+            course_sets = [None] * len(self.students)
+            members = iter([])
+            current = -1
+            for k, g in enumerate(slot_group):
+                if g != current:
+                    members = iter(self.profile_groups[g])
+                    current = g
+                for _ in range(int(slot_size[k])):
+                    course_sets[next(members)] = slot_courses[k]
+            return course_sets
+
+        return model, decode
+
+    def solve_heuristic(self, time_limit=1.0, seed=None):
+        """
+        貪欲法＋局所探索（heuristic_course_sets）で配置を求める
+
+        最適性の保証はないが、ILPを解かないため生徒数が多くても数秒で終わる。
+        時限への割り当ては solve_decomposed と同じく辺彩色で行う。
+        seed が None なら self.seed（それも None なら 0）を使う。
+        """
+        print("\n【ヒューリスティック（貪欲法＋局所探索）で求解】")
+
+        start_time = time.time()
+        course_sets = self._heuristic_course_sets(time_limit, seed)
+        if course_sets is None:
+            print("警告: 人数の範囲を満たす配置が見つかりませんでした。制約を緩和して再試行します...")
+            return self.solve_with_relaxed_constraints()
+
+        result = self._assign_course_sets(course_sets.tolist())
+        if result is None:
+            print("警告: 時限への割り当てが人数制約を満たしません。通常のILPで再計算します...")
+            return self.solve_with_ilp()
+
+        scores = np.take_along_axis(self.rank_matrix, course_sets, axis=1).sum(axis=1)
+        objective = scores.sum() + 10 * (scores.max() - scores.min())
+        print(f"\n✓ 求解完了（{time.time() - start_time:.1f}秒）")
+        print(f"目的関数値: {objective:.2f}")
+
+        return result
 
-        prob = LpProblem("StudentScheduler_Relaxed", LpMinimize)
+    @traced('optimize')
+    def solve_incremental(self, previous, previous_preferences=None, move_penalty=None):
+        """
+        前回の配置結果を元に再計算する（アンケートの一部の修正・転入・転出向け）
+
+        previous: 前回の配置 {生徒番号: [1限の講座名, ...]}（load_previous_schedule の戻り値）
+        previous_preferences: 前回の希望 {生徒番号: [第1希望, ...]}。指定すると
+                              希望を書き換えた生徒を「変更あり」として扱う
+        move_penalty: 変更の無い生徒が前回の講座を1つ手放すごとのペナルティ
+                      （None なら 11 * (num_choices + 1)、0 なら移動を妨げない）
+
+        前回と今回の生徒を突き合わせて追加・削除・変更ありの生徒を求め、段階1
+        （build_selection_matrix）の y[s,c] のうち変更の無い生徒の前回の講座の係数から
+        move_penalty を引く（前回の講座を手放すとその分だけ目的関数が悪化する）。
+        既定のペナルティは1人の講座を1つ動かしたときの希望順位・公平性ペナルティの
+        変化を上回るので、人数条件や追加・変更の生徒のために必要な分しか動かさない。
+        self.fairness の方式で解く（_solve_fair。minimax・profile ではペナルティを最後の段階に足す）。
+        前回の配置（追加・変更ありの生徒は希望上位）を人数条件に合うよう修復したものを
+        MIPスタートにする。時限への割り当ても、前回の時限から動く件数を最小にする
+        ILP（_keep_periods、変更の無い生徒の移動を最優先で避ける）で解く。
+        """
+        print("\n【前回の配置からの再計算】")
+
+        num_p = self.num_periods
+        if move_penalty is None:
+            move_penalty = 11 * (self.num_choices + 1)
+
+        # 前回との差分
+        added, changed, kept, kept_cols = [], [], [], []
+        preferred = [None] * len(self.students)
+        for s, student in enumerate(self.students):
+            student_id = student['id']
+            if student_id not in previous:
+                added.append(s)
+                continue
+            cols = [self.course_index.get(course) for course in previous[student_id][:num_p]]
+            preferred[s] = {c: p for p, c in enumerate(cols) if c is not None}
+            if (len(preferred[s]) < num_p
+                    or (previous_preferences is not None
+                        and tuple(previous_preferences.get(student_id, ())) != tuple(student['preferences']))):
+                changed.append(s)
+            else:
+                kept.append(s)
+                kept_cols.append(cols)
+        removed = [student_id for student_id in previous if student_id not in self.student_index]
+
+        print(f"追加: {len(added)}名 / 削除: {len(removed)}名 / "
+              f"変更あり: {len(changed)}名 / 変更なし: {len(kept)}名")
+        for label, ids in (("追加", [self.students[s]['id'] for s in added]), ("削除", removed),
+                           ("変更あり", [self.students[s]['id'] for s in changed])):
+            if ids:
+                more = f" ほか{len(ids) - 10}名" if len(ids) > 10 else ""
+                print(f"  {label}: {', '.join(ids[:10])}{more}")
+
+        kept = np.asarray(kept, dtype=np.int64)
+        kept_cols = np.asarray(kept_cols, dtype=np.int64).reshape(len(kept), num_p)
+
+        if not self.presolve(self.rank_cap if self.fairness == 'cap' else None):
+            print("制約を緩和して計算します...")
+            return self.solve_with_relaxed_constraints()
+
+        model, y_idx = self.build_selection_matrix()
+        max_col, min_col = y_idx.size, y_idx.size + 1
+        move_cost = np.zeros(model.num_cols)
+        move_cost[y_idx[kept[:, None], kept_cols]] = -move_penalty
+        model.col_cost += move_cost
+
+        print(f"変数数: {model.num_cols}")
+        print(f"制約数: {model.num_rows}")
+
+        # 前回の配置を人数条件に合うよう修復して MIP スタートにする
+        course_sets = np.argsort(self.rank_matrix, axis=1, kind='stable')[:, :num_p]
+        course_sets[kept] = kept_cols
+        course_sets = heuristic_course_sets(self.rank_matrix, num_p,
+                                            num_p * self.min_per_course, num_p * self.max_per_course,
+                                            time_limit=0, initial=course_sets)
+        initial = None
+        if course_sets is not None:
+            initial = self._selection_start(course_sets, y_idx, max_col, min_col, model.num_cols)
+            print("初期解: 前回の配置をMIPスタートに設定しました")
+        if move_penalty:
+            print(f"※ 暫定解の目的関数値は、前回の講座を保つごとに {move_penalty:g} を引いた値です")
+
+        print("\n最適化を実行中...")
+
+        start_time = time.time()
+        status, col_value, _ = self._solve_fair(model, y_idx, max_col, min_col, initial, move_cost=move_cost)
+
+        print(f"\n✓ 求解完了（{time.time() - start_time:.1f}秒）")
+        self._print_status(status, col_value is not None)
+
+        if col_value is None:
+            print("警告: 最適解が見つかりませんでした。制約を緩和して再試行します...")
+            return self.solve_with_relaxed_constraints()
+
+        chosen = col_value[y_idx] > 0.5
+        result = self._assign_course_sets([np.flatnonzero(row).tolist() for row in chosen], preferred, kept)
+        if result is None:
+            print("警告: 時限への割り当てが人数制約を満たしません。通常のILPで再計算します...")
+            return self.solve_with_ilp()
+
+        # 変更の無い生徒の移動を集計
+        assignment = result.assignment
+        same_period = (assignment[kept] == kept_cols).all(axis=1)
+        same_courses = (np.sort(assignment[kept], axis=1) == np.sort(kept_cols, axis=1)).all(axis=1)
+        print(f"変更なしの生徒 {len(kept)}名のうち: 講座が変わった生徒 {int((~same_courses).sum())}名、"
+              f"時限だけ変わった生徒 {int((same_courses & ~same_period).sum())}名")
+
+        summary = self.statistics(result)['summary']
+        print(f"目的関数値（{summary['fairness']}）: {format_objective(summary['objective'])}")
+
+        return result
+
+    @traced('heuristic')
+    def _heuristic_course_sets(self, time_limit=1.0, seed=None):
+        """
+        heuristic_course_sets を現在の人数条件で呼び出す
+
+        self.parallel が 'deterministic' なら局所探索を時間ではなく調べる生徒の延べ数で打ち切り、
+        実行環境の速さによらず同じ解にする。延べ数は time_limit から見積もる
+        （time_limit * HEURISTIC_STEP_RATE / 生徒数、多くても生徒数 × HEURISTIC_PASSES）。
+        """
+        num_p = self.num_periods
+        if seed is None:
+            seed = 0 if self.seed is None else self.seed
+        max_steps = None
+        if self.parallel == 'deterministic':
+            num_s = len(self.students)
+            max_steps = min(HEURISTIC_PASSES * num_s, max(1, int(time_limit * HEURISTIC_STEP_RATE / num_s)))
+            time_limit = None
+        return heuristic_course_sets(self.rank_matrix, num_p,
+                                     num_p * self.min_per_course, num_p * self.max_per_course,
+                                     time_limit=time_limit, seed=seed, max_steps=max_steps)
+
+    def _heuristic_start(self, y_idx, max_col, min_col, num_cols, time_limit=1.0):
+        """
+        ヒューリスティック解から y[s,c], max_score, min_score の初期解（MIPスタート）を作る
+
+        戻り値: (列の値の配列, (生徒, 時限) の講座番号配列)。解が無ければ (None, None)
+        """
+        course_sets = self._heuristic_course_sets(time_limit)
+        if course_sets is None:
+            return None, None
+        return self._selection_start(course_sets, y_idx, max_col, min_col, num_cols), course_sets
+
+    def _selection_start(self, course_sets, y_idx, max_col, min_col, num_cols):
+        """(生徒, 時限) の講座番号配列から y[s,c], max_score, min_score の列の値を作る"""
+        scores = np.take_along_axis(self.rank_matrix, course_sets, axis=1).sum(axis=1)
+        initial = np.zeros(num_cols)
+        initial[np.take_along_axis(y_idx, course_sets, axis=1)] = 1
+        initial[max_col] = scores.max()
+        initial[min_col] = scores.min()
+        return initial
+
+    def _solve_with_matrix(self, warm_start=True, engine=None):
+        """疎行列モデルを求解エンジン（既定は highspy）で解く"""
+        print("問題を定式化中（疎行列）...")
+        model, x_idx = self.build_ilp_matrix()
+
+        print(f"変数数: {model.num_cols}")
+        print(f"制約数: {model.num_rows}")
+        print(f"非ゼロ要素数: {model.num_nonzeros}")
+
+        initial = None
+        if warm_start:
+            initial = self._ilp_start(model, x_idx)
+            if initial is not None:
+                print("初期解: ヒューリスティック解をMIPスタートに設定しました")
+
+        print("\n最適化を実行中（しばらくお待ちください）...")
 
+        num_s, num_c, _ = x_idx.shape
+        y_idx = x_idx.size + np.arange(num_s * num_c, dtype=np.int64).reshape(num_s, num_c)
+        max_col = x_idx.size + y_idx.size
+
+        start_time = time.time()
+        status, col_value, objective = self._solve_fair(model, y_idx, max_col, max_col + 1, initial, engine)
+        solve_time = time.time() - start_time
+
+        print(f"\n✓ 求解完了（{solve_time:.1f}秒）")
+        self._print_status(status, col_value is not None)
+
+        if col_value is None:
+            print("警告: 最適解が見つかりませんでした。制約を緩和して再試行します...")
+            return self.solve_with_relaxed_constraints()
+
+        print(f"目的関数値: {objective:.2f}")
+
+        return self.extract_ilp_result(col_value, x_idx)
+
+    def _ilp_start(self, model, x_idx):
+        """ヒューリスティック解から build_ilp_matrix のモデルの MIP スタートを作る（無ければ None）"""
+        num_s, num_c, num_p = x_idx.shape
+        y_idx = x_idx.size + np.arange(num_s * num_c, dtype=np.int64).reshape(num_s, num_c)
+        max_col = x_idx.size + num_s * num_c
+        initial, course_sets = self._heuristic_start(y_idx, max_col, max_col + 1, model.num_cols)
+        if initial is not None:
+            assignment = assign_periods(course_sets.tolist(), num_p)
+            initial[x_idx[np.arange(num_s)[:, None], assignment, np.arange(num_p)]] = 1
+        return initial
+
+    def extract_ilp_result(self, col_value, x_idx):
+        """
+        build_ilp_matrix のモデルの解（列の値）から ScheduleResult を作る
+
+        x_idx は x[s,c,p] の列番号配列 (生徒, 講座, 時限)。各生徒は各時限でちょうど1講座を
+        受講するので、講座の軸の argmax がその時限の講座番号になる。
+        """
+        chosen = col_value[x_idx] > 0.5
+        return self._build_schedule(chosen.argmax(axis=1))
+
+    def _solve_with_pulp(self):
+        """PuLPの変数オブジェクトで定式化して解く"""
+        from pulp import LpProblem, LpMinimize, LpVariable, LpBinary, lpSum, LpStatus, \
+            LpSolutionIntegerFeasible, value
+
+        print("問題を定式化中...")
+
+        # 問題の作成
+        prob = LpProblem("StudentScheduler", LpMinimize)
+
+        # インデックス
         students_idx = range(len(self.students))
         courses_idx = range(len(self.courses))
         periods_idx = range(1, self.num_periods + 1)
 
-        x = {}
-        for s in students_idx:
-            for c in courses_idx:
+        with self.profiler.span('variables'):
+            # 決定変数: x[s][c][p] = 1 if student s takes course c in period p
+            x = {}
+            for s in students_idx:
+                for c in courses_idx:
+                    for p in periods_idx:
+                        x[s, c, p] = LpVariable(f"x_{s}_{c}_{p}", cat=LpBinary)
+
+            # 補助変数: y[s][c] = 1 if student s takes course c (any period)
+            y = {}
+            for s in students_idx:
+                for c in courses_idx:
+                    y[s, c] = LpVariable(f"y_{s}_{c}", cat=LpBinary)
+
+            # 公平性のための補助変数
+            max_score = LpVariable("max_score", lowBound=0)
+            min_score = LpVariable("min_score", lowBound=0)
+
+        with self.profiler.span('constraints'):
+            # 各生徒のスコア（希望順位の合計）
+            student_scores = {}
+            for s in students_idx:
+                student_scores[s] = lpSum(
+                    int(self.rank_matrix[s, c]) * y[s, c]
+                    for c in courses_idx
+                )
+
+            print("目的関数を設定中...")
+
+            # 目的関数: 希望順位の合計 + 公平性ペナルティ
+            total_preference_score = lpSum(student_scores[s] for s in students_idx)
+            fairness_penalty = (max_score - min_score) * 10
+
+            prob += total_preference_score + fairness_penalty, "Total_Cost"
+
+            print("制約条件を追加中...")
+
+            # 制約1: 各生徒は各時限で1つの講座を受講
+            for s in students_idx:
                 for p in periods_idx:
-                    x[s, c, p] = LpVariable(f"x_{s}_{c}_{p}", cat=LpBinary)
-
-        # 目的関数（公平性ペナルティなし）
-        prob += lpSum(
-            self.get_preference_rank(self.students[s], self.courses[c]) * x[s, c, p]
-            for s in students_idx
-            for c in courses_idx
-            for p in periods_idx
-        ), "Total_Preference"
-
-        # 制約1: 各生徒は各時限で1つの講座
-        for s in students_idx:
+                    prob += lpSum(x[s, c, p] for c in courses_idx) == 1, f"OnePerPeriod_s{s}_p{p}"
+
+            # 制約2: 各生徒は各講座を最大1回受講
+            for s in students_idx:
+                for c in courses_idx:
+                    prob += lpSum(x[s, c, p] for p in periods_idx) <= 1, f"MaxOnce_s{s}_c{c}"
+
+            # 制約3: y[s,c]とx[s,c,p]の関係
+            for s in students_idx:
+                for c in courses_idx:
+                    prob += y[s, c] == lpSum(x[s, c, p] for p in periods_idx), f"Link_y_x_s{s}_c{c}"
+
+            # 制約4: 各時限の各講座の人数バランス
             for p in periods_idx:
-                prob += lpSum(x[s, c, p] for c in courses_idx) == 1
-
-        # 制約2: 各生徒は各講座を最大1回
-        for s in students_idx:
-            for c in courses_idx:
-                prob += lpSum(x[s, c, p] for p in periods_idx) <= 1
-
-        # 制約3: 人数バランス（緩和）
-        relaxed_min = max(0, self.min_per_course - 5)
-        relaxed_max = self.max_per_course + 5
-        for p in periods_idx:
-            for c in courses_idx:
-                count = lpSum(x[s, c, p] for s in students_idx)
-                prob += count >= relaxed_min
-                prob += count <= relaxed_max
-
-        solver = get_solver()
-        if solver:
-            prob.solve(solver)
+                for c in courses_idx:
+                    count = lpSum(x[s, c, p] for s in students_idx)
+                    prob += count >= self.min_per_course, f"MinBalance_p{p}_c{c}"
+                    prob += count <= self.max_per_course, f"MaxBalance_p{p}_c{c}"
+
+            # 制約5: 公平性（max_score, min_score）
+            for s in students_idx:
+                prob += student_scores[s] <= max_score, f"MaxScore_s{s}"
+                prob += student_scores[s] >= min_score, f"MinScore_s{s}"
+
+        print(f"変数数: {len(prob.variables())}")
+        print(f"制約数: {len(prob.constraints)}")
+        print("\n最適化を実行中（しばらくお待ちください）...")
+
+        # 求解
+        start_time = time.time()
+        with self.profiler.span('solve'):
+            solver = get_solver(self.solve_time_limit(), self.mip_gap, self.threads, self.seed, self.parallel)
+            if solver:
+                prob.solve(solver)
+            else:
+                prob.solve()
+        solve_time = time.time() - start_time
+
+        print(f"\n✓ 求解完了（{solve_time:.1f}秒）")
+        if prob.status == 1 and prob.sol_status == LpSolutionIntegerFeasible:
+            self._print_status("Time limit reached", True)
         else:
-            prob.solve()
+            print(f"ステータス: {LpStatus[prob.status]}")
 
-        if prob.status != 1:
-            raise ValueError("最適化に失敗しました。入力データを確認してください。")
+        if prob.status != 1:  # 1 = Optimal（制限時間到達時の暫定解を含む）
+            print("警告: 最適解が見つかりませんでした。制約を緩和して再試行します...")
+            return self.solve_with_relaxed_constraints()
 
-        course_selection = {student['id']: set() for student in self.students}
-        schedule = {student['id']: {} for student in self.students}
+        # 目的関数の値
+        print(f"目的関数値: {value(prob.objective):.2f}")
 
-        for s in students_idx:
-            student_id = self.students[s]['id']
-            for c in courses_idx:
-                for p in periods_idx:
-                    if value(x[s, c, p]) and value(x[s, c, p]) > 0.5:
-                        course_name = self.courses[c]
-                        course_selection[student_id].add(course_name)
-                        schedule[student_id][p] = course_name
+        # 結果の抽出: x は (生徒, 講座, 時限) の順に作ったので、値を1回で並べれば
+        # build_ilp_matrix の列の値と同じ形になる
+        x_idx = np.arange(len(x), dtype=np.int64).reshape(len(students_idx), len(courses_idx), len(periods_idx))
+        col_value = np.fromiter((var.varValue or 0.0 for var in x.values()), dtype=float, count=len(x))
+        return self.extract_ilp_result(col_value, x_idx)
 
-        return course_selection, schedule
+    @staticmethod
+    def _print_status(status, has_solution):
+        """ソルバーのステータスを表示（最適性未証明の暫定解ならその旨も）"""
+        print(f"ステータス: {status}")
+        if status != 'Optimal' and has_solution:
+            print("※ 最適性は未証明です。制限時間内に見つかった最良の暫定解を使用します")
 
-    def save_results(self, course_selection, schedule):
-        """結果をExcelファイルに保存"""
-        wb = openpyxl.Workbook()
+    def solve_with_relaxed_constraints(self):
+        """
+        人数制約をソフト制約にして解を求める（フォールバック）
+
+        段階1のモデル（build_selection_matrix）の講座ごとの延べ人数に
+        不足・超過のスラック変数を加え、人数のずれ1人あたりにペナルティを課す。
+        ずれの合計が最小でない配置は、1人の講座を1つ移すだけでずれを1減らせる
+        （その際の希望順位の変化は num_choices 以下、公平性ペナルティの変化は
+        10 * num_choices 以下）。ペナルティをそれより大きくしておけば、ずれの合計が
+        最小になる配置の中で元の目的関数を最小化した解が1回の求解で得られる。
+        時限への割り当ては辺彩色で行うので、各時限のずれの合計は
+        講座の延べ人数のずれと一致する。
+
+        人数範囲を外れた時限・講座は self.violations に
+        {'period', 'course', 'count', 'amount'}（amount は不足なら負、超過なら正）
+        の辞書のリストとして記録する。
+        """
+        print("\n人数制約をソフト制約にして再計算...")
 
-        # 共通スタイル定義
-        header_fill = PatternFill(start_color='4472C4', end_color='4472C4', fill_type='solid')
-        header_font = Font(bold=True, color='FFFFFF', size=11)
-        subheader_fill = PatternFill(start_color='D9E1F2', end_color='D9E1F2', fill_type='solid')
-        good_fill = PatternFill(start_color='C6EFCE', end_color='C6EFCE', fill_type='solid')
-        warning_fill = PatternFill(start_color='FFEB9C', end_color='FFEB9C', fill_type='solid')
-        bad_fill = PatternFill(start_color='FFC7CE', end_color='FFC7CE', fill_type='solid')
-        border = Border(
-            left=Side(style='thin'), right=Side(style='thin'),
-            top=Side(style='thin'), bottom=Side(style='thin')
-        )
-        center_align = Alignment(horizontal='center', vertical='center')
-        left_align = Alignment(horizontal='left', vertical='center')
+        num_p = self.num_periods
+        if num_p > len(self.courses):
+            raise ValueError(f"受講する講座数（{num_p}）が講座の種類数（{len(self.courses)}）を超えています。")
 
-        # ========== シート1: 生徒×時限配置結果 ==========
-        ws_result = wb.active
-        ws_result.title = "生徒別配置結果"
+        # 1人の移動による希望順位・公平性ペナルティの変化を上回るペナルティ
+        slack_penalty = 11 * (self.num_choices + 1)
 
-        headers = ['生徒番号', '氏名'] + [f'{i}限' for i in range(1, self.num_periods + 1)]
-        for col, header in enumerate(headers, 1):
-            cell = ws_result.cell(1, col, header)
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.border = border
-            cell.alignment = center_align
+        model, y_idx = self.build_selection_matrix(slack_penalty)
+        print(f"変数数: {model.num_cols}")
+        print(f"制約数: {model.num_rows}")
 
-        sorted_students = sorted(self.students, key=lambda s: s['id'])
+        start_time = time.time()
+        self.applied_fairness = 'weighted'
+        status, col_value, _ = self._solve_matrix(model)
 
-        for row_idx, student in enumerate(sorted_students, 2):
-            cell = ws_result.cell(row_idx, 1, student['id'])
-            cell.border = border
-            cell.alignment = center_align
+        print(f"\n✓ 求解完了（{time.time() - start_time:.1f}秒）")
+        self._print_status(status, col_value is not None)
 
-            cell = ws_result.cell(row_idx, 2, student['name'])
-            cell.border = border
-            cell.alignment = left_align
+        if col_value is None:
+            if self.time_limit is not None:
+                raise ValueError("制限時間内に解が見つかりませんでした。制限時間を長くしてください。")
+            raise ValueError("最適化に失敗しました。入力データを確認してください。")
 
-            for period in range(1, self.num_periods + 1):
-                course = schedule[student['id']].get(period, '')
-                cell = ws_result.cell(row_idx, 2 + period, course)
-                cell.border = border
-                cell.alignment = left_align
+        chosen = col_value[y_idx] > 0.5
+        assignment = assign_periods([np.flatnonzero(row).tolist() for row in chosen], num_p)
+
+        # 人数範囲を外れた時限・講座を記録
+        counts = self._period_course_counts(assignment)
+        self.violations = []
+        for p, c in zip(*np.nonzero((counts < self.min_per_course) | (counts > self.max_per_course))):
+            count = int(counts[p, c])
+            amount = count - self.min_per_course if count < self.min_per_course else count - self.max_per_course
+            self.violations.append({'period': int(p) + 1, 'course': self.courses[c],
+                                    'count': count, 'amount': amount})
+
+        if self.violations:
+            print(f"警告: {len(self.violations)}か所で人数範囲（{self.min_per_course}〜{self.max_per_course}名）を外れています")
+            for v in self.violations:
+                kind = "不足" if v['amount'] < 0 else "超過"
+                print(f"  {v['period']}時限 {v['course']}: {v['count']}名（{abs(v['amount'])}名{kind}）")
+        else:
+            print("✓ 人数範囲を満たす配置が見つかりました")
 
-                rank = self.get_preference_rank(student, course)
-                if rank <= 2:
-                    cell.fill = good_fill
-                elif rank <= 4:
-                    cell.fill = warning_fill
-                elif rank <= self.num_choices:
-                    cell.fill = bad_fill
+        return self._build_schedule(assignment)
+
+    @traced('save_results')
+    def save_results(self, result, schedule=None):
+        """
+        結果をExcelファイルに保存
+
+        result: ScheduleResult（従来の (course_selection, schedule) の2引数も受け付ける）
+
+        書き込み専用モードのブックに行を順に追加していく（セルをすべてメモリに
+        保持しない）。書式は名前付きスタイルとして1回だけ登録し、各セルはその
+        名前を参照する。名前からスタイルを引く処理はスタイルごとに1回だけ行い
+        （見本のセル）、各セルには見本のセルの書式をコピーする。
+        """
+        if schedule is not None:
+            result = self.make_result(result, schedule)
+        schedule = result.schedule
+
+        from copy import copy
+        import openpyxl
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.utils import get_column_letter
+
+        wb = openpyxl.Workbook(write_only=True)
+        for style in result_styles():
+            wb.add_named_style(style)
+
+        # スタイル名 → その名前付きスタイルを適用した見本のセル
+        prototypes = {}
+
+        def styled(ws, value, style):
+            prototype = prototypes.get(style)
+            if prototype is None:
+                prototype = prototypes[style] = WriteOnlyCell(ws)
+                prototype.style = style
+            cell = WriteOnlyCell(ws, value)
+            cell._style = copy(prototype._style)
+            return cell
+
+        # ========== シート1: 生徒×時限配置結果 ==========
+        ws_result = wb.create_sheet("生徒別配置結果")
 
         ws_result.column_dimensions['A'].width = 12
         ws_result.column_dimensions['B'].width = 15
         for col in range(3, 3 + self.num_periods):
             ws_result.column_dimensions[get_column_letter(col)].width = 18
 
+        headers = ['生徒番号', '氏名'] + [f'{i}限' for i in range(1, self.num_periods + 1)]
+        ws_result.append([styled(ws_result, header, '配置_見出し') for header in headers])
+
+        sorted_students = sorted(self.students, key=lambda s: s['id'])
+
+        for student in sorted_students:
+            s = self.student_index[student['id']]
+            row = [styled(ws_result, student['id'], '配置_中央'),
+                   styled(ws_result, student['name'], '配置_左')]
+            periods = schedule[student['id']]
+            for period in range(1, self.num_periods + 1):
+                course = periods.get(period, '')
+                rank = self.rank_of(s, course)
+                if rank <= 2:
+                    style = '配置_左_良'
+                elif rank <= 4:
+                    style = '配置_左_注意'
+                elif rank <= self.num_choices:
+                    style = '配置_左_不良'
+                else:
+                    style = '配置_左'
+                row.append(styled(ws_result, course, style))
+            ws_result.append(row)
+
         # ========== シート2: 講座別名簿 ==========
         ws_roster = wb.create_sheet("講座別名簿")
 
+        # 各ブロック（時限・講座）の開始列と名簿を先に求め、行ごとに書き出す
+        blocks = []
         col_offset = 0
         for period in range(1, self.num_periods + 1):
             for course in self.courses:
-                start_col = col_offset + 1
-                cell = ws_roster.cell(1, start_col, f"【{period}限】{course}")
-                cell.font = Font(bold=True, size=11, color='FFFFFF')
-                cell.fill = header_fill
-                cell.alignment = center_align
-                cell.border = border
-                ws_roster.merge_cells(start_row=1, start_column=start_col,
-                                       end_row=1, end_column=start_col + 1)
-                ws_roster.cell(1, start_col + 1).border = border
-
-                ws_roster.cell(2, start_col, '生徒番号').fill = subheader_fill
-                ws_roster.cell(2, start_col, '生徒番号').border = border
-                ws_roster.cell(2, start_col, '生徒番号').alignment = center_align
-                ws_roster.cell(2, start_col + 1, '氏名').fill = subheader_fill
-                ws_roster.cell(2, start_col + 1, '氏名').border = border
-                ws_roster.cell(2, start_col + 1, '氏名').alignment = center_align
-
-                course_students = [s for s in self.students
-                                   if schedule[s['id']].get(period) == course]
-                course_students.sort(key=lambda s: s['id'])
-
-                for row_idx, student in enumerate(course_students, 3):
-                    ws_roster.cell(row_idx, start_col, student['id']).border = border
-                    ws_roster.cell(row_idx, start_col).alignment = center_align
-                    ws_roster.cell(row_idx, start_col + 1, student['name']).border = border
-                    ws_roster.cell(row_idx, start_col + 1).alignment = left_align
-
-                count_row = max(len(course_students) + 3, 4)
-                ws_roster.cell(count_row, start_col, f"計: {len(course_students)}名")
-                ws_roster.cell(count_row, start_col).font = Font(bold=True)
-
-                ws_roster.column_dimensions[get_column_letter(start_col)].width = 10
-                ws_roster.column_dimensions[get_column_letter(start_col + 1)].width = 12
+                blocks.append((col_offset, period, course, result.roster[period, course]))
 
+                ws_roster.column_dimensions[get_column_letter(col_offset + 1)].width = 10
+                ws_roster.column_dimensions[get_column_letter(col_offset + 2)].width = 12
+                ws_roster.merged_cells.add(f"{get_column_letter(col_offset + 1)}1:"
+                                           f"{get_column_letter(col_offset + 2)}1")
                 col_offset += 3
 
             col_offset += 1
 
+        num_cols = max(offset for offset, *_ in blocks) + 2
+        header_row = [None] * num_cols
+        subheader_row = [None] * num_cols
+        for offset, period, course, _ in blocks:
+            header_row[offset] = styled(ws_roster, f"【{period}限】{course}", '配置_名簿見出し')
+            header_row[offset + 1] = styled(ws_roster, None, '配置_枠線')
+            subheader_row[offset] = styled(ws_roster, '生徒番号', '配置_小見出し')
+            subheader_row[offset + 1] = styled(ws_roster, '氏名', '配置_小見出し')
+        ws_roster.append(header_row)
+        ws_roster.append(subheader_row)
+
+        last_row = max(max(len(course_students) + 3, 4) for *_, course_students in blocks)
+        for row_idx in range(3, last_row + 1):
+            row = [None] * num_cols
+            for offset, _, _, course_students in blocks:
+                i = row_idx - 3
+                if i < len(course_students):
+                    row[offset] = styled(ws_roster, course_students[i]['id'], '配置_中央')
+                    row[offset + 1] = styled(ws_roster, course_students[i]['name'], '配置_左')
+                elif row_idx == max(len(course_students) + 3, 4):
+                    row[offset] = styled(ws_roster, f"計: {len(course_students)}名", '配置_太字')
+            ws_roster.append(row)
+
         # ========== シート3: 希望達成度 ==========
         ws_stats = wb.create_sheet("希望達成度")
 
+        ws_stats.column_dimensions['A'].width = 12
+        ws_stats.column_dimensions['B'].width = 15
+        ws_stats.column_dimensions['C'].width = 12
+        ws_stats.column_dimensions['D'].width = 12
+        for col in range(5, 6 + self.num_choices):
+            ws_stats.column_dimensions[get_column_letter(col)].width = 10
+
         stat_headers = ['生徒番号', '氏名', '満足度', '平均順位'] + \
                        [f'第{i}希望' for i in range(1, self.num_choices + 1)] + ['希望外']
-        for col, header in enumerate(stat_headers, 1):
-            cell = ws_stats.cell(1, col, header)
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.border = border
-            cell.alignment = center_align
-
-        student_stats = []
-        for student in sorted_students:
-            rank_counts = defaultdict(int)
-            total_rank = 0
-            count = 0
-
-            selected = course_selection.get(student['id'], set())
-            for course in selected:
-                rank = self.get_preference_rank(student, course)
-                if rank <= self.num_choices:
-                    rank_counts[rank] += 1
-                    total_rank += rank
-                else:
-                    rank_counts['希望外'] += 1
-                    total_rank += self.num_choices + 1
-                count += 1
-
-            avg_rank = total_rank / count if count > 0 else 0
-            max_possible = self.num_periods
-            min_possible = self.num_periods * (self.num_choices + 1)
-            satisfaction = 100 * (min_possible - total_rank) / (min_possible - max_possible) if min_possible > max_possible else 100
-
-            student_stats.append({
-                'student': student,
-                'satisfaction': satisfaction,
-                'avg_rank': avg_rank,
-                'rank_counts': rank_counts
-            })
-
-        student_stats.sort(key=lambda x: x['satisfaction'])
+        ws_stats.append([styled(ws_stats, header, '配置_見出し') for header in stat_headers])
 
-        for row_idx, stat in enumerate(student_stats, 2):
-            student = stat['student']
+        # 生徒番号順に並べてから満足度の低い順に（同点は生徒番号順）
+        stats = self.statistics(result)
+        by_id = np.array([self.student_index[student['id']] for student in sorted_students], dtype=np.int64)
+        order = by_id[np.argsort(stats['satisfaction'][by_id], kind='stable')]
 
-            cell = ws_stats.cell(row_idx, 1, student['id'])
-            cell.border = border
-            cell.alignment = center_align
-
-            cell = ws_stats.cell(row_idx, 2, student['name'])
-            cell.border = border
-            cell.alignment = left_align
+        for s in order:
+            student = self.students[s]
+            satisfaction = float(stats['satisfaction'][s])
 
-            cell = ws_stats.cell(row_idx, 3, round(stat['satisfaction'], 1))
-            cell.border = border
-            cell.alignment = center_align
-            if stat['satisfaction'] >= 80:
-                cell.fill = good_fill
-            elif stat['satisfaction'] >= 60:
-                cell.fill = warning_fill
+            if satisfaction >= 80:
+                satisfaction_style = '配置_中央_良'
+            elif satisfaction >= 60:
+                satisfaction_style = '配置_中央_注意'
             else:
-                cell.fill = bad_fill
-
-            cell = ws_stats.cell(row_idx, 4, round(stat['avg_rank'], 2))
-            cell.border = border
-            cell.alignment = center_align
+                satisfaction_style = '配置_中央_不良'
 
-            for rank in range(1, self.num_choices + 1):
-                cell = ws_stats.cell(row_idx, 4 + rank, stat['rank_counts'].get(rank, 0))
-                cell.border = border
-                cell.alignment = center_align
-
-            cell = ws_stats.cell(row_idx, 5 + self.num_choices, stat['rank_counts'].get('希望外', 0))
-            cell.border = border
-            cell.alignment = center_align
-
-        summary_row = len(student_stats) + 3
-        ws_stats.cell(summary_row, 1, '【統計】').font = Font(bold=True)
-
-        satisfactions = [s['satisfaction'] for s in student_stats]
-        avg_ranks = [s['avg_rank'] for s in student_stats]
+            row = [styled(ws_stats, student['id'], '配置_中央'),
+                   styled(ws_stats, student['name'], '配置_左'),
+                   styled(ws_stats, round(satisfaction, 1), satisfaction_style),
+                   styled(ws_stats, round(float(stats['avg_rank'][s]), 2), '配置_中央')]
+            row.extend(styled(ws_stats, int(n), '配置_中央') for n in stats['rank_counts'][s])
+            ws_stats.append(row)
 
+        summary = stats['summary']
         stats_info = [
-            (summary_row + 1, '平均満足度', f"{sum(satisfactions)/len(satisfactions):.1f}点"),
-            (summary_row + 2, '最低満足度', f"{min(satisfactions):.1f}点"),
-            (summary_row + 3, '最高満足度', f"{max(satisfactions):.1f}点"),
-            (summary_row + 4, '標準偏差', f"{(sum((s-sum(satisfactions)/len(satisfactions))**2 for s in satisfactions)/len(satisfactions))**0.5:.2f}"),
-            (summary_row + 5, '平均希望順位', f"{sum(avg_ranks)/len(avg_ranks):.2f}"),
+            ('平均満足度', f"{summary['mean_satisfaction']:.1f}点"),
+            ('最低満足度', f"{summary['min_satisfaction']:.1f}点"),
+            ('最高満足度', f"{summary['max_satisfaction']:.1f}点"),
+            ('標準偏差', f"{summary['std_satisfaction']:.2f}"),
+            ('平均希望順位', f"{summary['mean_rank']:.2f}"),
         ]
 
-        for row, label, val in stats_info:
-            ws_stats.cell(row, 1, label).font = Font(bold=True)
-            ws_stats.cell(row, 2, val)
-
-        ws_stats.column_dimensions['A'].width = 12
-        ws_stats.column_dimensions['B'].width = 15
-        ws_stats.column_dimensions['C'].width = 12
-        ws_stats.column_dimensions['D'].width = 12
-        for col in range(5, 6 + self.num_choices):
-            ws_stats.column_dimensions[get_column_letter(col)].width = 10
+        ws_stats.append([])
+        ws_stats.append([styled(ws_stats, '【統計】', '配置_太字')])
+        for label, val in stats_info:
+            ws_stats.append([styled(ws_stats, label, '配置_太字'), val])
 
         wb.save(self.output_file)
         print(f"\n✓ 結果を保存しました: {self.output_file}")
 
-    def print_summary(self, course_selection, schedule):
-        """結果のサマリーを表示"""
+    def statistics(self, result):
+        """配置結果の統計（compute_statistics。目的関数値は求解に実際に使った公平性の方式のもの）"""
+        return compute_statistics(self.rank_matrix, result.assignment, self.num_choices, self.max_per_course,
+                                  fairness=self.applied_fairness or 'weighted')
+
+    def statistics_report(self, stats):
+        """statistics() の結果をJSONに変換できる辞書にする"""
+        labels = [f'第{i}希望' for i in range(1, self.num_choices + 1)] + ['希望外']
+        return {
+            'summary': stats['summary'],
+            'rank_distribution': dict(zip(labels, stats['rank_totals'].tolist())),
+            'courses': {
+                course: {
+                    'counts': stats['counts'][:, c].tolist(),
+                    'fill_rate': stats['fill_rate'][:, c].round(4).tolist(),
+                }
+                for c, course in enumerate(self.courses)
+            },
+            'students': [
+                {
+                    'id': student['id'],
+                    'name': student['name'],
+                    'score': int(stats['scores'][s]),
+                    'satisfaction': round(float(stats['satisfaction'][s]), 1),
+                    'avg_rank': round(float(stats['avg_rank'][s]), 2),
+                    'rank_counts': dict(zip(labels, stats['rank_counts'][s].tolist())),
+                }
+                for s, student in enumerate(self.students)
+            ],
+        }
+
+    def save_statistics_json(self, stats, path):
+        """statistics() の結果をJSONファイルに保存"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.statistics_report(stats), f, ensure_ascii=False, indent=2)
+        print(f"\n✓ 統計を保存しました: {path}")
+
+    @traced('print_summary')
+    def print_summary(self, result, schedule=None):
+        """
+        結果のサマリーを表示
+
+        result: ScheduleResult（従来の (course_selection, schedule) の2引数も受け付ける）
+        """
+        if schedule is not None:
+            result = self.make_result(result, schedule)
+
         print("\n" + "=" * 70)
         print("配置結果サマリー")
         print("=" * 70)
@@ -682,40 +3132,423 @@ class StudentScheduler:
         for period in range(1, self.num_periods + 1):
             print(f"\n  {period}限:")
             for course in self.courses:
-                count = sum(1 for s in self.students
-                            if schedule[s['id']].get(period) == course)
+                count = result.counts[period, course]
                 in_range = self.min_per_course <= count <= self.max_per_course
                 status = "✓" if in_range else "!"
                 print(f"    {course}: {count}名 {status}")
 
         print("\n【希望達成状況】")
-        rank_counts = defaultdict(int)
-        total_assignments = 0
-
-        for student in self.students:
-            selected = course_selection.get(student['id'], set())
-            for course in selected:
-                total_assignments += 1
-                rank = self.get_preference_rank(student, course)
-                if rank <= self.num_choices:
-                    rank_counts[rank] += 1
-                else:
-                    rank_counts['希望外'] += 1
+        rank_totals = self.statistics(result)['rank_totals']
+        total_assignments = int(rank_totals.sum())
 
         for rank in range(1, self.num_choices + 1):
-            count = rank_counts.get(rank, 0)
+            count = int(rank_totals[rank - 1])
             percentage = count / total_assignments * 100 if total_assignments > 0 else 0
             bar = "■" * int(percentage / 5)
             print(f"  第{rank}希望: {count:3d}件 ({percentage:5.1f}%) {bar}")
 
-        hope_outside = rank_counts.get('希望外', 0)
+        hope_outside = int(rank_totals[-1])
         if hope_outside > 0:
             percentage = hope_outside / total_assignments * 100
             bar = "■" * int(percentage / 5)
             print(f"  希望外 : {hope_outside:3d}件 ({percentage:5.1f}%) {bar}")
 
+    def survey_state(self):
+        """読み込み済みのアンケート（rank_matrix 以外）を辞書で返す（スイープの各プロセスに渡す）"""
+        return {
+            'num_students': self.num_students,
+            'num_choices': self.num_choices,
+            'students': self.students,
+            'courses': self.courses,
+            'profile_groups': self.profile_groups,
+            'student_index': self.student_index,
+            'course_index': self.course_index,
+            'time_limit': self.time_limit,
+            'mip_gap': self.mip_gap,
+            'engine': self.engine,
+            'threads': self.threads,
+            'seed': self.seed,
+            'parallel': self.parallel,
+            'fairness': self.fairness,
+            'rank_cap': self.rank_cap,
+        }
+
+    @classmethod
+    def from_survey(cls, state, rank_matrix, num_periods, min_per_course, max_per_course):
+        """survey_state() と rank_matrix から、人数条件だけを変えたインスタンスを作る"""
+        scheduler = cls(state['num_students'], num_periods, state['num_choices'],
+                        min_per_course, max_per_course)
+        for key in ('students', 'courses', 'profile_groups', 'student_index', 'course_index',
+                    'time_limit', 'mip_gap', 'engine', 'threads', 'seed', 'parallel', 'fairness', 'rank_cap'):
+            setattr(scheduler, key, state[key])
+        scheduler.rank_matrix = rank_matrix
+        return scheduler
+
+
+# スイープの各ワーカープロセスが保持するアンケート（プロセス起動時に1回だけ受け取る）
+_sweep_survey: Dict[str, Any] = {}
+
+
+def _init_sweep_worker(state, shm_name, shape, dtype):
+    """ワーカーの初期化: アンケートを受け取り、rank_matrix は共有メモリを参照する"""
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _sweep_survey.update(state)
+    _sweep_survey['shm'] = shm  # 参照を保持しないとバッファが解放される
+    _sweep_survey['rank_matrix'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _solve_sweep_scenario(scenario):
+    """1つのシナリオ (min, max, num_periods) を解いて比較表の1行を返す"""
+    min_per_course, max_per_course, num_periods, mode = scenario
+    row = {'min': min_per_course, 'max': max_per_course, 'periods': num_periods}
+    scheduler = StudentScheduler.from_survey(_sweep_survey, _sweep_survey['rank_matrix'],
+                                             num_periods, min_per_course, max_per_course)
+    start_time = time.time()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = scheduler.solve(mode)
+    except Exception as e:
+        row.update(status='エラー', fairness=scheduler.fairness, objective=None, weighted_objective=None,
+                   total=None, spread=None, violation=None,
+                   seconds=round(time.time() - start_time, 2), message=str(e))
+        return row
+
+    summary = scheduler.statistics(result)['summary']
+    violation = sum(abs(v['amount']) for v in scheduler.violations)
+    row.update(status='範囲外' if violation else 'OK', fairness=summary['fairness'],
+               objective=summary['objective'], weighted_objective=summary['weighted_objective'],
+               total=summary['total_score'], spread=summary['score_spread'],
+               violation=violation, seconds=round(time.time() - start_time, 2), message='')
+    return row
+
+
+def run_sweep(scheduler, scenarios, mode='decomposed', max_workers=None):
+    """
+    読み込み済みのアンケートについて、複数の人数条件をプロセスプールで並列に解く
+
+    scenarios: (min_per_course, max_per_course, num_periods) のリスト
+    rank_matrix は共有メモリに1回だけ置き、各ワーカーはそれを参照する
+    （アンケートの読み込み・希望順位の計算はワーカーでは行わない）。
+    scheduler.threads が None なら、ワーカーどうしで CPU を取り合わないように
+    各ワーカーのソルバーのスレッド数を CPU数 // ワーカー数（最低1）にする。
+
+    戻り値: シナリオの順の比較表（辞書のリスト）
+        status    'OK' / '範囲外'（ソフト制約で解いた）/ 'エラー'
+        fairness  実際に使った公平性の方式（ソフト制約で解き直した場合などは weighted）
+        objective その方式の目的関数値（fairness_objective。weighted 以外はリスト）
+        weighted_objective 希望順位の合計 + 10 * spread（方式によらず比べられる値）
+        total     希望順位の合計
+        spread    生徒のスコアの最大 - 最小
+        violation 人数範囲からのずれの合計（人）
+        seconds   求解時間（秒）
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+    cpu_count = os.cpu_count() or 1
+    workers = max(1, min(max_workers or cpu_count, len(scenarios)))
+    state = scheduler.survey_state()
+    if state['threads'] is None:
+        state['threads'] = max(1, cpu_count // workers)
+
+    rank = np.ascontiguousarray(scheduler.rank_matrix)
+    shm = shared_memory.SharedMemory(create=True, size=max(rank.nbytes, 1))
+    try:
+        np.ndarray(rank.shape, dtype=rank.dtype, buffer=shm.buf)[:] = rank
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep_worker,
+                                 initargs=(state, shm.name, rank.shape, rank.dtype.str)) as pool:
+            return list(pool.map(_solve_sweep_scenario,
+                                 [(lo, hi, p, mode) for lo, hi, p in scenarios]))
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def pad(text, width, align='>'):
+    """全角文字を幅2として text を width 桁に揃える（align は '<' で左寄せ、'>' で右寄せ）"""
+    fill = " " * max(0, width - sum(2 if ord(ch) > 0x7f else 1 for ch in str(text)))
+    return f"{text}{fill}" if align == '<' else f"{fill}{text}"
+
+
+def print_sweep_table(rows):
+    """run_sweep の比較表を表示"""
+    print("\n" + "=" * 70)
+    print("人数条件の比較")
+    print("=" * 70)
+    print(f"  {pad('最低', 6)} {pad('最高', 6)} {pad('講座数', 7)}  {pad('状態', 6, '<')}  {pad('方式', 8, '<')} "
+          f"{pad('目的関数値', 15)} {pad('順位合計', 12)} {pad('差', 5)} {pad('ずれ', 7)} {pad('秒', 8)}")
+    for row in rows:
+        if row['status'] == 'エラー':
+            print(f"  {row['min']:>6} {row['max']:>6} {row['periods']:>7}  エラー: {row['message']}")
+            continue
+        print(f"  {row['min']:>6} {row['max']:>6} {row['periods']:>7}  {pad(row['status'], 6, '<')}  "
+              f"{row['fairness']:<8} {format_objective(row['objective']):>15} {row['total']:>12} {row['spread']:>5} "
+              f"{row['violation']:>7} {row['seconds']:>8.2f}")
+
+
+def save_sweep_csv(rows, path):
+    """run_sweep の比較表をCSVに保存"""
+    fields = ['min', 'max', 'periods', 'status', 'fairness', 'objective', 'weighted_objective', 'total', 'spread',
+              'violation', 'seconds', 'message']
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for row in rows:
+            objective = row['objective']
+            writer.writerow({**row, 'objective': format_objective(objective) if objective is not None else None})
+    print(f"\n✓ 比較表を保存しました: {path}")
+
+
+# 終了コード
+EXIT_OK = 0  # 人数範囲を満たす配置を出力した
+EXIT_ERROR = 1  # 入力ファイルの不備・求解の失敗など
+EXIT_USAGE = 2  # 引数の誤り（argparse の既定）
+EXIT_VIOLATION = 3  # 人数範囲を満たせず、ずれを最小にした配置を出力した
+
+
+def parse_args(argv=None):
+    """コマンドライン引数を解析"""
+    parser = argparse.ArgumentParser(
+        description="学生講座配置プログラム（ILP最適化版）",
+        epilog="--input を指定すると対話なしで実行する（テンプレート作成・Excelの起動と監視を行わない）。"
+               f"終了コード: {EXIT_OK}=成功, {EXIT_ERROR}=エラー, {EXIT_USAGE}=引数の誤り, "
+               f"{EXIT_VIOLATION}=人数範囲を満たせず範囲外の配置を出力")
+    parser.add_argument('--solver', choices=['ilp', 'decomposed', 'aggregated', 'heuristic'],
+                        default='ilp',
+                        help="求解方式（既定: ilp）。heuristic は貪欲法＋局所探索で高速に近似解を求める")
+    parser.add_argument('--engine', choices=list(SOLVER_ENGINES), default=None,
+                        help="ILPを解く求解エンジン（既定: highs、highspy が無ければ pulp）。"
+                             "cpsat は OR-Tools の CP-SAT（pip install \"student-scheduler[cpsat]\" が必要）")
+    parser.add_argument('--time-limit', type=float, default=None, metavar='秒',
+                        help="求解の制限時間。到達したらその時点の最良の暫定解を使う（既定: 無制限）")
+    parser.add_argument('--mip-gap', type=float, default=None, metavar='割合',
+                        help="相対ギャップがこの値以下になったら終了する（例: 0.01）")
+    parser.add_argument('--threads', type=int, default=None, metavar='N',
+                        help="ソルバーのスレッド数（既定: ソルバーの既定値）")
+    parser.add_argument('--seed', type=int, default=None, metavar='N',
+                        help="ソルバーとヒューリスティックの乱数シード（既定: ソルバーの既定値）")
+    parser.add_argument('--parallel', choices=['deterministic', 'opportunistic', 'off'],
+                        default='deterministic',
+                        help="並列化の方式。deterministic は同じスレッド数・シードなら同じ結果になる（既定）。"
+                             "opportunistic は速さ優先で実行ごとに結果が変わりうる。off は1スレッド")
+    parser.add_argument('--fairness', choices=list(FAIRNESS_STRATEGIES), default='weighted',
+                        help="公平性の扱い（ilp と decomposed のみ）。weighted は希望順位の合計に公平性ペナルティを"
+                             "足して1回で解く（既定）。minimax は最悪の生徒のスコアを最小にしてから合計を最小にする。"
+                             "cap は全員の希望順位を --rank-cap 以内（省略時はできるだけ小さく）に抑える。"
+                             "profile は低い希望順位の件数を悪い方から順に減らす")
+    parser.add_argument('--rank-cap', type=int, default=None, metavar='K',
+                        help="--fairness cap で、全員がこの順位以内の講座だけを受講するようにする")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="求解キャッシュを使わずに必ず解き直す")
+    parser.add_argument('--cache-dir', metavar='PATH', default=None,
+                        help="求解キャッシュの保存先（既定: 環境変数 STUDENT_SCHEDULER_CACHE または "
+                             "ユーザーのキャッシュフォルダ下の student-scheduler）")
+    parser.add_argument('--cache-size', type=float, default=64, metavar='MB',
+                        help="求解キャッシュの合計サイズの上限。超えたら古いものから削除する（既定: 64）")
+
+    profile = parser.add_argument_group("処理時間・メモリの計測")
+    profile.add_argument('--profile-report', metavar='PATH',
+                         help="読み込み・モデル構築・求解・解の取り出し・保存などの段階ごとの所要時間と"
+                              "メモリをJSONで保存し、内訳を表示する")
+    profile.add_argument('--trace-memory', action='store_true',
+                         help="tracemalloc で段階ごとのメモリ確保量のピークと確保の多い箇所も記録する（遅くなる）")
+    profile.add_argument('--cprofile', metavar='PATH',
+                         help="cProfile の結果を保存する（python -m pstats PATH や snakeviz で見る）")
+
+    batch = parser.add_argument_group("バッチ実行")
+    batch.add_argument('--input', metavar='PATH', help="入力ファイル（生徒希望アンケート）")
+    batch.add_argument('--output', metavar='PATH', help="結果ファイル（既定: 出力_講座配置結果.xlsx）")
+    batch.add_argument('--stats-json', metavar='PATH',
+                       help="満足度・希望順位の分布・充足率などの統計をJSONで保存する")
+    batch.add_argument('--students', type=int, metavar='N',
+                       help="生徒の人数（省略時は入力ファイルの最初の空行までを読む。指定すると読み込んだ人数と照合する）")
+    batch.add_argument('--choices', type=int, metavar='N', help="講座数（希望順位の数）")
+    batch.add_argument('--periods', type=int, metavar='N', help="受講する講座数")
+    batch.add_argument('--min', type=int, dest='min_per_course', metavar='N', help="1コマあたりの最低人数")
+    batch.add_argument('--max', type=int, dest='max_per_course', metavar='N', help="1コマあたりの最高人数")
+
+    incremental = parser.add_argument_group("前回の配置からの再計算（--input と併用）")
+    incremental.add_argument('--previous', metavar='PATH',
+                             help="前回の結果ファイル。変更の無い生徒の配置をできるだけ保って再計算する")
+    incremental.add_argument('--previous-input', metavar='PATH',
+                             help="前回の入力ファイル。希望を書き換えた生徒を検出するのに使う")
+    incremental.add_argument('--move-penalty', type=float, default=None, metavar='N',
+                             help="変更の無い生徒の講座を1つ動かすごとのペナルティ"
+                                  "（既定: 11×(講座数+1)、0 で移動を妨げない）")
+
+    sweep = parser.add_argument_group("人数条件のスイープ（--input と併用）")
+    sweep.add_argument('--sweep-min', type=int, nargs='+', metavar='N',
+                       help="試す最低人数（省略時は --min のみ）")
+    sweep.add_argument('--sweep-max', type=int, nargs='+', metavar='N',
+                       help="試す最高人数（省略時は --max のみ）")
+    sweep.add_argument('--sweep-periods', type=int, nargs='+', metavar='N',
+                       help="試す受講講座数（省略時は --periods のみ）")
+    sweep.add_argument('--sweep-output', metavar='PATH', help="比較表のCSVの保存先")
+    sweep.add_argument('--workers', type=int, default=None, metavar='N',
+                       help="並列に解くプロセス数（既定: CPU数）")
+
+    args = parser.parse_args(argv)
+    if args.engine is not None and args.engine not in available_engines():
+        parser.error(engine_install_hint(args.engine))
+    if args.threads is not None and args.threads < 1:
+        parser.error("--threads は1以上を指定してください")
+    if args.rank_cap is not None:
+        if args.fairness != 'cap':
+            parser.error("--rank-cap は --fairness cap と一緒に指定してください")
+        if args.rank_cap < 1:
+            parser.error("--rank-cap は1以上を指定してください")
+    if args.cache_size < 0:
+        parser.error("--cache-size は0以上を指定してください")
+    if args.input is not None:
+        required = {'--choices': args.choices, '--periods': args.periods,
+                    '--min': args.min_per_course, '--max': args.max_per_course}
+        missing = [name for name, v in required.items() if v is None]
+        if missing:
+            parser.error(f"--input を指定した場合は {', '.join(missing)} も指定してください")
+        if args.choices <= 0 or (args.students is not None and args.students <= 0):
+            parser.error("--students と --choices は1以上を指定してください")
+        if not 1 <= args.periods <= args.choices:
+            parser.error(f"--periods は1〜{args.choices}を指定してください")
+        if not 0 <= args.min_per_course <= args.max_per_course:
+            parser.error("--min は0以上、--max は --min 以上を指定してください")
+        if args.previous is not None and (args.sweep_min or args.sweep_max or args.sweep_periods):
+            parser.error("--previous と --sweep-* は同時に指定できません")
+        if args.move_penalty is not None and args.move_penalty < 0:
+            parser.error("--move-penalty は0以上を指定してください")
+    elif args.sweep_min or args.sweep_max or args.sweep_periods:
+        parser.error("--sweep-min/--sweep-max/--sweep-periods は --input と一緒に指定してください")
+    elif args.previous is not None:
+        parser.error("--previous は --input と一緒に指定してください")
+    if args.previous is None and (args.previous_input is not None or args.move_penalty is not None):
+        parser.error("--previous-input/--move-penalty は --previous と一緒に指定してください")
+    return args
+
+
+def sweep_scenarios(args):
+    """--sweep-* の組み合わせ（最低人数 <= 最高人数、受講講座数 <= 講座数のもの）"""
+    return [(lo, hi, p) for lo, hi, p in itertools.product(args.sweep_min or [args.min_per_course],
+                                                           args.sweep_max or [args.max_per_course],
+                                                           args.sweep_periods or [args.periods])
+            if 0 <= lo <= hi and 1 <= p <= args.choices]
+
+
+def solve_cache(args):
+    """--no-cache / --cache-dir / --cache-size から SolveCache を作る（--no-cache なら None）"""
+    if args.no_cache:
+        return None
+    return SolveCache(args.cache_dir, int(args.cache_size * 1024 * 1024))
+
+
+def report_profile(profiler, args, exit_code):
+    """--profile-report / --trace-memory が指定されていれば処理時間の内訳を表示し、実行レポートを保存する"""
+    if args.profile_report is None and not args.trace_memory:
+        return
+    profiler.print_table()
+    if args.profile_report is not None:
+        try:
+            profiler.save(args.profile_report, exit_code=exit_code, solver=args.solver, engine=args.engine)
+        except OSError as e:
+            print(f"※ 実行レポートを保存できませんでした: {e}", file=sys.stderr)
+        else:
+            print(f"実行レポートを保存しました: {args.profile_report}")
+
+
+def run_batch(args):
+    """
+    対話なしで読み込み → 求解 → 保存を行う
+
+    戻り値: 終了コード（EXIT_OK / EXIT_ERROR / EXIT_VIOLATION）
+    """
+    profiler = RunProfiler(args.trace_memory)
+    exit_code = _run_batch(args, profiler)
+    report_profile(profiler, args, exit_code)
+    return exit_code
+
+
+def _run_batch(args, profiler):
+    """run_batch の本体"""
+    try:
+        scheduler = StudentScheduler(args.students, args.periods, args.choices,
+                                     args.min_per_course, args.max_per_course)
+        scheduler.profiler = profiler
+        scheduler.input_file = args.input
+        if args.output is not None:
+            scheduler.output_file = args.output
+        scheduler.time_limit = args.time_limit
+        scheduler.mip_gap = args.mip_gap
+        scheduler.cache = solve_cache(args)
+        scheduler.engine = args.engine
+        scheduler.threads = args.threads
+        scheduler.seed = args.seed
+        scheduler.parallel = args.parallel
+        scheduler.fairness = args.fairness
+        scheduler.rank_cap = args.rank_cap
+
+        scheduler.load_data()
+
+        if args.sweep_min or args.sweep_max or args.sweep_periods:
+            scenarios = sweep_scenarios(args)
+            print(f"\n{len(scenarios)}通りの人数条件を並列に求解中...")
+            with profiler.span('sweep', scenarios=len(scenarios)):
+                rows = run_sweep(scheduler, scenarios, args.solver, args.workers)
+            print_sweep_table(rows)
+            if args.sweep_output is not None:
+                save_sweep_csv(rows, args.sweep_output)
+            return EXIT_ERROR if all(row['status'] == 'エラー' for row in rows) else EXIT_OK
+
+        if args.previous is not None:
+            previous_preferences = None
+            if args.previous_input is not None:
+                before = StudentScheduler(None, args.periods, args.choices,
+                                          args.min_per_course, args.max_per_course)
+                before.input_file = args.previous_input
+                with contextlib.redirect_stdout(io.StringIO()):
+                    before.load_data()
+                previous_preferences = {student['id']: student['preferences'] for student in before.students}
+            result = scheduler.solve_incremental(load_previous_schedule(args.previous),
+                                                 previous_preferences, args.move_penalty)
+        else:
+            result = scheduler.solve(args.solver)
+        scheduler.print_summary(result)
+        scheduler.save_results(result)
+        if args.stats_json is not None:
+            scheduler.save_statistics_json(scheduler.statistics(result), args.stats_json)
+
+    except FileNotFoundError as e:
+        print(f"\nエラー: ファイルが見つかりません - {e}", file=sys.stderr)
+        return EXIT_ERROR
+    except (KeyError, ValueError) as e:
+        print(f"\nエラー: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    except Exception as e:
+        print(f"\nエラーが発生しました: {e}", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+        return EXIT_ERROR
+
+    return EXIT_VIOLATION if scheduler.violations else EXIT_OK
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.cprofile is None:
+        return run(args)
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(run, args)
+    finally:
+        profile.dump_stats(args.cprofile)
+        print(f"cProfile の結果を保存しました: {args.cprofile}")
+
+
+def run(args):
+    """解析済みの引数で実行する（--input があればバッチ、無ければ対話）"""
+    if args.input is not None:
+        return run_batch(args)
 
-def main():
     print("=" * 70)
     print("        学生講座配置プログラム（ILP最適化版）")
     print("=" * 70)
@@ -770,8 +3603,19 @@ def main():
         except ValueError:
             print("数値を入力してください。")
 
+    profiler = RunProfiler(args.trace_memory)
     try:
         scheduler = StudentScheduler(num_students, num_periods, num_choices, min_per_course, max_per_course)
+        scheduler.profiler = profiler
+        scheduler.time_limit = args.time_limit
+        scheduler.mip_gap = args.mip_gap
+        scheduler.cache = solve_cache(args)
+        scheduler.engine = args.engine
+        scheduler.threads = args.threads
+        scheduler.seed = args.seed
+        scheduler.parallel = args.parallel
+        scheduler.fairness = args.fairness
+        scheduler.rank_cap = args.rank_cap
 
         print("\n" + "=" * 70)
         print("ステップ1: 入力ファイルの準備")
@@ -790,16 +3634,16 @@ def main():
         scheduler.load_data()
 
         print("\n" + "=" * 70)
-        print("ステップ4: 最適化計算（ILP）")
+        print(f"ステップ4: 最適化計算（{args.solver}）")
         print("=" * 70)
-        course_selection, schedule = scheduler.solve_with_ilp()
+        result = scheduler.solve(args.solver)
 
-        scheduler.print_summary(course_selection, schedule)
+        scheduler.print_summary(result)
 
         print("\n" + "=" * 70)
         print("ステップ5: 結果の保存")
         print("=" * 70)
-        scheduler.save_results(course_selection, schedule)
+        scheduler.save_results(result)
 
         print("\n結果ファイルを開きます...")
         scheduler.open_excel_file(scheduler.output_file)
@@ -807,18 +3651,24 @@ def main():
         print("\n" + "=" * 70)
         print("処理が完了しました！")
         print("=" * 70)
+        exit_code = EXIT_VIOLATION if scheduler.violations else EXIT_OK
 
     except FileNotFoundError as e:
         print(f"\nエラー: ファイルが見つかりません - {e}")
+        exit_code = EXIT_ERROR
     except ValueError as e:
         print(f"\nエラー: {e}")
+        exit_code = EXIT_ERROR
     except Exception as e:
         print(f"\nエラーが発生しました: {e}")
         import traceback
         traceback.print_exc()
+        exit_code = EXIT_ERROR
 
+    report_profile(profiler, args, exit_code)
     input("\nEnterキーを押して終了...")
+    return exit_code
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
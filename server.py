@@ -0,0 +1,517 @@
+# server.py
+"""
+学生講座配置のサーバーモード
+
+複数の学校のアンケートを1台のマシンで受け付けて順に解く、常駐型のローカルHTTPサービス。
+アンケートのファイルと人数条件を POST するとジョブとしてキューに入り、
+プロセスプール（--workers 個）で解かれる。ワーカーはサーバーの起動時にすべて立ち上げ、
+openpyxl・PuLP と既定の求解エンジンを import しておくので、最初のジョブから
+インタープリタ起動と import の時間がかからない。ワーカーが異常終了してプールが壊れた場合は
+次のジョブの登録時に作り直す。完了したジョブは --job-ttl 秒たつとファイルごと削除する。
+
+    python server.py --port 8765 --workers 2 --time-limit 120
+
+    # アンケートを送る（パラメータはクエリ文字列、本文はファイルそのもの）
+    curl --data-binary @入力.xlsx \
+        "http://127.0.0.1:8765/jobs?choices=6&periods=4&min=15&max=25&solver=decomposed"
+    # → {"id": "...", "status": "queued", ...}
+    curl http://127.0.0.1:8765/jobs/<id>                        # 状態
+    curl -o 結果.xlsx http://127.0.0.1:8765/jobs/<id>/result.xlsx
+    curl http://127.0.0.1:8765/jobs/<id>/result.json             # 配置・統計のJSON
+
+エンドポイント:
+    POST   /jobs                  ジョブの登録（202）。キューが満杯なら 503
+    GET    /jobs                  ジョブの一覧
+    GET    /jobs/<id>             ジョブの状態（queued / running / done / failed）
+    GET    /jobs/<id>/result.xlsx 結果のExcelファイル
+    GET    /jobs/<id>/result.json 生徒別の配置・人数範囲外の時限・講座・統計
+    GET    /jobs/<id>/log         求解中の出力
+    DELETE /jobs/<id>             ジョブとファイルの削除（待ちのジョブは実行しない。実行中は 409）
+    GET    /health                プールの状態・ワーカー数・キューの長さ・使える求解エンジン
+                                  （プールが壊れていれば 503）
+"""
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+from urllib.parse import parse_qs, urlsplit
+
+from main import (EXIT_OK, EXIT_ERROR, EXIT_VIOLATION, ENGINE_PACKAGES, FAIRNESS_STRATEGIES, SolveCache,
+                  StudentScheduler, available_engines, engine_install_hint, pulp_solvers)
+
+# 受け付けるアンケートの形式
+SURVEY_FORMATS = ('xlsx', 'csv', 'tsv')
+SOLVERS = ('ilp', 'decomposed', 'aggregated', 'heuristic')
+# ワーカーの起動時に import しておく、求解エンジンごとのモジュール
+ENGINE_MODULES = {'highs': 'highspy', 'cpsat': 'ortools.sat.python.cp_model', 'pulp': 'pulp'}
+# 1つのジョブのアンケートの上限（バイト）
+MAX_SURVEY_BYTES = 32 * 1024 * 1024
+
+
+def job_params(query, max_time_limit=None):
+    """
+    クエリ文字列（parse_qs の結果）からジョブのパラメータを作る
+
+    choices, periods, min, max は必須。time_limit は max_time_limit を上限とし、
+    省略時は max_time_limit にする。不正な値は ValueError。
+    """
+    def get(name, type_, default=None):
+        values = query.get(name)
+        if not values or values[-1] == '':
+            return default
+        try:
+            return type_(values[-1])
+        except ValueError:
+            raise ValueError(f"{name} の値が不正です: {values[-1]}") from None
+
+    params = {
+        'students': get('students', int),
+        'choices': get('choices', int),
+        'periods': get('periods', int),
+        'min': get('min', int),
+        'max': get('max', int),
+        'solver': get('solver', str, 'decomposed'),
+        'engine': get('engine', str),
+        'time_limit': get('time_limit', float, max_time_limit),
+        'mip_gap': get('mip_gap', float),
+        'seed': get('seed', int),
+        'fairness': get('fairness', str, 'weighted'),
+        'rank_cap': get('rank_cap', int),
+        'format': get('format', str, 'xlsx').lower(),
+    }
+    missing = [name for name in ('choices', 'periods', 'min', 'max') if params[name] is None]
+    if missing:
+        raise ValueError(f"{', '.join(missing)} を指定してください")
+    if params['choices'] <= 0 or (params['students'] is not None and params['students'] <= 0):
+        raise ValueError("students と choices は1以上を指定してください")
+    if not 1 <= params['periods'] <= params['choices']:
+        raise ValueError(f"periods は1〜{params['choices']}を指定してください")
+    if not 0 <= params['min'] <= params['max']:
+        raise ValueError("min は0以上、max は min 以上を指定してください")
+    if params['solver'] not in SOLVERS:
+        raise ValueError(f"solver は {', '.join(SOLVERS)} のいずれかを指定してください")
+    if params['engine'] is not None and params['engine'] not in available_engines():
+        raise ValueError(f"engine は {', '.join(available_engines())} のいずれかを指定してください")
+    if params['fairness'] not in FAIRNESS_STRATEGIES:
+        raise ValueError(f"fairness は {', '.join(FAIRNESS_STRATEGIES)} のいずれかを指定してください")
+    if params['rank_cap'] is not None and (params['fairness'] != 'cap' or params['rank_cap'] < 1):
+        raise ValueError("rank_cap は fairness=cap と一緒に1以上を指定してください")
+    if params['format'] not in SURVEY_FORMATS:
+        raise ValueError(f"format は {', '.join(SURVEY_FORMATS)} のいずれかを指定してください")
+    if params['time_limit'] is not None:
+        if params['time_limit'] <= 0:
+            raise ValueError("time_limit は0より大きい値を指定してください")
+        if max_time_limit is not None:
+            params['time_limit'] = min(params['time_limit'], max_time_limit)
+    return params
+
+
+# ワーカープロセスの設定（プロセス起動時に1回だけ受け取る）
+_worker_config: Dict[str, Any] = {}
+
+
+def _init_worker(config):
+    """ワーカーの初期化: 設定を受け取り、結果の保存と求解に使うライブラリを先に import する"""
+    # Ctrl+C はサーバー本体が受けて、実行中のジョブの完了を待ってから終了する
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_config.update(config)
+    importlib.import_module('openpyxl')
+    pulp_solvers()
+    engine = config['engine'] or StudentScheduler(0, 1, 1, 0, 0).engine_name()
+    importlib.import_module(ENGINE_MODULES[engine])
+
+
+def run_job(job_dir, params):
+    """
+    ワーカーで1つのジョブを解く
+
+    job_dir の survey.<format> を読み、result.xlsx・result.json・log.txt を書く。
+    params['time_limit'] はワーカーが受け取ってからのジョブ全体（読み込み・求解・
+    制約を緩和した再試行）の制限時間として StudentScheduler.deadline に渡す。
+    戻り値: {'exit_code', 'violations', 'seconds', 'error'}
+    """
+    start = time.perf_counter()
+    outcome = {'exit_code': EXIT_OK, 'violations': [], 'error': None}
+    try:
+        log = open(os.path.join(job_dir, 'log.txt'), 'x', encoding='utf-8')
+    except FileExistsError:
+        # 待ちの間に JobQueue.delete で削除された（delete が先に log.txt を作る）
+        return {'exit_code': EXIT_ERROR, 'violations': [], 'error': "削除されたジョブです", 'seconds': 0.0}
+    with log, contextlib.redirect_stdout(log):
+        try:
+            scheduler = StudentScheduler(params['students'], params['periods'], params['choices'],
+                                         params['min'], params['max'])
+            scheduler.input_file = os.path.join(job_dir, f"survey.{params['format']}")
+            scheduler.output_file = os.path.join(job_dir, 'result.xlsx')
+            scheduler.time_limit = params['time_limit']
+            if params['time_limit'] is not None:
+                scheduler.deadline = start + params['time_limit']
+            scheduler.mip_gap = params['mip_gap']
+            scheduler.seed = params['seed']
+            scheduler.fairness = params['fairness']
+            scheduler.rank_cap = params['rank_cap']
+            scheduler.engine = params['engine'] or _worker_config.get('engine')
+            scheduler.threads = _worker_config.get('threads')
+            if _worker_config.get('cache', True):
+                scheduler.cache = SolveCache(_worker_config.get('cache_dir'))
+
+            scheduler.load_data()
+            result = scheduler.solve(params['solver'])
+            scheduler.save_results(result)
+
+            document = {
+                'schedule': {student_id: [row[p] for p in range(1, scheduler.num_periods + 1)]
+                             for student_id, row in result.schedule.items()},
+                'violations': scheduler.violations,
+                'statistics': scheduler.statistics_report(scheduler.statistics(result)),
+            }
+            with open(os.path.join(job_dir, 'result.json'), 'w', encoding='utf-8') as f:
+                json.dump(document, f, ensure_ascii=False, indent=2)
+            outcome['violations'] = scheduler.violations
+            if scheduler.violations:
+                outcome['exit_code'] = EXIT_VIOLATION
+        except (FileNotFoundError, KeyError, ValueError) as e:
+            print(f"\nエラー: {e}")
+            outcome.update(exit_code=EXIT_ERROR, error=str(e))
+        except Exception as e:
+            print(f"\nエラーが発生しました: {e}")
+            import traceback
+            traceback.print_exc(file=log)
+            outcome.update(exit_code=EXIT_ERROR, error=f"{type(e).__name__}: {e}")
+    outcome['seconds'] = round(time.perf_counter() - start, 3)
+    return outcome
+
+
+class JobQueue:
+    """
+    ジョブの登録・状態の管理
+
+    ジョブは work_dir/<id>/ にファイルを置き、プロセスプールに投入する。
+    pool の内部キューとは別に、未完了のジョブ数を max_pending で制限する。
+    プールは作るときに全ワーカーを起動して初期化を済ませ、壊れていれば（ワーカーの
+    異常終了）次の登録時に作り直す。完了から job_ttl 秒たったジョブはファイルごと削除する。
+    """
+
+    def __init__(self, work_dir, workers, max_pending, config, job_ttl=None):
+        self.work_dir = work_dir
+        self.workers = workers
+        self.max_pending = max_pending
+        self.config = config
+        self.job_ttl = job_ttl  # 完了したジョブを残す秒数。None なら削除しない
+        self.jobs = {}  # id → ジョブの辞書（future は状態を返すときに参照する）
+        self.lock = threading.Lock()
+        self.pool = None
+        self._start_pool()
+
+    def _start_pool(self):
+        """プロセスプールを作り、全ワーカーを起動して初期化（import）が終わるまで待つ"""
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                        initargs=(self.config,))
+        # 空きのワーカーが無い間は submit のたびにワーカーが1つ増えるので、
+        # ワーカー数だけ軽い処理を同時に投げれば全ワーカーが立ち上がる
+        for future in [self.pool.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+
+    def broken(self):
+        """プロセスプールが壊れているか（ワーカーの異常終了で新しいジョブを受け付けない状態）"""
+        # ProcessPoolExecutor は壊れたことを公開していないので内部の _broken を見る
+        return bool(getattr(self.pool, '_broken', False))
+
+    def _restart_pool(self):
+        print("※ ワーカーが異常終了したため、プロセスプールを作り直します", flush=True)
+        self.pool.shutdown(wait=False)
+        self._start_pool()
+
+    def _submit_job(self, job_dir, params):
+        """run_job をプールに投入する。壊れていれば作り直して投入し直す"""
+        if self.broken():
+            self._restart_pool()
+        try:
+            return self.pool.submit(run_job, job_dir, params)
+        except BrokenProcessPool:
+            self._restart_pool()
+            return self.pool.submit(run_job, job_dir, params)
+
+    def pending(self):
+        """未完了（待ち・実行中）のジョブ数"""
+        return sum(not job['future'].done() for job in self.jobs.values())
+
+    def evict_expired(self):
+        """完了から job_ttl 秒たったジョブとファイルを削除する"""
+        if self.job_ttl is None:
+            return
+        limit = time.time() - self.job_ttl
+        with self.lock:
+            expired = [job for job in self.jobs.values()
+                       if job['finished'] is not None and job['finished'] < limit]
+            for job in expired:
+                del self.jobs[job['id']]
+        for job in expired:
+            shutil.rmtree(job['dir'], ignore_errors=True)
+
+    def submit(self, survey, params):
+        """
+        ジョブを登録して状態を返す。キューが満杯なら None
+
+        プールを作り直してもワーカーを起動できなければ BrokenProcessPool
+        （ジョブのファイルは削除する）。
+        """
+        self.evict_expired()
+        with self.lock:
+            if self.pending() >= self.max_pending:
+                return None
+            job_id = uuid.uuid4().hex
+            job_dir = os.path.join(self.work_dir, job_id)
+            os.makedirs(job_dir)
+            with open(os.path.join(job_dir, f"survey.{params['format']}"), 'wb') as f:
+                f.write(survey)
+            try:
+                future = self._submit_job(job_dir, params)
+            except BrokenProcessPool:
+                shutil.rmtree(job_dir, ignore_errors=True)
+                raise
+            self.jobs[job_id] = {'id': job_id, 'dir': job_dir, 'params': params,
+                                 'submitted': time.time(), 'finished': None, 'future': future}
+            future.add_done_callback(lambda _, job=self.jobs[job_id]: job.update(finished=time.time()))
+            return self.status(job_id)
+
+    def status(self, job_id):
+        """ジョブの状態（JSON にできる辞書）。無ければ None"""
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        future = job['future']
+        state = {'id': job_id, 'params': job['params'],
+                 'submitted': job['submitted'], 'finished': job['finished']}
+        if not future.done():
+            # future.running() はプールの内部キューに送っただけでも True になるので、
+            # ワーカーが run_job の最初に作る log.txt の有無で判定する
+            running = os.path.exists(os.path.join(job['dir'], 'log.txt'))
+            state['status'] = 'running' if running else 'queued'
+            return state
+        try:
+            outcome = future.result()
+        except Exception as e:  # ワーカープロセスの異常終了など
+            outcome = {'exit_code': EXIT_ERROR, 'violations': [], 'seconds': None,
+                       'error': f"{type(e).__name__}: {e}"}
+        state.update(outcome)
+        state['status'] = 'failed' if outcome['exit_code'] == EXIT_ERROR else 'done'
+        if state['status'] == 'done':
+            state['result'] = {'xlsx': f"/jobs/{job_id}/result.xlsx", 'json': f"/jobs/{job_id}/result.json"}
+        return state
+
+    def path(self, job_id, name):
+        """完了したジョブのファイルのパス（ジョブが無い・未完了・ファイルが無ければ None）"""
+        job = self.jobs.get(job_id)
+        if job is None or not job['future'].done():
+            return None
+        path = os.path.join(job['dir'], name)
+        return path if os.path.exists(path) else None
+
+    def delete(self, job_id):
+        """
+        ジョブとファイルを削除する。戻り値: 削除したら True、実行中なら False、無ければ None
+
+        プールの内部キューに送られた待ちのジョブは future.cancel() で取り消せないので、
+        ワーカーより先に log.txt を作って run_job をすぐに戻らせ、ファイルはそのジョブが
+        終わったときに削除する。どちらが先に log.txt を作るかで実行中かどうかが決まる。
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            future = job['future']
+            if not future.cancel() and not future.done():
+                try:
+                    with open(os.path.join(job['dir'], 'log.txt'), 'x', encoding='utf-8') as log:
+                        log.write("削除されたジョブのため実行しません\n")
+                except FileExistsError:
+                    return False
+                del self.jobs[job_id]
+                future.add_done_callback(lambda _, job_dir=job['dir']: shutil.rmtree(job_dir, ignore_errors=True))
+                return True
+            del self.jobs[job_id]
+        shutil.rmtree(job['dir'], ignore_errors=True)
+        return True
+
+    def shutdown(self):
+        """待ちのジョブを取り消し、実行中のジョブの終了を待つ"""
+        for job in list(self.jobs.values()):
+            job['future'].cancel()
+        self.pool.shutdown(wait=True)
+
+
+class SchedulerRequestHandler(BaseHTTPRequestHandler):
+    """JobQueue を HTTP で公開するハンドラー（self.server.queue を使う）"""
+
+    server_version = "StudentScheduler/0.1"
+
+    def send_json(self, status, document):
+        body = json.dumps(document, ensure_ascii=False, indent=2).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, {'error': message})
+
+    def send_file(self, path, content_type):
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def route(self):
+        """パスを ('jobs', id, ファイル名) のような部分に分ける"""
+        return [part for part in urlsplit(self.path).path.split('/') if part]
+
+    def do_POST(self):
+        queue = self.server.queue
+        if self.route() != ['jobs']:
+            return self.send_error_json(HTTPStatus.NOT_FOUND, "POST できるのは /jobs だけです")
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0:
+            return self.send_error_json(HTTPStatus.BAD_REQUEST, "本文にアンケートのファイルを入れてください")
+        if length > MAX_SURVEY_BYTES:
+            return self.send_error_json(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                        f"アンケートは {MAX_SURVEY_BYTES // 1024 ** 2}MB までです")
+        survey = self.rfile.read(length)
+        try:
+            params = job_params(parse_qs(urlsplit(self.path).query), self.server.max_time_limit)
+        except ValueError as e:
+            return self.send_error_json(HTTPStatus.BAD_REQUEST, str(e))
+        try:
+            state = queue.submit(survey, params)
+        except BrokenProcessPool:
+            return self.send_error_json(HTTPStatus.SERVICE_UNAVAILABLE,
+                                        "ワーカーを起動できません。サーバーのログを確認してください")
+        if state is None:
+            return self.send_error_json(HTTPStatus.SERVICE_UNAVAILABLE,
+                                        f"キューが満杯です（{queue.max_pending}件）。しばらくしてから送ってください")
+        self.send_json(HTTPStatus.ACCEPTED, state)
+
+    def do_GET(self):
+        queue = self.server.queue
+        queue.evict_expired()
+        route = self.route()
+        if route == ['health']:
+            broken = queue.broken()
+            return self.send_json(HTTPStatus.SERVICE_UNAVAILABLE if broken else HTTPStatus.OK,
+                                  {'status': 'broken' if broken else 'ok',
+                                   'workers': queue.workers, 'pending': queue.pending(),
+                                   'max_pending': queue.max_pending, 'engines': available_engines()})
+        if route == ['jobs']:
+            return self.send_json(HTTPStatus.OK, [queue.status(job_id) for job_id in list(queue.jobs)])
+        if len(route) < 2 or route[0] != 'jobs' or route[1] not in queue.jobs:
+            return self.send_error_json(HTTPStatus.NOT_FOUND, "ジョブが見つかりません")
+        job_id = route[1]
+        if len(route) == 2:
+            return self.send_json(HTTPStatus.OK, queue.status(job_id))
+
+        files = {'result.xlsx': ('result.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+                 'result.json': ('result.json', 'application/json; charset=utf-8'),
+                 'log': ('log.txt', 'text/plain; charset=utf-8')}
+        if len(route) != 3 or route[2] not in files:
+            return self.send_error_json(HTTPStatus.NOT_FOUND, "不明なパスです")
+        name, content_type = files[route[2]]
+        path = queue.path(job_id, name)
+        if path is None:
+            return self.send_error_json(HTTPStatus.CONFLICT, "ジョブが完了していないか、結果がありません")
+        self.send_file(path, content_type)
+
+    def do_DELETE(self):
+        route = self.route()
+        if len(route) != 2 or route[0] != 'jobs':
+            return self.send_error_json(HTTPStatus.NOT_FOUND, "不明なパスです")
+        deleted = self.server.queue.delete(route[1])
+        if deleted is None:
+            return self.send_error_json(HTTPStatus.NOT_FOUND, "ジョブが見つかりません")
+        if not deleted:
+            return self.send_error_json(HTTPStatus.CONFLICT, "実行中のジョブは削除できません")
+        self.send_json(HTTPStatus.OK, {'id': route[1], 'deleted': True})
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="学生講座配置プログラムのサーバーモード（ジョブキュー）")
+    parser.add_argument('--host', default='127.0.0.1', help="待ち受けるアドレス（既定: 127.0.0.1）")
+    parser.add_argument('--port', type=int, default=8765, help="待ち受けるポート（既定: 8765）")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) // 2), metavar='N',
+                        help="同時に解くジョブ数（既定: CPU数の半分）")
+    parser.add_argument('--max-queue', type=int, default=100, metavar='N',
+                        help="未完了のジョブ数の上限。超えたら 503 を返す（既定: 100）")
+    parser.add_argument('--time-limit', type=float, default=300, metavar='秒',
+                        help="1ジョブの制限時間（読み込み・求解・再試行の合計）の既定値かつ上限（既定: 300）")
+    parser.add_argument('--engine', choices=list(ENGINE_PACKAGES), default=None,
+                        help="既定の求解エンジン（ワーカーの起動時に import しておく）")
+    parser.add_argument('--threads', type=int, default=None, metavar='N',
+                        help="1ジョブあたりのソルバーのスレッド数")
+    parser.add_argument('--work-dir', metavar='PATH', default=None,
+                        help="ジョブのファイルの置き場所（既定: 一時フォルダ。終了時に削除）")
+    parser.add_argument('--job-ttl', type=float, default=24 * 3600, metavar='秒',
+                        help="完了したジョブのファイルを残す秒数。0 なら削除しない（既定: 86400）")
+    parser.add_argument('--no-cache', action='store_true', help="求解キャッシュを使わない")
+    parser.add_argument('--cache-dir', metavar='PATH', default=None, help="求解キャッシュの保存先")
+    parser.add_argument('--quiet', action='store_true', help="リクエストのログを表示しない")
+    args = parser.parse_args(argv)
+    if args.engine is not None and args.engine not in available_engines():
+        parser.error(engine_install_hint(args.engine))
+    if args.workers < 1 or args.max_queue < 1:
+        parser.error("--workers と --max-queue は1以上を指定してください")
+    if args.time_limit <= 0:
+        parser.error("--time-limit は0より大きい値を指定してください")
+    if args.job_ttl < 0:
+        parser.error("--job-ttl は0以上を指定してください")
+    if args.threads is not None and args.threads < 1:
+        parser.error("--threads は1以上を指定してください")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = {'engine': args.engine, 'threads': args.threads,
+              'cache': not args.no_cache, 'cache_dir': args.cache_dir}
+
+    with contextlib.ExitStack() as stack:
+        work_dir = args.work_dir or stack.enter_context(tempfile.TemporaryDirectory(prefix='student-scheduler-'))
+        os.makedirs(work_dir, exist_ok=True)
+        queue = JobQueue(work_dir, args.workers, args.max_queue, config, args.job_ttl or None)
+        httpd = ThreadingHTTPServer((args.host, args.port), SchedulerRequestHandler)
+        httpd.queue = queue
+        httpd.max_time_limit = args.time_limit
+        httpd.quiet = args.quiet
+        print(f"学生講座配置サーバーを起動しました: http://{args.host}:{httpd.server_port}/"
+              f"（ワーカー {args.workers}、キュー上限 {args.max_queue}、制限時間 {args.time_limit:g}秒）",
+              flush=True)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("\n終了します（実行中のジョブの完了を待っています）...")
+        finally:
+            httpd.server_close()
+            queue.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())